@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Benchmark the chart payload size and render time as history grows.
+
+Builds cumulative and weekly charts from synthetic daily download numbers
+covering more and more years of history, with and without downsampling, and
+prints the Google Chart URL length and render time of each. With
+downsampling, both should stay flat once the series are longer than the
+number of points. Exits with an error if the payload of the longest history
+is more than 25% larger than that of the first history long enough to be
+downsampled.
+"""
+from optparse import OptionParser
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'reporter'))
+
+from charts import CHART_MAX_POINTS, chart_spec, google_chart_url, _render_local_chart
+
+
+def synthetic_daily(days, seed=0):
+    rand = random.Random(seed)
+    daily = []
+    level = 100.0
+    for day in xrange(days):
+        level = max(10.0, level * rand.uniform(0.97, 1.035))
+        # Weekly seasonality and the odd launch spike
+        value = level * (0.7 if day % 7 in (5, 6) else 1.0)
+        if rand.random() < 0.005:
+            value *= 8
+        daily.append(int(value))
+    return daily
+
+
+def measure(specs, local):
+    start = time.time()
+    payload = sum(len(google_chart_url(spec)) for spec in specs)
+    if local:
+        for spec in specs:
+            _render_local_chart(spec)
+    return payload, time.time() - start
+
+
+if __name__ == '__main__':
+    optparser = OptionParser()
+    optparser.add_option("--years", dest="years", default="1,2,5,10,20", help="Comma separated years of history to benchmark.")
+    optparser.add_option("--points", dest="points", type="int", default=CHART_MAX_POINTS, help="The number of points to downsample to.")
+    optparser.add_option("--local", dest="local", action="store_true", default=False, help="Also time rendering with the local (matplotlib) backend.")
+    (options, args) = optparser.parse_args()
+
+    if options.local:
+        # Keep matplotlib's import out of the timings
+        _render_local_chart(chart_spec('warmup', 'Warmup', [[0, 1]]))
+
+    print('Years\tDays\tPoints\tPayload\tSeconds\tRaw payload\tRaw seconds')
+
+    payloads = []
+    for years in [int(y) for y in options.years.split(',')]:
+        daily = synthetic_daily(365 * years)
+        weekly = [sum(daily[i:i + 7]) for i in xrange(0, len(daily), 7)]
+        cumulative = []
+        total = 0
+        for value in daily:
+            total += value
+            cumulative.append(total)
+
+        specs = [
+            chart_spec('weekly', 'Weekly Downloads', [weekly], max_points=options.points),
+            chart_spec('cumulative', 'Cumulative Downloads', [cumulative], max_points=options.points),
+        ]
+        raw_specs = [
+            chart_spec('weekly', 'Weekly Downloads', [weekly], max_points=None),
+            chart_spec('cumulative', 'Cumulative Downloads', [cumulative], max_points=None),
+        ]
+
+        payload, seconds = measure(specs, options.local)
+        raw_payload, raw_seconds = measure(raw_specs, options.local)
+        if all(len(s) > options.points for spec in raw_specs for s in spec['series']):
+            payloads.append(payload)
+
+        print('{}\t{}\t{}\t{}\t{:.3f}\t{}\t{:.3f}'.format(
+            years, len(daily), max(len(s) for spec in specs for s in spec['series']),
+            payload, seconds, raw_payload, raw_seconds))
+
+    if payloads and payloads[-1] > payloads[0] * 1.25:
+        print('The chart payload grows with history!')
+        sys.exit(1)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+"""
+Benchmark each stage of the nightly reporting pipeline on synthetic data.
+
+Generates years of synthetic daily reports in a local directory standing in
+for the S3 bucket, then times each stage in its own process:
+
+    parse        `exclude_headers` and csv parsing of every report line
+    daily        `generate_daily_report` over the concatenated reports
+    weekly       `generate_weekly_report` over the concatenated reports
+    concatenate  `_concatenate_reports_in_bucket` from the local bucket
+    email        building the report email's MIME message
+    python-engine, numpy-engine
+                 aggregating every report and rolling the totals up to daily
+                 and weekly reports with `--engine python` or `numpy`
+
+For each stage the best wall time over the repeats and the peak memory the
+stage added to its process are recorded. With `--save-baseline` the results
+are written to the baseline file. Otherwise they are compared with it, and
+the script exits with an error if any stage is slower or uses more memory
+than its baseline by more than the threshold, or if the numpy engine is not
+faster than the python engine.
+"""
+from multiprocessing import Pipe, Process
+from optparse import OptionParser
+import csv
+import datetime
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'reporter'))
+
+from charts import ChartCache
+from columnar import numpy
+from reports import (
+    S3_PREFIX, _concatenate_reports_in_bucket, _iter_key_chunks,
+    _iter_report_lines, _report_keys, build_report_message, exclude_headers,
+    generate_daily_report, generate_reports, generate_weekly_report,
+    get_engine, merge_aggregates)
+from storage import LocalBucket
+from synthetic import generate_reports as generate_synthetic_reports
+from utils import TemporaryDirectory
+
+
+STAGES = ('parse', 'daily', 'weekly', 'concatenate', 'email', 'python-engine', 'numpy-engine')
+
+# The stages run by default, which need no optional packages
+DEFAULT_STAGES = tuple(s for s in STAGES if numpy is not None or s != 'numpy-engine')
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Increases below these are noise
+TIME_SLACK_SECONDS = 0.01
+MEMORY_SLACK_KB = 1024
+
+# A 1x1 transparent PNG, standing in for every chart
+BLANK_PNG = (
+    '\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06'
+    '\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\rIDATx\x9cc\xf8\x0f\x00\x00\x01\x01'
+    '\x00\x05\x18\xd8N\x00\x00\x00\x00IEND\xaeB`\x82'
+)
+
+
+class BlankChartCache(ChartCache):
+    """A chart cache holding every chart, so no chart is rendered."""
+
+    def __init__(self):
+        pass
+
+    def get(self, spec, backend):
+        return BLANK_PNG
+
+
+def _stage(name, data):
+    """
+    Prepare the stage `name` and return the function to time.
+
+    `data` is the directory holding the local bucket and the concatenated
+    reports.
+    """
+    concatenated = os.path.join(data, 'concatenated.txt')
+
+    if name == 'parse':
+        with open(concatenated) as f:
+            lines = f.readlines()
+
+        def parse():
+            for row in csv.reader(exclude_headers(lines), delimiter='\t'):
+                pass
+        return parse
+
+    elif name in ('daily', 'weekly'):
+        f = open(concatenated)
+        return lambda: (generate_daily_report if name == 'daily' else generate_weekly_report)(f)
+
+    elif name == 'concatenate':
+        bucket = LocalBucket(os.path.join(data, 'bucket'))
+
+        def concatenate():
+            with tempfile.TemporaryFile() as f:
+                _concatenate_reports_in_bucket(bucket, f)
+        return concatenate
+
+    elif name == 'email':
+        with open(concatenated) as f:
+            reports = generate_reports(f)
+        cache = BlankChartCache()
+        return lambda: build_report_message(
+            'reports@example.com', 'https://example.com/report', reports['daily'],
+            reports['weekly'], chart_cache=cache).as_string()
+
+    elif name in ('python-engine', 'numpy-engine'):
+        aggregate_lines, rollup_reports = get_engine(name.split('-')[0])
+        bucket = LocalBucket(os.path.join(data, 'bucket'))
+        reports = [
+            list(_iter_report_lines(_iter_key_chunks(key)))
+            for key in _report_keys(bucket)
+        ]
+
+        def aggregate():
+            totals = merge_aggregates(aggregate_lines(iter(lines)) for lines in reports)
+            rollup_reports(totals, ('daily', 'weekly'))
+        return aggregate
+
+    raise Exception('Unknown stage: {}'.format(name))
+
+
+def _peak_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run_stage(connection, name, data, repeat):
+    try:
+        run = _stage(name, data)
+        start_kb = _peak_kb()
+        seconds = []
+        for i in xrange(repeat):
+            start = time.time()
+            run()
+            seconds.append(time.time() - start)
+        connection.send({
+            'seconds': min(seconds),
+            'peak_kb': max(_peak_kb() - start_kb, 0),
+        })
+    except Exception as e:
+        connection.send({'error': '{}: {}'.format(type(e).__name__, e)})
+    finally:
+        connection.close()
+
+
+def measure_stage(name, data, repeat=3):
+    """
+    Time the stage `name` in a new process, so its peak memory is its own.
+
+    Returns a dict with the best wall time of `repeat` runs in 'seconds',
+    and the KB of memory the stage added to the process at its peak in
+    'peak_kb'.
+    """
+    parent, child = Pipe(duplex=False)
+    process = Process(target=_run_stage, args=(child, name, data, repeat))
+    process.start()
+    child.close()
+    result = parent.recv()
+    process.join()
+
+    if 'error' in result:
+        raise Exception('The {} stage failed: {}'.format(name, result['error']))
+    return result
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare `results` with `baseline`.
+
+    Returns a description of every stage that is slower or uses more memory
+    than its baseline by more than `threshold` (a fraction).
+    """
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['seconds'] > max(base['seconds'] * (1 + threshold), base['seconds'] + TIME_SLACK_SECONDS):
+            regressions.append('{} took {:.3f}s, {:.0%} over its baseline of {:.3f}s'.format(
+                name, result['seconds'], result['seconds'] / base['seconds'] - 1, base['seconds']))
+        if result['peak_kb'] > max(base['peak_kb'] * (1 + threshold), base['peak_kb'] + MEMORY_SLACK_KB):
+            regressions.append('{} used {:,}KB, over its baseline of {:,}KB'.format(
+                name, result['peak_kb'], base['peak_kb']))
+    return regressions
+
+
+if __name__ == '__main__':
+    optparser = OptionParser()
+    optparser.add_option("--years", dest="years", type="float", default=2, help="Years of daily reports to generate.")
+    optparser.add_option("--skus", dest="skus", type="int", default=3, help="The number of SKUs.")
+    optparser.add_option("--countries", dest="countries", type="int", default=10, help="The number of countries.")
+    optparser.add_option("--rows", dest="rows", type="int", default=100, help="Rows per daily report.")
+    optparser.add_option("--stages", dest="stages", default=','.join(DEFAULT_STAGES), help="Comma separated stages to run ({}).".format(', '.join(STAGES)))
+    optparser.add_option("--repeat", dest="repeat", type="int", default=3, help="Runs of each stage, the best time is kept.")
+    optparser.add_option("--baseline", dest="baseline", default=DEFAULT_BASELINE, help="The baseline results file.")
+    optparser.add_option("--save-baseline", dest="save_baseline", action="store_true", default=False, help="Save the results as the new baseline.")
+    optparser.add_option("--threshold", dest="threshold", type="float", default=0.2, help="The fraction over the baseline that fails the benchmark.")
+    (options, args) = optparser.parse_args()
+
+    stages = [s for s in options.stages.split(',') if s]
+    for name in stages:
+        if name not in STAGES:
+            optparser.error('Unknown stage: {}'.format(name))
+
+    config = {
+        'years': options.years,
+        'skus': options.skus,
+        'countries': options.countries,
+        'rows': options.rows,
+    }
+
+    with TemporaryDirectory() as data:
+        start = time.time()
+        paths = generate_synthetic_reports(
+            os.path.join(data, 'bucket', S3_PREFIX), years=options.years,
+            skus=options.skus, countries=options.countries, rows=options.rows,
+            end=datetime.date(2014, 12, 31))
+        with open(os.path.join(data, 'concatenated.txt'), 'wb') as f:
+            _concatenate_reports_in_bucket(LocalBucket(os.path.join(data, 'bucket')), f)
+        print('Generated {} reports of {} rows in {:.1f}s.'.format(
+            len(paths), options.rows, time.time() - start))
+
+        results = {}
+        print('Stage\tSeconds\tPeak KB')
+        for name in stages:
+            results[name] = measure_stage(name, data, repeat=options.repeat)
+            print('{}\t{:.3f}\t{:,}'.format(
+                name, results[name]['seconds'], results[name]['peak_kb']))
+
+    if options.save_baseline:
+        with open(options.baseline, 'w') as f:
+            json.dump({'config': config, 'stages': results}, f, indent=2, sort_keys=True)
+        print('Saved the baseline to {}.'.format(options.baseline))
+        sys.exit()
+
+    if not os.path.exists(options.baseline):
+        print('No baseline at {}, run with --save-baseline first.'.format(options.baseline))
+        sys.exit()
+
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    if baseline['config'] != config:
+        print('The baseline was recorded with {}, not comparing.'.format(baseline['config']))
+        sys.exit(1)
+
+    regressions = compare(results, baseline['stages'], options.threshold)
+    if 'python-engine' in results and 'numpy-engine' in results:
+        python, numpy_ = results['python-engine']['seconds'], results['numpy-engine']['seconds']
+        print('The numpy engine took {:.0%} of the python engine\'s time.'.format(numpy_ / python))
+        if numpy_ >= python:
+            regressions.append('the numpy engine is not faster than the python engine')
+    for regression in regressions:
+        print('Regression: {}'.format(regression))
+    if regressions:
+        sys.exit(1)
+    print('No stage regressed by more than {:.0%}.'.format(options.threshold))
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Generate synthetic iTunes Connect Daily Summary reports.
+
+Writes one gzipped `S_D_<vendorid>_<YYYYMMDD>.txt.gz` report per day, in
+the same tab separated format as Autoingestion downloads, with a configurable
+history length, number of SKUs, countries and rows per day. Reports written
+to `DIR/itunes` can be summarized with `reporter/main.py --storage-dir DIR`.
+"""
+from optparse import OptionParser
+import datetime
+import gzip
+import os
+import random
+
+
+HEADER = '\t'.join([
+    'Provider', 'Provider Country', 'SKU', 'Developer', 'Title', 'Version',
+    'Product Type Identifier', 'Units', 'Developer Proceeds', 'Begin Date',
+    'End Date', 'Customer Currency', 'Country Code', 'Currency of Proceeds',
+    'Apple Identifier', 'Customer Price', 'Promo Code', 'Parent Identifier',
+    'Subscription', 'Period',
+])
+
+COUNTRIES = [
+    'US', 'GB', 'CA', 'AU', 'DE', 'FR', 'JP', 'CN', 'BR', 'MX', 'IN', 'IT',
+    'ES', 'NL', 'SE', 'NO', 'DK', 'FI', 'RU', 'KR', 'TW', 'HK', 'SG', 'NZ',
+    'IE', 'CH', 'AT', 'BE', 'PT', 'PL', 'TR', 'ZA',
+]
+
+# Product types and how often they appear: free installs, updates, in-app
+# purchases and universal apps
+PRODUCT_TYPES = [('1T', 45), ('7T', 40), ('IA1', 10), ('1F', 5)]
+
+
+def _weighted(rand, choices):
+    total = sum(weight for choice, weight in choices)
+    point = rand.uniform(0, total)
+    for choice, weight in choices:
+        point -= weight
+        if point <= 0:
+            return choice
+    return choices[-1][0]
+
+
+def report_lines(date, rand, skus=3, countries=10, rows=100):
+    """Return the lines of one synthetic daily report for `date`."""
+    datestr = date.strftime('%m/%d/%Y')
+    lines = [HEADER]
+    for i in xrange(rows):
+        sku = rand.randrange(skus)
+        product_type = _weighted(rand, PRODUCT_TYPES)
+        promo = 'EDU' if product_type == '1T' and rand.random() < 0.2 else ''
+        lines.append('\t'.join([
+            'APPLE', 'US', 'SKU{}'.format(sku), 'Developer', 'App {}'.format(sku),
+            '{}.{}'.format(1 + sku % 3, rand.randrange(6)), product_type,
+            str(int(rand.paretovariate(1.2))), '0', datestr, datestr, 'USD',
+            COUNTRIES[rand.randrange(min(countries, len(COUNTRIES)))], 'USD',
+            str(400000000 + sku), '0', promo, '', '', '',
+        ]))
+    return lines
+
+
+def report_name(vendorid, date):
+    return 'S_D_{}_{:%Y%m%d}.txt.gz'.format(vendorid, date)
+
+
+def generate_reports(dir, years=1, skus=3, countries=10, rows=100,
+                     vendorid='80000000', end=None, seed=0):
+    """
+    Write `years` of synthetic daily reports ending at `end` into `dir`.
+
+    Returns the paths of the reports, oldest first.
+    """
+    rand = random.Random(seed)
+    end = end or datetime.date.today() - datetime.timedelta(days=1)
+    date = end - datetime.timedelta(days=int(365 * years) - 1)
+
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+
+    paths = []
+    while date <= end:
+        path = os.path.join(dir, report_name(vendorid, date))
+        # Keep the reports byte for byte identical between runs
+        with open(path, 'wb') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as gz:
+                gz.write('\n'.join(report_lines(date, rand, skus, countries, rows)) + '\n')
+        paths.append(path)
+        date += datetime.timedelta(days=1)
+
+    return paths
+
+
+if __name__ == '__main__':
+    optparser = OptionParser(usage='%prog [options] DIR')
+    optparser.add_option("--years", dest="years", type="float", default=1, help="Years of daily reports to generate.")
+    optparser.add_option("--skus", dest="skus", type="int", default=3, help="The number of SKUs.")
+    optparser.add_option("--countries", dest="countries", type="int", default=10, help="The number of countries (at most {}).".format(len(COUNTRIES)))
+    optparser.add_option("--rows", dest="rows", type="int", default=100, help="Rows per daily report.")
+    optparser.add_option("--vendorid", dest="vendorid", default='80000000', help="The vendor ID in the report names.")
+    (options, args) = optparser.parse_args()
+
+    if len(args) != 1:
+        optparser.error('Give the directory to write the reports to.')
+
+    paths = generate_reports(
+        args[0], years=options.years, skus=options.skus,
+        countries=options.countries, rows=options.rows, vendorid=options.vendorid)
+    print('Wrote {} reports to {}.'.format(len(paths), args[0]))
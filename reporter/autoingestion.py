@@ -0,0 +1,113 @@
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+
+AUTOINGESTION_URL = os.getenv(
+    'AUTOINGESTION_URL', 'https://reportingitc.apple.com/autoingestion.tft')
+
+NO_REPORTS_MESSAGE = 'There are no reports available'
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# How many times a download is tried again after a connection error or a
+# server error, and the seconds before the first retry, doubling after that
+AUTOINGESTION_RETRIES = 3
+AUTOINGESTION_RETRY_BACKOFF = 1.0
+
+
+class AutoingestionClient(object):
+    """A Python client for the iTunes Connect Autoingestion service.
+
+    Speaks the same HTTP protocol as the Autoingestion Java class, without
+    starting a JVM for each report. Every download goes over one pooled
+    `requests.Session`, so many dates and vendors can be fetched over the
+    same connections, including from several threads at once. Downloads
+    that fail with a connection error or a 5xx response are tried again up
+    to `retries` times.
+    """
+
+    def __init__(self, login, password, url=AUTOINGESTION_URL, pool_size=4,
+                 retries=AUTOINGESTION_RETRIES,
+                 retry_backoff=AUTOINGESTION_RETRY_BACKOFF):
+        self.login = login
+        self.password = password
+        self.url = url
+
+        # Downloading a report changes nothing, so the POST can be retried
+        retry = Retry(
+            total=retries, backoff_factor=retry_backoff,
+            status_forcelist=(500, 502, 503, 504), method_whitelist=False,
+            raise_on_status=False)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def download(self, dir, vendorid, date=None, report_type='Sales',
+                 date_type='Daily', report_subtype='Summary'):
+        """
+        Download a report into `dir`.
+
+        Downloads the report for `date` ('%Y%m%d'), or the latest report if
+        no date is given. The response is streamed to disk in chunks.
+
+        Returns the path of the downloaded report, or None if there was none.
+        """
+        data = {
+            'USERNAME': self.login,
+            'PASSWORD': self.password,
+            'VNDNUMBER': vendorid,
+            'TYPEOFREPORT': report_type,
+            'DATETYPE': date_type,
+            'REPORTTYPE': report_subtype,
+        }
+        if date is not None:
+            data['REPORTDATE'] = date
+
+        response = self.session.post(self.url, data=data, stream=True)
+        try:
+            error = response.headers.get('ERRORMSG')
+            if error:
+                # Finish reading the short response, so its connection goes
+                # back to the pool instead of being closed
+                response.raw.read()
+                if error.startswith(NO_REPORTS_MESSAGE):
+                    return None
+                raise Exception('Autoingestion failed for {}: {}'.format(
+                    date or 'the latest report', error))
+            response.raise_for_status()
+
+            filename = response.headers.get('filename')
+            if not filename:
+                raise Exception('Autoingestion returned no report for {}.'.format(
+                    date or 'the latest report'))
+
+            # Keep the report gzipped, even if it is sent with a gzip
+            # Content-Encoding
+            filepath = os.path.join(dir, os.path.basename(filename))
+            with open(filepath, 'wb') as f:
+                for chunk in response.raw.stream(DOWNLOAD_CHUNK_SIZE, decode_content=False):
+                    f.write(chunk)
+        finally:
+            response.close()
+
+        return filepath
+
+    def download_many(self, dir, reports, **kwargs):
+        """
+        Download several reports over the session's connections.
+
+        `reports` is a list of (vendorid, date) tuples. Returns a list of
+        (vendorid, date, filepath) tuples, in the same order.
+        """
+        return [
+            (vendorid, date, self.download(dir, vendorid, date=date, **kwargs))
+            for vendorid, date in reports
+        ]
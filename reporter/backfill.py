@@ -0,0 +1,192 @@
+import datetime
+import os
+import sys
+import tempfile
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from autoingestion import AutoingestionClient
+from metrics import METRICS
+from reports import (
+    S3_PREFIX, _run_autoingestion, load_compaction_manifest,
+    load_report_manifest, parse_report_name, update_report_manifest)
+from utils import TemporaryDirectory
+
+
+def parse_backfill_date(datestr):
+    """Parse a '%Y%m%d' or '%Y-%m-%d' backfill date."""
+    for fmt in ('%Y%m%d', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(datestr, fmt).date()
+        except ValueError:
+            pass
+    raise Exception('Unable to parse the date {}, use YYYYMMDD.'.format(datestr))
+
+
+def stored_reports(bucket, vendorid):
+    """
+    Map the '%Y%m%d' date of every stored daily report of `vendorid` to its
+    key name and ETag.
+
+    Reads the report manifest, or lists the bucket once if there is none.
+    Daily reports that were compacted are included with the ETag recorded
+    in the compaction manifest.
+    """
+    stored = {}
+    manifest = load_report_manifest(bucket)
+
+    for entry in load_compaction_manifest(bucket)['consolidated'].itervalues():
+        for source in entry['sources']:
+            source_vendorid, datestr = parse_report_name(source['name'])
+            if source_vendorid == vendorid:
+                stored[datestr] = (source['name'], source['etag'])
+
+    if manifest is not None:
+        keys = [(name, entry['etag']) for name, entry in manifest['reports'].iteritems()]
+    else:
+        keys = [(key.name, key.etag) for key in bucket.list(prefix=S3_PREFIX)]
+
+    for name, etag in keys:
+        key_vendorid, datestr = parse_report_name(name)
+        if key_vendorid == vendorid and len(datestr) == 8:
+            stored[datestr] = (name, etag)
+
+    return stored
+
+
+def _download_report_for_date(args):
+    """Download one report in its own directory under `parent`."""
+    parent, login, password, vendorid, date = args
+    dir = tempfile.mkdtemp(prefix=date, dir=parent)
+    return date, _run_autoingestion(dir, login, password, vendorid, date=date)
+
+
+def _client_download_report_for_date(args):
+    """Download one report with a shared `AutoingestionClient`."""
+    parent, client, vendorid, date = args
+    return date, client.download(parent, vendorid, date=date)
+
+
+def _upload_report(args):
+    """Upload a downloaded report unless the stored copy is identical."""
+    bucket, filepath, etag, dry_run = args
+
+    key = bucket.new_key('{}/{}'.format(S3_PREFIX, os.path.basename(filepath)))
+
+    with open(filepath, 'rb') as f:
+        md5 = key.compute_md5(f)
+        if etag is not None and etag.strip('"') == md5[0]:
+            return key, False
+        if not dry_run:
+            with METRICS.timer('upload', requests=1, objects=1, bytes=os.path.getsize(filepath)):
+                key.set_contents_from_file(f, md5=md5, replace=True)
+
+    return key, True
+
+
+def _collect_uploads(uploads, uploaded, verbose=False):
+    """
+    Wait for every `_upload_report` result, adding the uploaded keys to
+    `uploaded`. Returns the exc_info of the first failed upload, or None.
+    """
+    error = None
+    for result in uploads:
+        try:
+            key, changed = result.get()
+        except Exception:
+            if error is None:
+                error = sys.exc_info()
+            continue
+        if changed:
+            uploaded.append(key)
+        if verbose:
+            sys.stdout.write('.' if changed else '=')
+            sys.stdout.flush()
+    return error
+
+
+def backfill_reports(bucket, login, password, vendorid, start, end,
+                     refetch=False, processes=4, upload_concurrency=4,
+                     dry_run=False, verbose=False, downloader='java'):
+    """
+    Download and store the Daily Summary reports from `start` to `end`.
+
+    Only the dates without a stored report are downloaded, unless `refetch`
+    is set, in which case every date is downloaded and reports whose
+    contents match the stored copy are not uploaded again. The Autoingestion
+    downloads run in a pool of `processes` processes, each in its own
+    directory, and the uploads in a pool of `upload_concurrency` threads.
+    With the 'python' `downloader`, the downloads instead run in `processes`
+    threads sharing one `AutoingestionClient`.
+
+    Returns the key names that were uploaded.
+    """
+    stored = stored_reports(bucket, vendorid)
+
+    dates = []
+    date = start
+    while date <= end:
+        datestr = date.strftime('%Y%m%d')
+        if refetch or datestr not in stored:
+            dates.append(datestr)
+        date += datetime.timedelta(days=1)
+
+    if verbose:
+        print('Backfilling {} daily reports between {:%Y-%m-%d} and {:%Y-%m-%d}...'.format(
+            len(dates), start, end))
+    if not dates:
+        return []
+
+    uploaded = []
+
+    client = None
+
+    with TemporaryDirectory() as parent:
+        if downloader == 'python':
+            client = AutoingestionClient(login, password, pool_size=processes)
+            download_pool = ThreadPool(processes)
+            downloads = download_pool.imap_unordered(
+                _client_download_report_for_date,
+                [(parent, client, vendorid, d) for d in dates])
+        else:
+            download_pool = Pool(processes)
+            downloads = download_pool.imap_unordered(
+                _download_report_for_date,
+                [(parent, login, password, vendorid, d) for d in dates])
+
+        upload_pool = ThreadPool(upload_concurrency)
+        try:
+            uploads = []
+            try:
+                # The downloads run elsewhere, so this times waiting for them
+                for datestr, filepath in METRICS.timed('download', downloads):
+                    METRICS.add('download', requests=1)
+                    if filepath is None:
+                        if verbose:
+                            print('No report is available for {}.'.format(datestr))
+                        continue
+                    METRICS.add('download', objects=1, bytes=os.path.getsize(filepath))
+                    etag = stored.get(datestr, (None, None))[1]
+                    uploads.append(upload_pool.apply_async(
+                        _upload_report, ((bucket, filepath, etag, dry_run), )))
+            finally:
+                # Wait for the uploads already started, even if a
+                # download failed, so they are recorded below
+                error = _collect_uploads(uploads, uploaded, verbose)
+            if error is not None:
+                raise error[0], error[1], error[2]
+        finally:
+            download_pool.terminate()
+            upload_pool.terminate()
+            download_pool.join()
+            upload_pool.join()
+            if client is not None:
+                client.close()
+            # Reports uploaded before a failure are summarized all the same
+            if uploaded and not dry_run:
+                update_report_manifest(bucket, added=uploaded)
+
+    if verbose:
+        print(' done, uploaded {} daily reports.'.format(len(uploaded)))
+
+    return sorted(key.name for key in uploaded)
@@ -0,0 +1,115 @@
+import contextlib
+import gzip
+import json
+import os
+import StringIO
+
+
+AGGREGATE_CACHE_KEY = 'cache/aggregates.json.gz'
+
+CACHE_VERSION = 1
+
+
+def _utf8(value):
+    # JSON gives back unicode, but parsed reports hold UTF-8 strs. Mixing
+    # them would split the groups of non-ASCII values in two.
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+class AggregateCache(object):
+    """Per-report partial aggregates keyed by S3 key name and ETag.
+
+    Each entry holds the `aggregate_report` result for one report file, so a
+    summary run only has to download the reports that are new or have
+    changed since the cache was last saved. Entries written by
+    `set_groups` also hold the `group_report` result of the breakdowns.
+    """
+
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+        self.dirty = False
+
+    def get(self, name, etag):
+        entry = self.entries.get(name)
+        if entry is None or entry['etag'] != etag:
+            return None
+        return entry['totals']
+
+    def set(self, name, etag, totals):
+        self.entries[name] = {'etag': etag, 'totals': totals}
+        self.dirty = True
+
+    def get_groups(self, name, etag, groupings):
+        """Return the cached `group_report` result, if it has `groupings`."""
+        entry = self.entries.get(name)
+        if entry is None or entry['etag'] != etag:
+            return None
+
+        cached = entry.get('groups', {})
+        groups = {}
+        for grouping in groupings:
+            rows = cached.get(','.join(grouping))
+            if rows is None:
+                return None
+            groups[tuple(grouping)] = dict(
+                (tuple(_utf8(value) for value in key), counts) for key, counts in rows)
+        return groups
+
+    def set_groups(self, name, etag, groups):
+        self.entries[name] = {
+            'etag': etag,
+            'totals': dict((key[0], counts) for key, counts in groups[()].iteritems()),
+            'groups': dict(
+                (','.join(grouping), [[list(key), counts] for key, counts in totals.iteritems()])
+                for grouping, totals in groups.iteritems()
+            ),
+        }
+        self.dirty = True
+
+    def prune(self, names):
+        """Drop the entries for keys that are not in `names`."""
+        for name in set(self.entries) - set(names):
+            del self.entries[name]
+            self.dirty = True
+
+    def dumps(self):
+        with contextlib.closing(StringIO.StringIO()) as s:
+            with gzip.GzipFile(fileobj=s, mode='wb') as gz:
+                json.dump({'version': CACHE_VERSION, 'entries': self.entries}, gz)
+            return s.getvalue()
+
+    @classmethod
+    def loads(cls, data):
+        with contextlib.closing(StringIO.StringIO(data)) as s, gzip.GzipFile(fileobj=s) as gz:
+            contents = json.load(gz)
+        if contents.get('version') != CACHE_VERSION:
+            return cls()
+        return cls(contents['entries'])
+
+    @classmethod
+    def load_from_bucket(cls, bucket, name=AGGREGATE_CACHE_KEY):
+        key = bucket.get_key(name)
+        if key is None:
+            return cls()
+        return cls.loads(key.get_contents_as_string())
+
+    def save_to_bucket(self, bucket, name=AGGREGATE_CACHE_KEY):
+        key = bucket.new_key(name)
+        key.set_contents_from_string(self.dumps(), replace=True)
+        self.dirty = False
+
+    @classmethod
+    def load_from_file(cls, path):
+        if not os.path.exists(path):
+            return cls()
+        with open(path, 'rb') as f:
+            return cls.loads(f.read())
+
+    def save_to_file(self, path):
+        # Write to a temporary file first so a failed run never leaves a
+        # truncated cache behind.
+        tmppath = '{}.tmp'.format(path)
+        with open(tmppath, 'wb') as f:
+            f.write(self.dumps())
+        os.rename(tmppath, path)
+        self.dirty = False
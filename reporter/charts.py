@@ -0,0 +1,265 @@
+import contextlib
+import hashlib
+import json
+import os
+import StringIO
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+
+from pygooglechart import SimpleLineChart, Axis
+import requests
+
+from metrics import METRICS
+
+
+CHART_WIDTH, CHART_HEIGHT = 700, 300
+
+# The styling shared by every chart
+CHART_MARKER = ('B', 'C5D4B5BB', '0', '0', '0')
+CHART_COLOURS = ['3D7930', 'FF9900']
+CHART_GRID = (0, 10)
+CHART_GRID_SEGMENTS = dict(line_segment=2, blank_segment=6)
+
+CHART_BACKENDS = ('google', 'local')
+
+# Longer series are downsampled to this many points before charting
+CHART_MAX_POINTS = 200
+
+# Bump to invalidate every cached chart when the rendering changes
+CHART_CACHE_VERSION = 1
+
+
+def downsample(data, threshold):
+    """
+    Downsample `data` to `threshold` points with Largest-Triangle-Three-Buckets.
+
+    The first and last points are always kept. The points in between are
+    split into evenly sized buckets, and from each bucket the point forming
+    the largest triangle with the previously kept point and the average of
+    the next bucket is kept, which preserves the visual shape of the series.
+    The bucket holding the largest value keeps that value, so the peak of
+    the series is never lost.
+    """
+    length = len(data)
+    if threshold >= length or threshold < 3:
+        return list(data)
+
+    peak = max(xrange(length), key=data.__getitem__)
+    every = float(length - 2) / (threshold - 2)
+
+    sampled = [data[0]]
+    a = 0
+    for i in xrange(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+
+        if start <= peak < end:
+            a = peak
+        else:
+            next_start = end
+            next_end = min(int((i + 2) * every) + 1, length)
+            avg_x = (next_start + next_end - 1) / 2.0
+            avg_y = sum(data[next_start:next_end]) / float(next_end - next_start)
+
+            ax, ay = a, data[a]
+            a = max(
+                xrange(start, end),
+                key=lambda b: abs((ax - avg_x) * (data[b] - ay) - (ax - b) * (avg_y - ay)),
+            )
+
+        sampled.append(data[a])
+
+    sampled.append(data[-1])
+    return sampled
+
+
+def chart_spec(name, title, series, width=CHART_WIDTH, height=CHART_HEIGHT,
+               max_points=CHART_MAX_POINTS):
+    """
+    Describe a line chart of one or more `series`.
+
+    The first series is filled, any others are drawn as lines over it. The
+    left axis runs from zero to the largest value, and the right axis labels
+    the smallest and largest values. Series longer than `max_points` are
+    downsampled, so the size of the chart stays the same however long the
+    history grows.
+    """
+    return {
+        'name': name,
+        'title': title,
+        'series': [downsample(list(s), max_points) if max_points else list(s) for s in series],
+        'width': width,
+        'height': height,
+    }
+
+
+def _series_range(spec):
+    values = [v for s in spec['series'] for v in s]
+    return min(values), max(values)
+
+
+def google_chart_url(spec):
+    """Return the Google Chart URL for `spec`."""
+    chart = SimpleLineChart(spec['width'], spec['height'])
+    chart.set_title(spec['title'])
+
+    for series in spec['series']:
+        chart.add_data(series)
+
+    low, high = _series_range(spec)
+    chart.set_axis_range(Axis.LEFT, 0, high)
+    chart.set_axis_labels(Axis.RIGHT, [low, high])
+
+    chart.markers.append(CHART_MARKER)
+    chart.set_colours(CHART_COLOURS)
+    chart.set_grid(*CHART_GRID, **CHART_GRID_SEGMENTS)
+
+    return chart.get_url()
+
+
+def _render_google_chart(spec):
+    return requests.get(google_chart_url(spec)).content
+
+
+def _hex_colour(colour):
+    """Convert a Google Chart 'RRGGBB[AA]' colour to a matplotlib RGBA tuple."""
+    channels = [int(colour[i:i + 2], 16) / 255.0 for i in range(0, len(colour), 2)]
+    return tuple(channels + [1.0] * (4 - len(channels)))
+
+
+def _render_local_chart(spec):
+    # matplotlib is optional, and only needed to render charts locally
+    try:
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+        from matplotlib.ticker import MultipleLocator
+    except ImportError:
+        raise Exception('Rendering charts locally requires matplotlib to be installed.')
+
+    dpi = 100.0
+    figure = Figure(figsize=(spec['width'] / dpi, spec['height'] / dpi), dpi=dpi)
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot(1, 1, 1)
+
+    low, high = _series_range(spec)
+    longest = max(len(s) for s in spec['series'])
+
+    for i, series in enumerate(spec['series']):
+        colour = _hex_colour(CHART_COLOURS[i % len(CHART_COLOURS)])
+        xs = range(len(series))
+        axes.plot(xs, series, color=colour, linewidth=1)
+        if i == 0:
+            axes.fill_between(xs, series, 0, color=_hex_colour(CHART_MARKER[1]))
+
+    axes.set_title(spec['title'], fontsize=11)
+    axes.set_xlim(0, max(longest - 1, 1))
+    axes.set_ylim(0, high or 1)
+    axes.set_xticks([])
+    axes.yaxis.set_major_locator(MultipleLocator(max(high, 1) / 10.0))
+    axes.yaxis.set_ticklabels([])
+    axes.grid(True, axis='y', linestyle=(0, (2, 6)), color='#aaaaaa')
+
+    right = axes.twinx()
+    right.set_ylim(0, high or 1)
+    right.set_yticks([low, high])
+    right.set_yticklabels(['{:,}'.format(low), '{:,}'.format(high)], fontsize=9)
+
+    with contextlib.closing(StringIO.StringIO()) as f:
+        figure.savefig(f, format='png', dpi=dpi)
+        return f.getvalue()
+
+
+class ChartCache(object):
+    """PNG charts stored on disk under a hash of their spec and backend.
+
+    A chart whose series and styling have not changed since it was last
+    rendered is read back from disk instead of being rendered again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    @staticmethod
+    def digest(spec, backend):
+        contents = json.dumps({
+            'version': CHART_CACHE_VERSION,
+            'backend': backend,
+            'spec': spec,
+            'style': [CHART_MARKER, CHART_COLOURS, CHART_GRID, CHART_GRID_SEGMENTS],
+        }, sort_keys=True)
+        return hashlib.sha1(contents).hexdigest()
+
+    def _filename(self, spec, backend):
+        return os.path.join(self.path, '{}.png'.format(self.digest(spec, backend)))
+
+    def get(self, spec, backend):
+        filename = self._filename(spec, backend)
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def set(self, spec, backend, png):
+        filename = self._filename(spec, backend)
+        tmpfilename = '{}.tmp'.format(filename)
+        with open(tmpfilename, 'wb') as f:
+            f.write(png)
+        os.rename(tmpfilename, filename)
+
+
+def render_charts(specs, backend='google', cache=None, verbose=False):
+    """
+    Render the charts in `specs` to PNG images.
+
+    Charts in the `cache` are reused, the rest are rendered in parallel:
+    fetched from the Google Chart API by a pool of threads, or drawn with
+    matplotlib by a pool of processes for the 'local' backend.
+
+    Returns a dict mapping each chart name to its PNG data.
+    """
+    if backend not in CHART_BACKENDS:
+        raise Exception('Unknown chart backend: {}'.format(backend))
+
+    images = {}
+    missing = []
+    for spec in specs:
+        png = cache.get(spec, backend) if cache is not None else None
+        if png is None:
+            missing.append(spec)
+        else:
+            images[spec['name']] = png
+
+    if verbose:
+        if backend == 'google':
+            for spec in specs:
+                print('{}: {}'.format(spec['title'], google_chart_url(spec)))
+        print('Rendering {} of {} charts...'.format(len(missing), len(specs)))
+
+    METRICS.add('chart', cached=len(specs) - len(missing))
+
+    if missing:
+        if backend == 'google':
+            pool = ThreadPool(len(missing))
+            render = _render_google_chart
+        else:
+            pool = Pool(min(len(missing), cpu_count()))
+            render = _render_local_chart
+        try:
+            with METRICS.timer('chart', objects=len(missing)):
+                rendered = pool.map(render, missing)
+        finally:
+            pool.terminate()
+            pool.join()
+        METRICS.add(
+            'chart',
+            bytes=sum(len(png) for png in rendered),
+            requests=len(missing) if backend == 'google' else 0)
+
+        for spec, png in zip(missing, rendered):
+            images[spec['name']] = png
+            if cache is not None:
+                cache.set(spec, backend, png)
+
+    return images
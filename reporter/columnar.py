@@ -0,0 +1,237 @@
+import array
+import csv
+import datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from metrics import METRICS
+from reports import (
+    COLUMN_DATE, COLUMN_DOWNLOAD_TYPE, COLUMN_DOWNLOADS, COLUMN_PROMO,
+    DOWNLOAD_TYPE_INSTALL, DOWNLOAD_TYPE_UPGRADE, PROMO_TYPE_EDU,
+    GRANULARITIES, datestr_to_datetime, datetime_to_str, exclude_headers)
+from series import TYPECODE, Series
+
+
+def _require_numpy():
+    if numpy is None:
+        raise Exception('The numpy engine requires numpy to be installed.')
+
+
+def _group_sums(index, size, values):
+    # bincount sums in float64, which is exact for integers below 2 ** 53
+    return numpy.bincount(index, weights=values, minlength=size).astype(numpy.int64)
+
+
+# The bytes that end a report's fields and rows
+_TAB = ord('\t')
+_NEWLINE = ord('\n')
+
+
+def _count_lines_starting(text, prefix):
+    return text.count('\n' + prefix) + text.startswith(prefix)
+
+
+class _Fields(object):
+    """
+    The fields of the rows of a report, found without splitting its text.
+
+    The tabs and newlines are found with a vectorized search, and `column`
+    copies only the bytes of one column, so no string is made for any other
+    field.
+    """
+
+    def __init__(self, buf, ends):
+        self.buf = buf
+        self.ends = ends
+
+    @classmethod
+    def split(cls, text):
+        """Return the fields of `text`, or None if its rows need csv."""
+        if '"' in text or '\r' in text:
+            return None
+        rows = text.count('\n')
+        buf = numpy.frombuffer(text, dtype=numpy.uint8)
+        ends = numpy.flatnonzero((buf == _TAB) | (buf == _NEWLINE))
+        width = len(ends) // rows
+        if width * rows != len(ends) or not (buf[ends[width - 1::width]] == _NEWLINE).all():
+            return None
+        return cls(buf, ends.reshape(rows, width))
+
+    def column(self, index, rows=None, size=None):
+        """
+        Return the column `index` of `rows` (every row by default) as byte
+        strings, cut to `size` bytes when given.
+        """
+        ends = self.ends[:, index]
+        if index:
+            starts = self.ends[:, index - 1] + 1
+        else:
+            starts = numpy.concatenate(([0], self.ends[:-1, -1] + 1))
+        if rows is not None:
+            starts, ends = starts[rows], ends[rows]
+        lengths = ends - starts
+        if size is None:
+            size = max(lengths.max(), 1) if len(lengths) else 1
+        positions = numpy.arange(size)
+        # Shorter fields are read past their ends, then masked
+        field = self.buf[numpy.minimum(starts[:, None] + positions, len(self.buf) - 1)]
+        field *= positions < lengths[:, None]
+        return field.view('S{}'.format(size)).ravel()
+
+
+class _CsvFields(object):
+    """The fields of the rows of a report that needs csv's quoting rules."""
+
+    def __init__(self, text):
+        self.rows = list(csv.reader(text.splitlines(True), delimiter='\t'))
+
+    def column(self, index, rows=None, size=None):
+        column = numpy.array([row[index] for row in self.rows], dtype=str)
+        return column if rows is None else column[rows]
+
+
+def _split_report(lines):
+    """
+    Return the fields of the rows of a report, or None if it has none.
+
+    Header rows have the same fields as the others, and their download type
+    is never counted, so they are only dropped, along with the lines that
+    `exclude_headers` rejects, when the report has any such lines. Otherwise
+    the rows are counted in the metrics the same way, without reading the
+    lines one at a time.
+    """
+    text = ''.join(lines)
+    if text and not text.endswith('\n'):
+        text += '\n'
+
+    rows = _count_lines_starting(text, 'APPLE')
+    if text and rows + _count_lines_starting(text, 'Provider') == text.count('\n'):
+        fields = _Fields.split(text)
+        if fields is not None:
+            METRICS.add('parse', rows=rows, rejected=0)
+            return fields
+
+    text = ''.join(exclude_headers(text.splitlines(True)))
+    if not text:
+        return None
+    if not text.endswith('\n'):
+        text += '\n'
+    return _Fields.split(text) or _CsvFields(text)
+
+
+def _parse_ints(strings):
+    """
+    Parse an array of byte strings of (optionally negative) integers.
+
+    The strings are joined and read by one `numpy.fromstring`. Anything it
+    can't read exactly is left to NumPy's conversion, which raises like `int`.
+    """
+    # Longer strings could overflow int64, which NumPy reports
+    if strings.itemsize > 18:
+        return strings.astype(numpy.int64)
+    joined = ','.join(strings.tolist())
+    # Only digits, each optionally after one leading minus sign
+    signs = joined.count('-')
+    if (joined.translate(None, '-0123456789,') or
+            joined.count(',') != len(strings) - 1 or
+            signs != joined.count(',-') + joined.startswith('-') or
+            signs and ('-,' in joined or joined.endswith('-'))):
+        return strings.astype(numpy.int64)
+    values = numpy.fromstring(joined, dtype=numpy.int64, sep=',')
+    if len(values) != len(strings):
+        return strings.astype(numpy.int64)
+    return values
+
+
+def aggregate_report(lines):
+    """
+    Sums the installs, updates and educational installs in a report by date.
+
+    The same as `reports.aggregate_report`, but the report is split into
+    fields with vectorized searches, only the date, download type, units and
+    promo code columns are read, into NumPy arrays, and the sums are
+    vectorized group-bys over day ordinals.
+    """
+    _require_numpy()
+
+    fields = _split_report(lines)
+    if fields is None:
+        return {}
+
+    # One byte past the download types is enough to tell them apart
+    types = fields.column(COLUMN_DOWNLOAD_TYPE, size=len(DOWNLOAD_TYPE_INSTALL) + 1)
+    install = types == DOWNLOAD_TYPE_INSTALL
+    counted = numpy.flatnonzero(install | (types == DOWNLOAD_TYPE_UPGRADE))
+    if not len(counted):
+        return {}
+
+    install = install[counted]
+    dates = fields.column(COLUMN_DATE, counted)
+    downloads = _parse_ints(fields.column(COLUMN_DOWNLOADS, counted))
+    promos = fields.column(COLUMN_PROMO, counted, size=len(PROMO_TYPE_EDU) + 1)
+    edu = install & (promos == PROMO_TYPE_EDU)
+
+    # Encode the dates as day ordinals, parsing each distinct string once
+    datestrs, datestr_index = numpy.unique(dates, return_inverse=True)
+    ordinals = numpy.array([datestr_to_datetime(d).toordinal() for d in datestrs])
+    # Strings written differently can still be the same day
+    days, day_index = numpy.unique(ordinals, return_inverse=True)
+    day_index = day_index[datestr_index]
+
+    installs = _group_sums(day_index, len(days), numpy.where(install, downloads, 0))
+    updates = _group_sums(day_index, len(days), numpy.where(install, 0, downloads))
+    educational = _group_sums(day_index, len(days), numpy.where(edu, downloads, 0))
+
+    return dict(
+        (datetime_to_str(datetime.date.fromordinal(day)), [i, u, e])
+        for day, i, u, e in zip(days.tolist(), installs.tolist(), updates.tolist(), educational.tolist())
+    )
+
+
+def rollup_reports(totals, granularities=('daily', 'weekly')):
+    """
+    Generate reports at several granularities from merged aggregates.
+
+    The same as `reports.rollup_reports`, but the running install totals are
+    a single cumsum and each granularity is a vectorized group-by.
+    """
+    _require_numpy()
+
+    for granularity in granularities:
+        if granularity not in GRANULARITIES:
+            raise Exception('Unknown report granularity: {}'.format(granularity))
+
+    dates = sorted(totals)
+    if not dates:
+        return dict((g, Series()) for g in granularities)
+
+    counts = numpy.array([totals[d] for d in dates], dtype=numpy.int64).reshape(-1, 3)
+    cumulative = numpy.cumsum(counts[:, 0])
+
+    reports = {}
+    for granularity in granularities:
+        period_for_date = GRANULARITIES[granularity]
+
+        if period_for_date is None:
+            periods = dates
+            sums = counts
+            cum = cumulative
+        else:
+            periods, index = numpy.unique([period_for_date(d) for d in dates], return_inverse=True)
+            periods = periods.tolist()
+            sums = numpy.column_stack([_group_sums(index, len(periods), counts[:, i]) for i in range(3)])
+
+            # A period's cumulative total is the one at its last date
+            last = numpy.zeros(len(periods), dtype=numpy.int64)
+            numpy.maximum.at(last, index, numpy.arange(len(dates)))
+            cum = cumulative[last]
+
+        reports[granularity] = Series(list(periods), tuple(
+            array.array(TYPECODE, column)
+            for column in sums.T.tolist() + [cum.tolist()]
+        ))
+
+    return reports
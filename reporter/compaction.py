@@ -0,0 +1,159 @@
+import collections
+import datetime
+import gzip
+import json
+import sys
+import tempfile
+
+from reports import (
+    ARCHIVE_PREFIX, COMPACTION_MANIFEST_KEY, CONSOLIDATED_PREFIX, S3_PREFIX,
+    _iter_key_chunks, _iter_report_lines, load_compaction_manifest,
+    parse_report_name, update_report_manifest)
+
+
+def consolidated_name(vendorid, month):
+    """Return the key name of the consolidated report for `month` ('%Y%m')."""
+    return '{}/S_D_{}_{}.txt.gz'.format(CONSOLIDATED_PREFIX, vendorid, month)
+
+
+def archive_name(name):
+    """Return the key name a compacted daily report is archived under."""
+    return '{}/{}'.format(ARCHIVE_PREFIX, name)
+
+
+def _save_manifest(bucket, manifest):
+    key = bucket.new_key(COMPACTION_MANIFEST_KEY)
+    key.set_contents_from_string(
+        json.dumps(manifest, indent=2, sort_keys=True), replace=True)
+
+
+def _closed_month_dailies(bucket, today=None):
+    """
+    Group the loose daily reports in `bucket` by consolidated key name.
+
+    Only months before the current one are included.
+    """
+    current_month = (today or datetime.date.today()).strftime('%Y%m')
+
+    months = collections.defaultdict(list)
+    for key in bucket.list(prefix=S3_PREFIX):
+        vendorid, datestr = parse_report_name(key.name)
+        if datestr is None or len(datestr) != 8:
+            continue
+        month = datestr[:6]
+        if month < current_month:
+            months[consolidated_name(vendorid, month)].append(key)
+
+    return months
+
+
+def _write_consolidated(bucket, name, keys):
+    """Merge the reports at `keys` into a single gzipped report at `name`."""
+    with tempfile.TemporaryFile() as f:
+        with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+            for key in keys:
+                line = ''
+                for line in _iter_report_lines(_iter_key_chunks(key)):
+                    gz.write(line)
+                # Keep the next report from starting mid-line
+                if line and not line.endswith('\n'):
+                    gz.write('\n')
+
+        f.seek(0)
+        key = bucket.new_key(name)
+        key.set_contents_from_file(f, replace=True)
+
+    return key
+
+
+def compact_reports(bucket, dry_run=False, verbose=False, today=None):
+    """
+    Merge the daily reports of closed months into consolidated monthly reports.
+
+    Each month's daily reports are merged into one gzipped report under
+    CONSOLIDATED_PREFIX, and the originals are moved under ARCHIVE_PREFIX.
+    The compaction manifest records which daily reports every consolidated
+    report holds. Daily reports that arrive for a month that was already
+    compacted are merged into its consolidated report on the next run, which
+    is rebuilt from the archived originals.
+
+    The manifest is only updated once the consolidated report is written
+    and the originals are archived, and loose daily reports stay in place
+    until after that, so an interrupted compaction can simply be run again.
+    """
+    manifest = load_compaction_manifest(bucket)
+    consolidated = manifest['consolidated']
+
+    for name, keys in sorted(_closed_month_dailies(bucket, today=today).items()):
+        keys = sorted(keys, key=lambda k: k.name)
+
+        if verbose:
+            print('Compacting {} daily reports into {}...'.format(len(keys), name))
+        if dry_run:
+            continue
+
+        # A daily report that was downloaded again replaces its earlier copy
+        names = set(key.name for key in keys)
+        entry = consolidated.get(name, {'sources': []})
+        entry['sources'] = [s for s in entry['sources'] if s['name'] not in names]
+
+        # Rebuild from the archived copies of reports that were already
+        # consolidated, so rewriting a month never duplicates its days
+        archived = [bucket.get_key(source['archive']) for source in entry['sources']]
+        consolidated_key = _write_consolidated(bucket, name, archived + keys)
+
+        for key in keys:
+            if verbose:
+                sys.stdout.write('.')
+                sys.stdout.flush()
+            bucket.copy_key(archive_name(key.name), bucket.name, key.name)
+            entry['sources'].append({
+                'name': key.name,
+                'archive': archive_name(key.name),
+                'etag': key.etag,
+            })
+
+        consolidated[name] = entry
+        _save_manifest(bucket, manifest)
+        update_report_manifest(bucket, added=[consolidated_key], removed=names)
+
+        for key in keys:
+            bucket.delete_key(key.name)
+
+        if verbose:
+            print(' done.')
+
+
+def uncompact_reports(bucket, month, dry_run=False, verbose=False):
+    """
+    Restore the archived daily reports of a compacted `month` ('%Y%m').
+
+    Reverses `compact_reports` for that month: the daily reports are copied
+    back from the archive and the consolidated reports are removed.
+    """
+    manifest = load_compaction_manifest(bucket)
+    consolidated = manifest['consolidated']
+
+    for name in sorted(consolidated):
+        if parse_report_name(name)[1] != month:
+            continue
+
+        sources = consolidated[name]['sources']
+        if verbose:
+            print('Restoring {} daily reports from {}...'.format(len(sources), name))
+        if dry_run:
+            continue
+
+        for source in sources:
+            bucket.copy_key(source['name'], bucket.name, source['archive'])
+
+        del consolidated[name]
+        _save_manifest(bucket, manifest)
+        update_report_manifest(
+            bucket,
+            added=[bucket.get_key(source['name']) for source in sources],
+            removed=[name])
+
+        bucket.delete_key(name)
+        for source in sources:
+            bucket.delete_key(source['archive'])
@@ -0,0 +1,137 @@
+import smtplib
+import socket
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from metrics import METRICS
+
+
+# How many times a message is sent again after its connection failed
+SMTP_RETRIES = 3
+
+# Seconds before the first retry, doubling after each one
+SMTP_RETRY_DELAY = 1.0
+
+# Errors after which a connection is dropped and the message sent again.
+# ssl.SSLError is a socket.error.
+SMTP_CONNECTION_ERRORS = (
+    socket.error, smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)
+
+
+def parse_recipients(emails):
+    """Split a comma separated string of addresses into a list."""
+    if isinstance(emails, basestring):
+        emails = emails.split(',')
+    return [email.strip() for email in emails if email.strip()]
+
+
+class SMTPPool(object):
+    """Authenticated SMTP connections reused for every message of a run.
+
+    At most `size` connections are opened, each on first use, and every
+    connection sends one message at a time. When a connection fails, it is
+    dropped and the message is sent again over a new one, up to `retries`
+    times with a growing delay. Other errors, such as a refused recipient,
+    are not retried. Without `starttls` and a `login`, messages can be
+    sent to a local debugging server (`python -m smtpd -n -c DebuggingServer`).
+    """
+
+    def __init__(self, host, port, login=None, password=None, size=1,
+                 retries=SMTP_RETRIES, retry_delay=SMTP_RETRY_DELAY,
+                 starttls=True):
+        self.host = host
+        self.port = port
+        self.login = login
+        self.password = password
+        self.size = size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.starttls = starttls
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = []
+
+    def _connect(self):
+        with METRICS.timer('smtp', requests=1):
+            smtp = smtplib.SMTP(self.host, self.port)
+            try:
+                if self.starttls:
+                    smtp.starttls()
+                if self.login:
+                    smtp.login(self.login, self.password)
+            except:
+                smtp.close()
+                raise
+        return smtp
+
+    def sendmail(self, from_addr, to_addrs, message):
+        with self.slots:
+            with self.lock:
+                smtp = self.idle.pop() if self.idle else None
+
+            try:
+                for attempt in xrange(self.retries + 1):
+                    try:
+                        if smtp is None:
+                            smtp = self._connect()
+                        with METRICS.timer('smtp', requests=1, objects=1, bytes=len(message)):
+                            result = smtp.sendmail(from_addr, to_addrs, message)
+                        break
+                    except SMTP_CONNECTION_ERRORS:
+                        if smtp is not None:
+                            smtp.close()
+                            smtp = None
+                        if attempt == self.retries:
+                            raise
+                        METRICS.add('smtp', retries=1)
+                        time.sleep(self.retry_delay * 2 ** attempt)
+            except:
+                if smtp is not None:
+                    smtp.close()
+                raise
+
+            with self.lock:
+                self.idle.append(smtp)
+            return result
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for smtp in idle:
+            try:
+                smtp.quit()
+            except (socket.error, smtplib.SMTPException):
+                smtp.close()
+
+
+def deliver(messages, smtp, verbose=False):
+    """
+    Send every (from address, to addresses, message) in `messages`.
+
+    The messages are sent concurrently over the connections of the
+    `SMTPPool`. A message that cannot be sent does not stop the others.
+    Raises an Exception listing the failed messages once all were tried.
+    """
+    def send(message):
+        from_addr, to_addrs, body = message
+        try:
+            smtp.sendmail(from_addr, to_addrs, body)
+        except Exception as e:
+            return '{}: {}: {}'.format(', '.join(to_addrs), type(e).__name__, e)
+
+    messages = list(messages)
+    pool = ThreadPool(min(smtp.size, len(messages)) or 1)
+    try:
+        errors = [error for error in pool.map(send, messages) if error]
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if verbose:
+        print('Sent {} of {} emails.'.format(len(messages) - len(errors), len(messages)))
+    if errors:
+        for error in errors:
+            sys.stderr.write('Unable to send to {}\n'.format(error))
+        raise Exception('Unable to send {} of {} emails.'.format(len(errors), len(messages)))
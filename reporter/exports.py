@@ -0,0 +1,201 @@
+import cStringIO
+import csv
+import hashlib
+import json
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from metrics import METRICS
+from reports import _timestamp_str, rollup_groups
+from series import SERIES_COLUMNS
+
+
+EXPORT_PREFIX = 'reports'
+
+# Bumped when the layout or the columns of the exports change, so
+# consumers of the previous version keep working until they move over
+EXPORT_VERSION = 1
+
+EXPORT_FORMATS = ('csv', 'json', 'parquet')
+
+# The small object pointing consumers at the latest numbers and exports
+EXPORT_LATEST_KEY = '{}/latest.json'.format(EXPORT_PREFIX)
+
+# The partition each period of a granularity is stored in. Only the
+# partitions with new or restated periods are uploaded again, so a new day
+# rewrites one month of the daily series, not the whole history.
+PARTITIONS = {
+    'daily': lambda period: period[:7],
+    'weekly': lambda period: period[:4],
+    'monthly': lambda period: period[:4],
+    'yearly': lambda period: 'all',
+}
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'json': 'application/json',
+    'parquet': 'application/octet-stream',
+}
+
+
+def parse_export_formats(formats):
+    """Split a comma separated string of export formats into a list."""
+    if isinstance(formats, basestring):
+        formats = formats.split(',')
+    formats = [f.strip().lower() for f in formats if f.strip()]
+    for f in formats:
+        if f not in EXPORT_FORMATS:
+            raise Exception('Unknown export format: {}'.format(f))
+    if 'parquet' in formats and pyarrow is None:
+        raise Exception('Parquet exports require pyarrow to be installed.')
+    return formats
+
+
+def _version_prefix():
+    return '{}/v{}'.format(EXPORT_PREFIX, EXPORT_VERSION)
+
+
+def _manifest_name():
+    return '{}/manifest.json'.format(_version_prefix())
+
+
+def _render(columns, rows, format):
+    if format == 'csv':
+        output = cStringIO.StringIO()
+        writer = csv.writer(output, lineterminator='\n')
+        writer.writerow(columns)
+        writer.writerows(rows)
+        return output.getvalue()
+    if format == 'json':
+        return json.dumps({'columns': columns, 'rows': rows}, separators=(',', ':'))
+    if format == 'parquet':
+        table = pyarrow.Table.from_arrays(
+            [pyarrow.array([row[i] for row in rows]) for i in xrange(len(columns))],
+            names=list(columns))
+        output = pyarrow.BufferOutputStream()
+        pyarrow.parquet.write_table(table, output)
+        return output.getvalue().to_pybytes()
+    raise Exception('Unknown export format: {}'.format(format))
+
+
+def _partitioned(granularity, rows):
+    """Split `rows`, which start with their period, into partitions."""
+    partition_for_period = PARTITIONS[granularity]
+    partitions = {}
+    for row in rows:
+        partitions.setdefault(partition_for_period(row[0]), []).append(row)
+    return sorted(partitions.iteritems())
+
+
+def _export_objects(reports, breakdowns, formats):
+    """Yield the (name, columns, rows, format) of every export object."""
+    prefix = _version_prefix()
+    for granularity, report in sorted(reports.iteritems()):
+        rows = [[period] + list(counts) for period, counts in report.iteritems()]
+        for partition, partition_rows in _partitioned(granularity, rows):
+            for format in formats:
+                name = '{}/{}/{}.{}'.format(prefix, granularity, partition, format)
+                yield name, SERIES_COLUMNS, partition_rows, format
+
+    for breakdown, grouping, grouped in breakdowns:
+        columns = ('date',) + tuple(grouping) + SERIES_COLUMNS[1:4]
+        for granularity in sorted(reports):
+            rows = sorted(
+                [period] + list(values) + list(counts)
+                for values, data in rollup_groups(grouped, granularity).iteritems()
+                for period, counts in data.iteritems()
+            )
+            for partition, partition_rows in _partitioned(granularity, rows):
+                for format in formats:
+                    name = '{}/breakdowns/{}/{}/{}.{}'.format(
+                        prefix, breakdown.replace(',', '-'), granularity,
+                        partition, format)
+                    yield name, columns, partition_rows, format
+
+
+def load_export_manifest(bucket):
+    """Load the MD5 of every export object written to `bucket`."""
+    key = bucket.get_key(_manifest_name())
+    if key is None:
+        return {'version': EXPORT_VERSION, 'objects': {}}
+    return json.loads(key.get_contents_as_string())
+
+
+def _upload(bucket, name, data, content_type, cache_control=None):
+    headers = {'Content-Type': content_type}
+    if cache_control:
+        headers['Cache-Control'] = cache_control
+    key = bucket.new_key(name)
+    with METRICS.timer('export', requests=1, objects=1, bytes=len(data)):
+        key.set_contents_from_string(data, headers=headers, replace=True)
+
+
+def export_reports(bucket, reports, breakdowns=(), formats=('csv', 'json'),
+                   dry_run=False, verbose=False):
+    """
+    Write `reports` and their `breakdowns` to `bucket` for downstream use.
+
+    Every granularity of `reports` is split into partitions (see
+    `PARTITIONS`) stored as 'reports/v<version>/<granularity>/<partition>.<format>'
+    with a date column followed by the installs, updates, educational
+    installs and cumulative installs. `breakdowns` is a list of (name,
+    grouping, group_report totals) tuples, exported the same way under
+    'breakdowns/<name>/'. Partitions whose contents have not changed since
+    the last export are not uploaded again.
+
+    The latest numbers of every granularity and the names of their
+    partitions are published in EXPORT_LATEST_KEY, so consumers get the
+    current numbers with one small GET.
+
+    Returns the names of the uploaded objects.
+    """
+    formats = parse_export_formats(formats)
+    manifest = load_export_manifest(bucket)
+    previous = manifest['objects']
+
+    objects = {}
+    partitions = {}
+    uploaded = []
+    for name, columns, rows, format in _export_objects(reports, breakdowns, formats):
+        data = _render(columns, rows, format)
+        md5 = hashlib.md5(data).hexdigest()
+        objects[name] = {'md5': md5, 'rows': len(rows)}
+        partitions.setdefault(name.rsplit('/', 1)[0], []).append(name)
+        if previous.get(name, {}).get('md5') == md5:
+            continue
+        uploaded.append(name)
+        if not dry_run:
+            _upload(bucket, name, data, CONTENT_TYPES[format])
+
+    latest = {
+        'version': EXPORT_VERSION,
+        'updated': _timestamp_str(),
+        'manifest': _manifest_name(),
+        'reports': {},
+    }
+    prefix = _version_prefix()
+    for granularity, report in reports.iteritems():
+        entry = latest['reports'][granularity] = {
+            'objects': sorted(partitions.get('{}/{}'.format(prefix, granularity), [])),
+        }
+        if report:
+            period = report.keys()[-1]
+            entry['latest'] = dict(zip(SERIES_COLUMNS, [period] + list(report.last())))
+
+    if verbose:
+        print('Exported {} of {} report objects{}.'.format(
+            len(uploaded), len(objects), ' (dry run)' if dry_run else ''))
+    if dry_run:
+        return uploaded
+
+    # The manifest goes last, so an interrupted export is uploaded again
+    manifest = {'version': EXPORT_VERSION, 'updated': latest['updated'], 'objects': objects}
+    _upload(bucket, _manifest_name(), json.dumps(manifest, indent=2, sort_keys=True),
+            CONTENT_TYPES['json'])
+    _upload(bucket, EXPORT_LATEST_KEY, json.dumps(latest, indent=2, sort_keys=True),
+            CONTENT_TYPES['json'], cache_control='max-age=60')
+    return uploaded
@@ -1,13 +1,26 @@
 #!/usr/bin/env python
 
 from optparse import OptionParser
+import atexit
 import os
 import sys
 
-from boto.s3.connection import S3Connection, OrdinaryCallingFormat
 import dotenv
 
-from reports import get_and_store_latest_report, generate_reports_from_files, link_for_latest_report, email_report
+from cache import AggregateCache
+from charts import CHART_BACKENDS, CHART_MAX_POINTS, ChartCache
+from backfill import backfill_reports, parse_backfill_date
+from compaction import compact_reports, uncompact_reports
+from delivery import SMTP_RETRIES
+from exports import EXPORT_FORMATS, export_reports, parse_export_formats
+from metrics import METRICS, finish_run
+from profiling import Profiler, parse_memory_budgets
+from scheduler import format_status, load_vendor_config, run_vendors
+from server import POLL_INTERVAL, ReportService, serve
+from storage import MIRROR_BUDGET_BYTES, open_storage
+from trends import RollingStats
+from warehouse import Warehouse, download_warehouse, upload_warehouse
+from reports import BREAKDOWNS, DIMENSIONS, DOWNLOADERS, ENGINES, GRANULARITIES, REPORT_REORDER_DAYS, get_and_store_latest_report, aggregate_reports_from_files, breakdown_rows, get_engine, group_reports_from_files, iter_daily_totals, link_for_latest_report, email_report, parse_grouping, rebuild_report_manifest, rollup_groups, rollup_ordered_totals
 
 
 if __name__ == '__main__':
@@ -21,11 +34,63 @@ if __name__ == '__main__':
 
     # Actions
     optparser.add_option("--download", dest="download", action="store_true", default=False, help="Download the latest report data.")
+    optparser.add_option("--downloader", dest="downloader", type="choice", choices=DOWNLOADERS, default=os.getenv('REPORT_DOWNLOADER', 'java'), help="How reports are downloaded from iTunes Connect ({}).".format(', '.join(DOWNLOADERS)))
+    optparser.add_option("--backfill", dest="backfill", nargs=2, metavar="START END", help="Download the missing daily reports between two dates (YYYYMMDD).")
+    optparser.add_option("--refetch", dest="refetch", action="store_true", default=False, help="Download every date when backfilling, uploading only the reports that changed.")
+    optparser.add_option("--backfill-processes", dest="backfill_processes", type="int", default=4, help="The number of reports to download at once when backfilling.")
+    optparser.add_option("--compact", dest="compact", action="store_true", default=False, help="Merge the daily reports of closed months into monthly reports.")
+    optparser.add_option("--uncompact", dest="uncompact", metavar="YYYYMM", help="Restore the daily reports of a compacted month.")
+    optparser.add_option("--rebuild-manifest", dest="rebuild_manifest", action="store_true", default=False, help="Rebuild the manifest of stored reports from a full bucket listing.")
     optparser.add_option("--daily-summary", dest="daily", action="store_true", default=False, help="Generate a daily summary.")
     optparser.add_option("--weekly-summary", dest="weekly", action="store_true", default=False, help="Generate a weekly summary.")
+    optparser.add_option("--monthly-summary", dest="monthly", action="store_true", default=False, help="Generate a monthly summary.")
+    optparser.add_option("--yearly-summary", dest="yearly", action="store_true", default=False, help="Generate a yearly summary.")
+    optparser.add_option("--breakdown", dest="breakdowns", action="append", default=[], metavar="NAME", help="Break the summaries down by {} or a comma separated list of columns ({}). Can be given several times.".format(', '.join(BREAKDOWNS), ', '.join(DIMENSIONS)))
+
+    # Aggregate cache options
+    optparser.add_option("--cache", dest="cache", action="store_true", default=False, help="Cache per-report aggregates in the bucket between runs.")
+    optparser.add_option("--cache-file", dest="cache_file", default=os.getenv('AGGREGATE_CACHE_FILE'), help="Cache per-report aggregates in a local file instead of the bucket.")
+
+    optparser.add_option("--engine", dest="engine", type="choice", choices=ENGINES, default=os.getenv('REPORT_ENGINE', 'python'), help="The engine used to parse and aggregate reports ({}).".format(', '.join(ENGINES)))
+    optparser.add_option("--ordered", dest="ordered", action="store_true", default=False, help="Stream the reports in date order, holding only a few days of totals at a time.")
+    optparser.add_option("--reorder-days", dest="reorder_days", type="int", default=REPORT_REORDER_DAYS, help="How many days before its own date a report can restate with --ordered.")
+    optparser.add_option("--fetch-concurrency", dest="fetch_concurrency", type="int", default=int(os.getenv('FETCH_CONCURRENCY', 1)), help="The number of reports to download from S3 at once.")
+    optparser.add_option("--parse-processes", dest="parse_processes", type="int", default=int(os.getenv('PARSE_PROCESSES', 1)), help="The number of worker processes that download and parse reports.")
+
+    # Warehouse options
+    optparser.add_option("--warehouse", dest="warehouse", default=os.getenv('WAREHOUSE_FILE'), help="A SQLite database of report rows to ingest into and summarize from.")
+    optparser.add_option("--ingest", dest="ingest", action="store_true", default=False, help="Load new and changed reports into the warehouse.")
+    optparser.add_option("--sync-warehouse", dest="sync_warehouse", action="store_true", default=False, help="Download the warehouse from the bucket first and upload it after ingesting.")
+
+    # Export options
+    optparser.add_option("--export", dest="export", default=os.getenv('REPORT_EXPORT'), metavar="FORMATS", help="Write the summaries back to the bucket under reports/ as a comma separated list of formats ({}).".format(', '.join(EXPORT_FORMATS)))
+
+    # Many vendors
+    optparser.add_option("--config", dest="config", default=os.getenv('VENDOR_CONFIG'), help="A JSON file of vendors to download, summarize and email concurrently.")
+    optparser.add_option("--download-concurrency", dest="download_concurrency", type="int", default=2, help="The number of vendors to download reports for at once.")
+    optparser.add_option("--summary-concurrency", dest="summary_concurrency", type="int", default=2, help="The number of vendors to summarize at once.")
+    optparser.add_option("--email-concurrency", dest="email_concurrency", type="int", default=1, help="The number of vendors to email reports for at once.")
+
+    # Run metrics
+    optparser.add_option("--metrics", dest="metrics", default=os.getenv('METRICS_FILE'), help="A file to append the run's metrics to as a line of JSON ('-' for stdout).")
+    optparser.add_option("--statsd", dest="statsd", default=os.getenv('STATSD_HOST'), metavar="HOST:PORT", help="Send the run's metrics to StatsD.")
+    optparser.add_option("--pushgateway", dest="pushgateway", default=os.getenv('PUSHGATEWAY_URL'), metavar="URL", help="Push the run's metrics to a Prometheus Pushgateway.")
+    optparser.add_option("--profile", dest="profile", default=os.getenv('PROFILE_FILE'), metavar="FILE", help="Profile the CPU and memory use of each phase of the run and write the report to FILE as JSON ('-' for stdout).")
+    optparser.add_option("--memory-budget", dest="memory_budgets", action="append", default=[os.getenv('MEMORY_BUDGET', '')], metavar="[PHASE=]MB", help="Fail the run as soon as a phase (or any phase) uses more MB of memory. Can be given several times.")
+
+    # Server mode
+    optparser.add_option("--serve", dest="serve", default=os.getenv('REPORT_SERVER'), metavar="HOST:PORT", help="Keep the reports in memory and serve them over HTTP.")
+    optparser.add_option("--poll-interval", dest="poll_interval", type="int", default=int(os.getenv('REPORT_POLL_INTERVAL', POLL_INTERVAL)), help="Seconds between checks for new reports when serving (0 to only refresh on request).")
+    optparser.add_option("--serve-token", dest="serve_token", default=os.getenv('REPORT_SERVER_TOKEN'), help="A token that POST requests to the server must send as a bearer token.")
 
     # Report destination
-    optparser.add_option("-e", "--email", dest="email", default=os.getenv('MAILTO'), help="The email to send to.")
+    optparser.add_option("-e", "--email", dest="email", default=os.getenv('MAILTO'), help="The email to send to, or a comma separated list of emails.")
+    optparser.add_option("--email-from", dest="email_from", default=os.getenv('MAILFROM'), help="The email to send from, the first email to send to by default.")
+
+    # Chart options
+    optparser.add_option("--chart-backend", dest="chart_backend", type="choice", choices=CHART_BACKENDS, default=os.getenv('CHART_BACKEND', 'google'), help="How the charts are rendered ({}).".format(', '.join(CHART_BACKENDS)))
+    optparser.add_option("--chart-points", dest="chart_points", type="int", default=int(os.getenv('CHART_MAX_POINTS', CHART_MAX_POINTS)), help="Downsample longer chart series to this many points (0 to disable).")
+    optparser.add_option("--chart-cache", dest="chart_cache", default=os.getenv('CHART_CACHE_DIR'), help="A directory to reuse unchanged charts from.")
 
     # iTunes Connect Options
     optparser.add_option("-l", "--login", dest="login", default=os.getenv('ITUNES_CONNECT_LOGIN'), help="The apple login.")
@@ -37,52 +102,282 @@ if __name__ == '__main__':
     optparser.add_option("-s", "--secret", dest="secret", default=os.getenv('AWS_SECRET_ACCESS_KEY'), help="The AWS access secret")
     optparser.add_option("-b", "--bucket", dest="bucket", default=os.getenv('AWS_BUCKET'), help="The AWS bucket.")
 
+    # Storage options
+    optparser.add_option("--storage-dir", dest="storage_dir", default=os.getenv('STORAGE_DIR'), help="Store the reports in a local directory instead of S3.")
+    optparser.add_option("--mirror", dest="mirror", default=os.getenv('STORAGE_MIRROR_DIR'), help="A directory to keep local copies of the stored reports in.")
+    optparser.add_option("--mirror-budget", dest="mirror_budget", type="int", default=int(os.getenv('STORAGE_MIRROR_BUDGET', MIRROR_BUDGET_BYTES // (1024 * 1024))), help="The MB of disk the mirror can use.")
+
     # SMTP options
     optparser.add_option("--smtp-host", dest="smtp_host", default=os.getenv('SMTP_HOST'), help="The SMTP host.")
     optparser.add_option("--smtp-port", dest="smtp_port", default=os.getenv('SMTP_PORT', 25), help="The SMTP port.")
     optparser.add_option("--smtp-login", dest="smtp_login", default=os.getenv('SMTP_LOGIN', None), help="The SMTP host login.")
     optparser.add_option("--smtp-password", dest="smtp_password", default=os.getenv('SMTP_PASSWORD', None), help="The SMTP host password.")
+    optparser.add_option("--smtp-no-tls", dest="smtp_starttls", action="store_false", default=not os.getenv('SMTP_NO_TLS'), help="Do not use STARTTLS, for example with a local debugging SMTP server.")
+    optparser.add_option("--smtp-connections", dest="smtp_connections", type="int", default=int(os.getenv('SMTP_CONNECTIONS', 1)), help="The number of SMTP connections to send emails over at once.")
+    optparser.add_option("--smtp-retries", dest="smtp_retries", type="int", default=int(os.getenv('SMTP_RETRIES', SMTP_RETRIES)), help="How many times an email is sent again after its SMTP connection failed.")
 
     (options, args) = optparser.parse_args()
 
     verbose = options.verbose
 
-    for k in ('login', 'password', 'vendorid', 'key', 'secret', 'bucket', 'smtp_host', ):
+    if options.ordered and options.breakdowns:
+        optparser.error('--ordered cannot be combined with --breakdown.')
+    if options.ordered and options.parse_processes > 1:
+        optparser.error('--ordered cannot be combined with --parse-processes.')
+    export_formats = []
+    if options.export:
+        try:
+            export_formats = parse_export_formats(options.export)
+        except Exception as e:
+            optparser.error(str(e))
+    try:
+        memory_budgets = parse_memory_budgets(options.memory_budgets)
+    except Exception as e:
+        optparser.error(str(e))
+
+    # Report the metrics however the run ends
+    METRICS.watch_exceptions()
+    atexit.register(
+        finish_run, path=options.metrics, statsd=options.statsd,
+        pushgateway=options.pushgateway, verbose=verbose)
+
+    profiler = Profiler(
+        profile=bool(options.profile), budgets=memory_budgets, verbose=verbose)
+    if options.profile:
+        atexit.register(profiler.save, options.profile)
+
+    if options.config:
+        vendors = load_vendor_config(options.config, defaults=dict(
+            (k, getattr(options, k))
+            for k in ('login', 'password', 'vendorid', 'key', 'secret', 'bucket', 'email', )
+        ))
+        with profiler.phase('vendors'):
+            statuses = run_vendors(
+                vendors,
+                smtp_host=options.smtp_host,
+                smtp_port=options.smtp_port,
+                smtp_login=options.smtp_login,
+                smtp_password=options.smtp_password,
+                smtp_starttls=options.smtp_starttls,
+                smtp_connections=options.smtp_connections,
+                smtp_retries=options.smtp_retries,
+                email_from=options.email_from,
+                download=options.download,
+                granularities=[g for g in GRANULARITIES if getattr(options, g)],
+                cache=options.cache,
+                engine=options.engine,
+                fetch_concurrency=options.fetch_concurrency,
+                parse_processes=options.parse_processes,
+                export_formats=export_formats,
+                downloader=options.downloader,
+                breakdowns=[(name, parse_grouping(name)) for name in options.breakdowns],
+                chart_backend=options.chart_backend,
+                chart_cache=ChartCache(options.chart_cache) if options.chart_cache else None,
+                chart_points=options.chart_points,
+                download_concurrency=options.download_concurrency,
+                summary_concurrency=options.summary_concurrency,
+                email_concurrency=options.email_concurrency,
+                dry_run=options.dry_run,
+                verbose=verbose,
+            )
+        print(format_status(statuses))
+        failed = [s['name'] for s in statuses if s['error']]
+        if failed:
+            METRICS.error = 'Vendors failed: {}'.format(', '.join(failed))
+        sys.exit(1 if failed else 0)
+
+    required = ('login', 'password', 'vendorid', 'key', 'secret', 'bucket', 'smtp_host', )
+    if options.storage_dir:
+        required = ('login', 'password', 'vendorid', 'smtp_host', )
+    for k in required:
         if not hasattr(options, k) or not getattr(options, k):
             print('--{} is a required option.'.format(k.replace('_', '-')))
             optparser.print_help()
             sys.exit()
 
-    s3 = S3Connection(options.key, options.secret, calling_format=OrdinaryCallingFormat())
-    bucket = s3.get_bucket(options.bucket)
+    bucket = open_storage(
+        key=options.key,
+        secret=options.secret,
+        bucket=options.bucket,
+        directory=options.storage_dir,
+        mirror=options.mirror,
+        mirror_budget=options.mirror_budget * 1024 * 1024,
+    )
+
+    if options.rebuild_manifest and not options.dry_run:
+        rebuild_report_manifest(bucket, verbose=verbose)
 
     if options.download:
-        get_and_store_latest_report(
-            bucket=bucket,
-            login=options.login,
-            password=options.password,
-            vendorid=options.vendorid,
-            dry_run=options.dry_run,
-            verbose=verbose,
-        )
+        with profiler.phase('download'):
+            get_and_store_latest_report(
+                bucket=bucket,
+                login=options.login,
+                password=options.password,
+                vendorid=options.vendorid,
+                dry_run=options.dry_run,
+                verbose=verbose,
+                downloader=options.downloader,
+            )
+
+    if options.backfill:
+        with profiler.phase('backfill'):
+            backfill_reports(
+                bucket=bucket,
+                login=options.login,
+                password=options.password,
+                vendorid=options.vendorid,
+                start=parse_backfill_date(options.backfill[0]),
+                end=parse_backfill_date(options.backfill[1]),
+                refetch=options.refetch,
+                processes=options.backfill_processes,
+                dry_run=options.dry_run,
+                verbose=verbose,
+                downloader=options.downloader,
+            )
+
+    if options.compact:
+        with profiler.phase('compaction'):
+            compact_reports(bucket, dry_run=options.dry_run, verbose=verbose)
+
+    if options.uncompact:
+        with profiler.phase('compaction'):
+            uncompact_reports(
+                bucket, options.uncompact, dry_run=options.dry_run, verbose=verbose)
+
+    if options.serve:
+        if options.cache_file:
+            cache = AggregateCache.load_from_file(options.cache_file)
+            save_cache = lambda cache: cache.save_to_file(options.cache_file)
+        elif options.cache:
+            cache = AggregateCache.load_from_bucket(bucket)
+            save_cache = lambda cache: cache.save_to_bucket(bucket)
+        else:
+            cache, save_cache = AggregateCache(), None
+
+        email_options = None
+        if options.email:
+            email_options = dict(
+                email=options.email,
+                host=options.smtp_host,
+                port=options.smtp_port,
+                login=options.smtp_login,
+                password=options.smtp_password,
+                sender=options.email_from,
+                starttls=options.smtp_starttls,
+                retries=options.smtp_retries,
+                connections=options.smtp_connections,
+            )
 
-    if options.daily or options.weekly:
-        daily_report, weekly_report = generate_reports_from_files(
-            bucket=bucket,
+        service = ReportService(
+            bucket,
+            cache,
+            engine=options.engine,
+            concurrency=options.fetch_concurrency,
+            processes=options.parse_processes,
+            save_cache=None if options.dry_run else save_cache,
+            chart_backend=options.chart_backend,
+            chart_cache=ChartCache(options.chart_cache) if options.chart_cache else None,
+            chart_points=options.chart_points,
+            email_options=email_options,
             verbose=verbose,
-            daily=options.daily,
-            weekly=options.weekly,
         )
-    else:
-        daily_report, weekly_report = None, None
+        serve(
+            service, options.serve, poll_interval=options.poll_interval,
+            token=options.serve_token, verbose=verbose)
+        sys.exit()
+
+    warehouse = None
+    if options.warehouse:
+        if options.sync_warehouse:
+            download_warehouse(bucket, options.warehouse)
+        warehouse = Warehouse(options.warehouse)
+    elif options.ingest:
+        print('--ingest requires --warehouse.')
+        optparser.print_help()
+        sys.exit()
+
+    if options.ingest:
+        with profiler.phase('ingest'):
+            warehouse.ingest(
+                bucket, verbose=verbose, concurrency=options.fetch_concurrency)
+            if options.sync_warehouse and not options.dry_run:
+                upload_warehouse(bucket, options.warehouse)
+
+    granularities = [g for g in GRANULARITIES if getattr(options, g)]
+    breakdowns = [(name, parse_grouping(name)) for name in options.breakdowns]
+    groupings = [grouping for name, grouping in breakdowns]
+    groups = {}
+    trends = None
+
+    with profiler.phase('summary'):
+        if granularities and warehouse is not None:
+            _, rollup_reports = get_engine(options.engine)
+            with METRICS.timer('aggregate'):
+                reports = rollup_reports(warehouse.aggregate(), granularities)
+                groups = warehouse.group(groupings)
+        elif granularities:
+            if options.cache_file:
+                cache = AggregateCache.load_from_file(options.cache_file)
+            elif options.cache:
+                cache = AggregateCache.load_from_bucket(bucket)
+            else:
+                cache = None
+
+            if groupings:
+                # Breakdowns are grouped in the same pass as the totals
+                totals, groups = group_reports_from_files(
+                    bucket=bucket,
+                    groupings=groupings,
+                    verbose=verbose,
+                    cache=cache,
+                    concurrency=options.fetch_concurrency,
+                    processes=options.parse_processes,
+                )
+            elif options.ordered:
+                totals = None
+                trends = RollingStats()
+                with METRICS.timer('aggregate'):
+                    reports = rollup_ordered_totals(iter_daily_totals(
+                        bucket=bucket,
+                        verbose=verbose,
+                        cache=cache,
+                        concurrency=options.fetch_concurrency,
+                        engine=options.engine,
+                        reorder_days=options.reorder_days,
+                    ), granularities, trends=trends)
+            else:
+                totals = aggregate_reports_from_files(
+                    bucket=bucket,
+                    verbose=verbose,
+                    cache=cache,
+                    concurrency=options.fetch_concurrency,
+                    engine=options.engine,
+                    processes=options.parse_processes,
+                )
+            if totals is not None:
+                _, rollup_reports = get_engine(options.engine)
+                with METRICS.timer('aggregate'):
+                    reports = rollup_reports(totals, granularities)
+
+            if cache is not None and cache.dirty and not options.dry_run:
+                if options.cache_file:
+                    cache.save_to_file(options.cache_file)
+                else:
+                    cache.save_to_bucket(bucket)
+        else:
+            reports = {}
 
-    if daily_report is not None or weekly_report is not None:
+    if warehouse is not None:
+        warehouse.close()
+
+    daily_report, weekly_report = reports.get('daily'), reports.get('weekly')
+
+    if reports:
 
         # Print the report data to the console
         if options.verbose:
-            for name, report in {'daily': daily_report, 'weekly': weekly_report}.iteritems():
-                if report is None:
-                    continue
+            for name in granularities:
+                report = reports[name]
                 output = """
 ===================================
       {} Download Numbers
@@ -96,18 +391,55 @@ if __name__ == '__main__':
                 )
                 print(output)
 
+                # Print each breakdown for the latest period
+                for breakdown, grouping in breakdowns:
+                    if not report:
+                        continue
+                    period = report.keys()[-1]
+                    rows = breakdown_rows(rollup_groups(groups[grouping], name), period)
+                    print('\n{} by {} for {}\n'.format(name.title(), breakdown, period) + '\n'.join(
+                        ['\t'.join(grouping + ('Count', 'Updates', 'Educational'))] +
+                        ['\t'.join(values + tuple(str(c) for c in counts)) for values, counts in rows]
+                    ))
+
+        if export_formats:
+            with profiler.phase('export'):
+                export_reports(
+                    bucket, reports,
+                    breakdowns=[
+                        (breakdown, grouping, groups[grouping])
+                        for breakdown, grouping in breakdowns
+                    ],
+                    formats=export_formats,
+                    dry_run=options.dry_run,
+                    verbose=verbose,
+                )
+
         download_link = link_for_latest_report(bucket, verbose=verbose)
 
-        if options.email:
-            email_report(
-                email=options.email,
-                download_link=download_link,
-                daily_report=daily_report,
-                weekly_report=weekly_report,
-                host=options.smtp_host,
-                port=options.smtp_port,
-                login=options.smtp_login,
-                password=options.smtp_password,
-                dry_run=options.dry_run,
-                verbose=verbose,
-            )
+        if options.email and (daily_report is not None or weekly_report is not None):
+            with profiler.phase('email'):
+                email_report(
+                    email=options.email,
+                    download_link=download_link,
+                    daily_report=daily_report,
+                    weekly_report=weekly_report,
+                    host=options.smtp_host,
+                    port=options.smtp_port,
+                    login=options.smtp_login,
+                    password=options.smtp_password,
+                    sender=options.email_from,
+                    starttls=options.smtp_starttls,
+                    retries=options.smtp_retries,
+                    connections=options.smtp_connections,
+                    dry_run=options.dry_run,
+                    verbose=verbose,
+                    chart_backend=options.chart_backend,
+                    chart_cache=ChartCache(options.chart_cache) if options.chart_cache else None,
+                    chart_points=options.chart_points,
+                    breakdowns=[
+                        (breakdown, grouping, rollup_groups(groups[grouping], 'daily'))
+                        for breakdown, grouping in breakdowns
+                    ],
+                    trends=trends.stats() if trends is not None else None,
+                )
@@ -0,0 +1,224 @@
+import collections
+import contextlib
+import datetime
+import json
+import socket
+import sys
+import threading
+import time
+
+import requests
+
+
+# The most unrecognized lines kept as examples
+SAMPLE_LIMIT = 5
+
+# Keep StatsD datagrams under a typical network MTU
+STATSD_MAX_DATAGRAM = 1432
+
+
+class Metrics(object):
+    """Durations and counts for each phase of a run.
+
+    Every phase records its duration in 'seconds' and how many times it
+    ran in 'calls', plus any counts added for it, such as 'bytes',
+    'objects', 'rows' or 'requests'. Timers can be nested on a thread, and a
+    phase's seconds exclude the time spent in phases nested inside it, so
+    streaming pipelines split their time between fetching, decompressing
+    and parsing. Phases timed on several threads at once add up their time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.phases = collections.defaultdict(lambda: collections.defaultdict(int))
+            self.samples = collections.defaultdict(list)
+            self.error = None
+
+    def add(self, phase, **counts):
+        with self.lock:
+            totals = self.phases[phase]
+            for name, value in counts.iteritems():
+                totals[name] += value
+
+    def merge(self, record):
+        """Add the phases and samples of another process's `record`."""
+        for phase, counts in record['phases'].iteritems():
+            self.add(phase, **counts)
+        for name, values in record['samples'].iteritems():
+            for value in values:
+                self.sample(name, value)
+
+    def sample(self, name, value, limit=SAMPLE_LIMIT):
+        with self.lock:
+            samples = self.samples[name]
+            if len(samples) < limit:
+                samples.append(value)
+
+    @contextlib.contextmanager
+    def timer(self, phase, **counts):
+        """Time the block as `phase`, adding any `counts` to it."""
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+
+        # Each entry collects the time of the timers nested inside it
+        stack.append(0.0)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self.add(phase, seconds=elapsed - nested, calls=1, **counts)
+
+    def timed(self, phase, iterator):
+        """Iterate over `iterator`, timing each step as `phase`."""
+        iterator = iter(iterator)
+        while True:
+            with self.timer(phase):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def watch_exceptions(self):
+        """Record the error of an uncaught exception before it is printed."""
+        excepthook = sys.excepthook
+
+        def hook(type, value, tb):
+            self.error = '{}: {}'.format(type.__name__, value)
+            excepthook(type, value, tb)
+
+        sys.excepthook = hook
+
+    def record(self):
+        """Return the run's metrics as a JSON serializable dict."""
+        with self.lock:
+            return {
+                'started': datetime.datetime.utcfromtimestamp(
+                    self.started).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'seconds': round(time.time() - self.started, 3),
+                'status': 'failed' if self.error else 'ok',
+                'error': self.error,
+                'phases': dict(
+                    (phase, dict(
+                        (name, round(value, 6) if isinstance(value, float) else value)
+                        for name, value in totals.iteritems()
+                    ))
+                    for phase, totals in self.phases.iteritems()
+                ),
+                'samples': dict(self.samples),
+            }
+
+
+# The metrics of the current run
+METRICS = Metrics()
+
+
+def _iter_metrics(record):
+    """Iterate over the (phase, name, value) numbers in a `record`."""
+    for phase, totals in sorted(record['phases'].iteritems()):
+        for name, value in sorted(totals.iteritems()):
+            yield phase, name, value
+
+
+def statsd_lines(record, prefix='itunes_reporter'):
+    """Format a `record` as StatsD timers, counters and gauges."""
+    lines = ['{}.run.seconds:{}|ms'.format(prefix, int(record['seconds'] * 1000))]
+    lines.append('{}.run.failed:{}|g'.format(prefix, int(record['status'] == 'failed')))
+    for phase, name, value in _iter_metrics(record):
+        if name == 'seconds':
+            lines.append('{}.{}.seconds:{}|ms'.format(prefix, phase, int(value * 1000)))
+        else:
+            lines.append('{}.{}.{}:{}|c'.format(prefix, phase, name, value))
+    return lines
+
+
+def send_statsd(record, host, port=8125, prefix='itunes_reporter'):
+    """Send a `record` to StatsD over UDP, batching lines into datagrams."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        datagram = ''
+        for line in statsd_lines(record, prefix=prefix):
+            if datagram and len(datagram) + len(line) + 1 > STATSD_MAX_DATAGRAM:
+                sock.sendto(datagram, (host, port))
+                datagram = ''
+            datagram = '{}\n{}'.format(datagram, line) if datagram else line
+        if datagram:
+            sock.sendto(datagram, (host, port))
+    finally:
+        sock.close()
+
+
+def prometheus_text(record, prefix='itunes_reporter'):
+    """Format a `record` in the Prometheus text exposition format."""
+    lines = [
+        '# TYPE {}_run_seconds gauge'.format(prefix),
+        '{}_run_seconds {}'.format(prefix, record['seconds']),
+        '# TYPE {}_run_failed gauge'.format(prefix),
+        '{}_run_failed {}'.format(prefix, int(record['status'] == 'failed')),
+    ]
+
+    by_name = collections.defaultdict(list)
+    for phase, name, value in _iter_metrics(record):
+        by_name[name].append((phase, value))
+    for name, values in sorted(by_name.iteritems()):
+        metric = '{}_phase_{}'.format(prefix, name)
+        lines.append('# TYPE {} gauge'.format(metric))
+        for phase, value in values:
+            lines.append('{}{{phase="{}"}} {}'.format(metric, phase, value))
+
+    return '\n'.join(lines) + '\n'
+
+
+def push_to_gateway(record, url, job='itunes_reporter', prefix='itunes_reporter'):
+    """Push a `record` to a Prometheus Pushgateway at `url`."""
+    response = requests.put(
+        '{}/metrics/job/{}'.format(url.rstrip('/'), job),
+        data=prometheus_text(record, prefix=prefix),
+        headers={'Content-Type': 'text/plain; version=0.0.4'})
+    response.raise_for_status()
+
+
+def finish_run(metrics=METRICS, path=None, statsd=None, pushgateway=None,
+               prefix='itunes_reporter', verbose=False):
+    """
+    Report the metrics of a run.
+
+    Appends the record as one line of JSON to the file at `path` ('-' for
+    stdout), sends it to StatsD at `statsd` ('host:port') and pushes it to
+    the Pushgateway at `pushgateway`. Failing to send metrics never fails
+    the run.
+    """
+    record = metrics.record()
+
+    rejected = record['phases'].get('parse', {}).get('rejected', 0)
+    if verbose and rejected:
+        print('Skipped {} lines that we do not recognize, such as:\n{}'.format(
+            rejected, '\n'.join(record['samples'].get('rejected', []))))
+
+    if path == '-':
+        print(json.dumps(record, sort_keys=True))
+    elif path:
+        with open(path, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    try:
+        if statsd:
+            host, _, port = statsd.partition(':')
+            send_statsd(record, host, int(port or 8125), prefix=prefix)
+        if pushgateway:
+            push_to_gateway(record, pushgateway, prefix=prefix)
+    except (socket.error, requests.RequestException) as e:
+        print('Unable to send the run metrics: {}'.format(e))
+
+    return record
@@ -0,0 +1,219 @@
+import cProfile
+import contextlib
+import datetime
+import json
+import os
+import pstats
+import resource
+import sys
+import thread
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+# The functions with the most time of their own listed for each phase
+PROFILE_HOTSPOTS = 20
+
+# The lines allocating the most memory listed for each phase, with tracemalloc
+PROFILE_ALLOCATIONS = 10
+
+# Seconds between samples of the resident memory during a phase
+MEMORY_POLL_INTERVAL = 0.1
+
+MB = 1024 * 1024
+
+try:
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    PAGE_SIZE = 4096
+
+
+def current_rss():
+    """Return the resident memory of this process in bytes, or None."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (IOError, OSError, IndexError, ValueError):
+        # Not Linux, so fall back on the peak
+        return peak_rss()
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    """Return the peak resident memory in bytes of this process, or of its
+    finished child processes."""
+    rss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes and macOS bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def parse_memory_budgets(values):
+    """
+    Parse '[PHASE=]MB' memory budgets into a dict mapping phases to bytes.
+
+    A budget without a phase applies to every phase without its own, and is
+    stored under None. `values` is a list of budgets or comma separated
+    strings of them.
+    """
+    budgets = {}
+    for value in values:
+        for budget in value.split(','):
+            if not budget.strip():
+                continue
+            phase, _, mb = budget.strip().rpartition('=')
+            try:
+                budgets[phase or None] = int(float(mb) * MB)
+            except ValueError:
+                raise Exception('Invalid memory budget: {}'.format(budget))
+    return budgets
+
+
+def _hotspots(profile, limit=PROFILE_HOTSPOTS):
+    stats = pstats.Stats(profile).stats
+    rows = sorted(stats.iteritems(), key=lambda item: -item[1][2])[:limit]
+    return [
+        {
+            'function': '{}:{}({})'.format(filename, line, function),
+            'calls': calls,
+            'seconds': round(own, 6),
+            'cumulative_seconds': round(cumulative, 6),
+        }
+        for (filename, line, function), (_, calls, own, cumulative, _) in rows
+    ]
+
+
+def _allocations(snapshot, limit=PROFILE_ALLOCATIONS):
+    return [
+        {'line': str(stat.traceback), 'bytes': stat.size, 'blocks': stat.count}
+        for stat in snapshot.statistics('lineno')[:limit]
+    ]
+
+
+class Profiler(object):
+    """CPU and memory profiles of the phases of a run, and memory budgets.
+
+    With `profile`, each `phase` runs under cProfile, and its hotspots,
+    resident memory and, when tracemalloc is available, its largest
+    allocations are recorded. cProfile only sees the thread that runs the
+    phase, so the time spent in fetch threads shows up as waiting on them.
+
+    `budgets` maps phases (None for every phase) to the bytes of resident
+    memory they may use. The memory is sampled while a phase runs, and a
+    phase on the main thread is interrupted as soon as it goes over, so the
+    run fails with the phase named before the dyno runs out of memory.
+    """
+
+    def __init__(self, profile=False, budgets=None, verbose=False):
+        self.profile = profile
+        self.budgets = budgets or {}
+        self.verbose = verbose
+        self.started = time.time()
+        self.phases = []
+        self.exceeded = None
+
+    def budget(self, name):
+        return self.budgets.get(name, self.budgets.get(None))
+
+    def _watch(self, name, budget, entry, done, lock, interrupt):
+        while not done.wait(MEMORY_POLL_INTERVAL):
+            rss = current_rss()
+            entry['peak_rss'] = max(entry['peak_rss'], rss)
+            if budget is not None and rss > budget and self.exceeded is None:
+                self.exceeded = name
+                # Never interrupt the main thread once the phase has ended
+                with lock:
+                    if interrupt and not done.is_set():
+                        thread.interrupt_main()
+                return
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Profile the block as the phase `name`, within its budget."""
+        budget = self.budget(name)
+        if not self.profile and budget is None:
+            yield
+            return
+
+        rss = current_rss()
+        entry = {'phase': name, 'rss_before': rss, 'peak_rss': rss, 'budget': budget}
+        done = threading.Event()
+        lock = threading.Lock()
+        watcher = threading.Thread(target=self._watch, args=(
+            name, budget, entry, done, lock,
+            isinstance(threading.current_thread(), threading._MainThread)))
+        watcher.daemon = True
+
+        profile = cProfile.Profile() if self.profile else None
+        tracing = self.profile and tracemalloc is not None
+        if tracing:
+            tracemalloc.start()
+
+        start = time.time()
+        watcher.start()
+        if profile is not None:
+            profile.enable()
+        try:
+            try:
+                yield
+            finally:
+                with lock:
+                    done.set()
+        except KeyboardInterrupt:
+            # Raised by the watcher when the phase went over its budget,
+            # which can land after the block is done but before `done` is set
+            if self.exceeded != name:
+                raise
+        finally:
+            if profile is not None:
+                profile.disable()
+            done.set()
+            watcher.join()
+
+            entry['seconds'] = round(time.time() - start, 3)
+            entry['rss_after'] = current_rss()
+            entry['peak_rss'] = max(entry['peak_rss'], entry['rss_after'])
+            entry['process_peak_rss'] = peak_rss()
+            entry['children_peak_rss'] = peak_rss(resource.RUSAGE_CHILDREN)
+            if tracing:
+                entry['traced_peak'] = tracemalloc.get_traced_memory()[1]
+                entry['allocations'] = _allocations(tracemalloc.take_snapshot())
+                tracemalloc.stop()
+            if profile is not None:
+                entry['hotspots'] = _hotspots(profile)
+            self.phases.append(entry)
+
+            if self.verbose and self.profile:
+                print('Profiled the {} phase: {:.1f}s, {:.0f}MB peak resident memory.'.format(
+                    name, entry['seconds'], entry['peak_rss'] / float(MB)))
+
+        if budget is not None and (self.exceeded == name or entry['peak_rss'] > budget):
+            raise Exception(
+                'The {} phase used {:.0f}MB of memory, over its budget of {:.0f}MB.'.format(
+                    name, entry['peak_rss'] / float(MB), budget / float(MB)))
+
+    def report(self):
+        """Return the profiles of the phases as a JSON serializable dict."""
+        return {
+            'started': datetime.datetime.utcfromtimestamp(
+                self.started).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'seconds': round(time.time() - self.started, 3),
+            'peak_rss': peak_rss(),
+            'children_peak_rss': peak_rss(resource.RUSAGE_CHILDREN),
+            'tracemalloc': tracemalloc is not None,
+            'budgets': dict((phase or '*', budget) for phase, budget in self.budgets.iteritems()),
+            'exceeded': self.exceeded,
+            'phases': self.phases,
+        }
+
+    def save(self, path):
+        """Write the `report` to `path` ('-' for stdout)."""
+        report = json.dumps(self.report(), indent=2, sort_keys=True)
+        if path == '-':
+            print(report)
+        else:
+            with open(path, 'w') as f:
+                f.write(report + '\n')
@@ -1,31 +1,42 @@
 from email.mime.multipart import MIMEMultipart
 from email.MIMEText import MIMEText
 from email.MIMEImage import MIMEImage
+import cgi
 import collections
-import contextlib
 import csv
 import datetime
 import glob
-import gzip
+import json
+import operator
 import os
-import smtplib
-import ssl
-import StringIO
+import re
+import subprocess
 import sys
-import tempfile
-
-from boto.s3.key import Key
-from pygooglechart import SimpleLineChart, Axis
-import envoy
-import requests
-
+import zlib
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from boto.utils import parse_ts
+
+from autoingestion import AutoingestionClient
+from cache import AggregateCache
+from delivery import SMTP_RETRIES, SMTPPool, deliver, parse_recipients
+from metrics import METRICS
+from series import Series
+from trends import RollingStats, daily_trends
+from storage import open_source, storage_source
+from charts import CHART_HEIGHT, CHART_MAX_POINTS, CHART_WIDTH, chart_spec, render_charts
 from utils import TemporaryDirectory
 
 
+COLUMN_SKU = 2
+COLUMN_TITLE = 4
 COLUMN_DATE = 9
 COLUMN_DOWNLOAD_TYPE = 6
 COLUMN_VERSION = 5
 COLUMN_DOWNLOADS = 7
+COLUMN_COUNTRY = 12
+COLUMN_APPLE_IDENTIFIER = 14
 COLUMN_PROMO = 16
 
 DOWNLOAD_TYPE_INSTALL = '1T'
@@ -34,16 +45,55 @@ DOWNLOAD_TYPE_UPGRADE = '7T'
 PROMO_TYPE_EDU = 'EDU'
 
 S3_PREFIX = 'itunes'
+CONSOLIDATED_PREFIX = 'consolidated'
+ARCHIVE_PREFIX = 'archive'
+
+COMPACTION_MANIFEST_KEY = '{}/manifest.json'.format(CONSOLIDATED_PREFIX)
+REPORT_MANIFEST_KEY = 'manifest/reports.json'
+
+# How many times an update re-reads a report manifest another run rewrote
+REPORT_MANIFEST_ATTEMPTS = 3
+
+REPORT_NAME_RE = re.compile(r'S_D_(?P<vendorid>\w+?)_(?P<date>\d{6}|\d{8})\.txt\.gz$')
+
+# The directory holding Autoingestion.class, which can point at a stub
+AUTOINGESTION_CLASSPATH = os.getenv(
+    'AUTOINGESTION_CLASSPATH', os.path.dirname(os.path.abspath(__file__)))
+
+# Report downloaders: the bundled Autoingestion class, or AutoingestionClient
+DOWNLOADERS = ('java', 'python')
+
+# How many days before its own date a report can restate when reports are
+# streamed in date order
+REPORT_REORDER_DAYS = 7
+
+# Shards of reports per worker process when parsing in processes
+PARSE_SHARDS_PER_PROCESS = 4
+
+FETCH_CHUNK_SIZE = 64 * 1024
+FETCH_MAX_INFLIGHT_BYTES = 64 * 1024 * 1024
 
 
 def exclude_headers(iterator):
-    for l in iterator:
-        if l.startswith('Provider'):
-            continue
-        elif not l.startswith('APPLE'):
-            print('Found a line that we do not recognize:\n{}'.format(l))
-            continue
-        yield l
+    """
+    Skip the header and any unrecognized lines of a report.
+
+    Unrecognized lines are counted and sampled in the run's metrics instead
+    of being printed.
+    """
+    rows = rejected = 0
+    try:
+        for l in iterator:
+            if l.startswith('Provider'):
+                continue
+            elif not l.startswith('APPLE'):
+                rejected += 1
+                METRICS.sample('rejected', l.rstrip('\n'))
+                continue
+            rows += 1
+            yield l
+    finally:
+        METRICS.add('parse', rows=rows, rejected=rejected)
 
 
 def datestr_to_datetime(datestr):
@@ -54,307 +104,1247 @@ def datetime_to_str(dt):
     return dt.strftime('%Y/%m/%d')
 
 
-def _iter_sorted_report(reader):
-    return sorted(reader, key=lambda r: datestr_to_datetime(r[COLUMN_DATE]))
+def aggregate_report(lines):
+    """
+    Sums the installs, updates and educational installs in a report by date.
 
+    Returns a dict mapping '%Y/%m/%d' dates to [installs, updates, edu]. Only
+    dates with at least one install or update row are included.
+    """
+    return _ungroup_totals(group_report(lines)[()])
 
-def _entry_row_for_date(data, row, date, cumulative):
-    units_type = row[COLUMN_DOWNLOAD_TYPE]
-    downloads = int(row[COLUMN_DOWNLOADS])
-    edu_promo = row[COLUMN_PROMO] == PROMO_TYPE_EDU
 
-    install_count = 0
-    upgrade_count = 0
-    educational_count = 0
-    if units_type == DOWNLOAD_TYPE_INSTALL:
-        install_count = downloads
-        if edu_promo:
-            educational_count = downloads
-    elif units_type == DOWNLOAD_TYPE_UPGRADE:
-        upgrade_count = downloads
-    else:
-        return 0
+def _ungroup_totals(totals):
+    """Key the totals of the empty grouping by date alone."""
+    return dict((key[0], counts) for key, counts in totals.iteritems())
+
+
+# The report columns that downloads can be grouped by
+DIMENSIONS = collections.OrderedDict([
+    ('sku', COLUMN_SKU),
+    ('title', COLUMN_TITLE),
+    ('version', COLUMN_VERSION),
+    ('download_type', COLUMN_DOWNLOAD_TYPE),
+    ('country', COLUMN_COUNTRY),
+    ('apple_identifier', COLUMN_APPLE_IDENTIFIER),
+    ('promo_code', COLUMN_PROMO),
+])
 
-    if date not in data:
-        data[date] = (0, 0, 0, cumulative)
+# Named groupings for the summary email and --breakdown
+BREAKDOWNS = collections.OrderedDict([
+    ('app', ('apple_identifier', 'title')),
+    ('version', ('apple_identifier', 'title', 'version')),
+    ('country', ('country', )),
+])
 
-    day, updates, edu, cum = data[date]
 
-    data[date] = (day + install_count, updates + upgrade_count, edu + educational_count, cumulative + install_count)
+def parse_grouping(grouping):
+    """
+    Return the dimensions of a named breakdown or a comma separated list of
+    dimensions, such as 'app' or 'sku,version'.
+    """
+    if grouping in BREAKDOWNS:
+        return BREAKDOWNS[grouping]
+    dimensions = tuple(d.strip() for d in grouping.split(',') if d.strip())
+    for dimension in dimensions:
+        if dimension not in DIMENSIONS:
+            raise Exception('Unknown report dimension: {}'.format(dimension))
+    return dimensions
+
 
-    return install_count
+def group_report(lines, groupings=((), )):
+    """
+    Sums the installs, updates and educational installs in a report by date
+    and by each grouping of dimensions, in a single pass.
 
+    Each grouping is a tuple of `DIMENSIONS` names. Rows are keyed on the
+    tuple of their date and dimension values, so the empty grouping gives
+    the same totals as `aggregate_report`, keyed by 1-tuples.
 
-def generate_daily_report(f, upgrades=False):
+    Returns a dict mapping each grouping to a dict mapping ('%Y/%m/%d',
+    values...) tuples to [installs, updates, edu].
     """
-    Generates a summary of the sales data by day.
+    groupings = [tuple(g) for g in groupings]
+    for grouping in groupings:
+        for dimension in grouping:
+            if dimension not in DIMENSIONS:
+                raise Exception('Unknown report dimension: {}'.format(dimension))
+
+    # Group on the raw date, which is only parsed once per key at the end
+    getters = [
+        operator.itemgetter(COLUMN_DATE, *[DIMENSIONS[d] for d in grouping])
+        for grouping in groupings
+    ]
+    groups = [{} for grouping in groupings]
+
+    for row in csv.reader(exclude_headers(lines), delimiter='\t'):
+        units_type = row[COLUMN_DOWNLOAD_TYPE]
+        if units_type == DOWNLOAD_TYPE_INSTALL:
+            index = 0
+        elif units_type == DOWNLOAD_TYPE_UPGRADE:
+            index = 1
+        else:
+            continue
 
-    Groups the sales data by date and number of downloads on that day.
+        downloads = int(row[COLUMN_DOWNLOADS])
+        edu = index == 0 and row[COLUMN_PROMO] == PROMO_TYPE_EDU
+
+        for getter, totals in zip(getters, groups):
+            key = getter(row)
+            counts = totals.get(key)
+            if counts is None:
+                counts = totals[key] = [0, 0, 0]
+            counts[index] += downloads
+            if edu:
+                counts[2] += downloads
+
+    dates = {}
+    results = {}
+    for grouping, totals in zip(groupings, groups):
+        result = results[grouping] = {}
+        for key, counts in totals.iteritems():
+            datestr = key[0] if grouping else key
+            date = dates.get(datestr)
+            if date is None:
+                date = dates[datestr] = datetime_to_str(datestr_to_datetime(datestr))
+
+            key = (date, ) + key[1:] if grouping else (date, )
+            existing = result.get(key)
+            if existing is None:
+                result[key] = counts
+            else:
+                # The same date written differently, such as 1/2 and 01/02
+                for i in xrange(3):
+                    existing[i] += counts[i]
+
+    return results
+
+
+def merge_aggregates(aggregates):
+    """Merge several `aggregate_report` or `group_report` totals into one."""
+    totals = {}
+    for aggregate in aggregates:
+        for date, (installs, updates, edu) in aggregate.iteritems():
+            counts = totals.get(date)
+            if counts is None:
+                totals[date] = [installs, updates, edu]
+            else:
+                counts[0] += installs
+                counts[1] += updates
+                counts[2] += edu
+    return totals
+
+
+def _datestr_to_date(datestr):
+    """Parse a '%Y/%m/%d' date without going through strptime."""
+    return datetime.date(int(datestr[:4]), int(datestr[5:7]), int(datestr[8:10]))
+
+
+def week_for_datestr(datestr):
     """
-    data = collections.OrderedDict()
+    Return the weekly report date that `datestr` is grouped under.
 
-    f.seek(0)
-    reader = csv.reader(exclude_headers(f), delimiter='\t')
+    This is the date strptime gives for '<year> <ISO week> 0' parsed as
+    '%Y %W %w', which is how weeks have always been keyed, worked out with
+    date arithmetic instead.
+    """
+    date = _datestr_to_date(datestr)
+    jan1 = datetime.date(date.year, 1, 1)
+    week_0_length = (7 - jan1.weekday()) % 7
+    days = week_0_length + 7 * (date.isocalendar()[1] - 1) + 6
+    return datetime_to_str(jan1 + datetime.timedelta(days=days))
 
-    cumulative = 0
 
-    for row in _iter_sorted_report(reader):
-        date = datetime_to_str(datestr_to_datetime(row[COLUMN_DATE]))
+def month_for_datestr(datestr):
+    """Return the monthly report date that `datestr` is grouped under."""
+    return datestr[:8] + '01'
 
-        cumulative += _entry_row_for_date(data, row, date, cumulative)
 
-    return data
+def year_for_datestr(datestr):
+    """Return the yearly report date that `datestr` is grouped under."""
+    return datestr[:5] + '01/01'
 
 
-def generate_weekly_report(f, upgrades=False):
+GRANULARITIES = collections.OrderedDict([
+    ('daily', None),
+    ('weekly', week_for_datestr),
+    ('monthly', month_for_datestr),
+    ('yearly', year_for_datestr),
+])
+
+
+def rollup_reports(totals, granularities=('daily', 'weekly')):
     """
-    Generates a summary of the sales data by week.
+    Generate reports at several granularities from merged aggregates.
 
-    Groups the sales data by date and number of downloads in that week.
+    The distinct dates in `totals` are sorted and walked once, filling every
+    requested granularity at the same time. Each report is a `Series`
+    mapping a '%Y/%m/%d' date to (installs, updates, edu, cumulative), where
+    cumulative is the running install total up to the last date in that
+    period.
+
+    Returns a dict mapping each granularity to its report.
     """
-    data = collections.OrderedDict()
+    return rollup_ordered_totals(
+        ((date, totals[date]) for date in sorted(totals)), granularities)
 
-    f.seek(0)
-    reader = csv.reader(exclude_headers(f), delimiter='\t')
+
+def rollup_ordered_totals(daily_totals, granularities=('daily', 'weekly'),
+                          trends=None):
+    """
+    Generate reports at several granularities from daily totals in date order.
+
+    `daily_totals` iterates over ('%Y/%m/%d', [installs, updates, edu])
+    tuples in increasing date order, such as `iter_daily_totals` yields.
+    Returns the same reports as `rollup_reports`. With `trends`, a
+    `RollingStats`, the installs of each day are also added to it as the
+    day goes by.
+    """
+    for granularity in granularities:
+        if granularity not in GRANULARITIES:
+            raise Exception('Unknown report granularity: {}'.format(granularity))
+
+    rollups = [
+        (g, Series() if GRANULARITIES[g] is None else {}, GRANULARITIES[g])
+        for g in granularities
+    ]
 
     cumulative = 0
+    for date, (installs, updates, edu) in daily_totals:
+        cumulative += installs
+        if trends is not None:
+            trends.add(datetime.datetime.strptime(date, '%Y/%m/%d').date(), installs)
+
+        for granularity, data, period_for_date in rollups:
+            if period_for_date is None:
+                # Dates come in order, so each is a new daily row
+                data.append(date, (installs, updates, edu, cumulative))
+                continue
+
+            period = period_for_date(date)
+            if period in data:
+                day, period_updates, period_edu, cum = data[period]
+                data[period] = (day + installs, period_updates + updates, period_edu + edu, cumulative)
+            else:
+                data[period] = (installs, updates, edu, cumulative)
+
+    reports = {}
+    for granularity, data, period_for_date in rollups:
+        if period_for_date is not None:
+            # Periods near the turn of the year can come out of order
+            data = Series.from_items(sorted(data.items(), key=lambda i: i[0]))
+        reports[granularity] = data
+
+    return reports
+
+
+def rollup_groups(grouped, granularity='daily'):
+    """
+    Roll the `group_report` totals of one grouping up to `granularity`.
 
-    for row in _iter_sorted_report(reader):
-        dt = datestr_to_datetime(row[COLUMN_DATE])
-        weekdt = datetime.datetime.strptime('{} {} 0'.format(dt.year, dt.isocalendar()[1]), '%Y %W %w')
-        date = datetime_to_str(weekdt)
+    Returns a dict mapping each tuple of dimension values to an OrderedDict
+    mapping '%Y/%m/%d' period dates to (installs, updates, edu).
+    """
+    if granularity not in GRANULARITIES:
+        raise Exception('Unknown report granularity: {}'.format(granularity))
+    period_for_date = GRANULARITIES[granularity]
+
+    periods = {}
+    rollups = collections.defaultdict(dict)
+    for key, (installs, updates, edu) in grouped.iteritems():
+        date, values = key[0], key[1:]
+        if period_for_date is None:
+            period = date
+        else:
+            period = periods.get(date)
+            if period is None:
+                period = periods[date] = period_for_date(date)
+
+        data = rollups[values]
+        counts = data.get(period)
+        if counts is None:
+            data[period] = (installs, updates, edu)
+        else:
+            data[period] = (counts[0] + installs, counts[1] + updates, counts[2] + edu)
 
-        cumulative += _entry_row_for_date(data, row, date, cumulative)
+    return dict(
+        (values, collections.OrderedDict(sorted(data.items())))
+        for values, data in rollups.iteritems()
+    )
 
-    # Sort the data
-    data = collections.OrderedDict(sorted(data.items(), key=lambda i: i[0]))
 
-    return data
+def breakdown_rows(rollup, period, limit=None):
+    """
+    Return the (values, (installs, updates, edu)) rows of a `rollup_groups`
+    result for one `period`, most installs first.
+    """
+    rows = [
+        (values, data[period])
+        for values, data in rollup.iteritems()
+        if period in data
+    ]
+    rows.sort(key=lambda row: (-row[1][0], -row[1][1], row[0]))
+    return rows[:limit] if limit else rows
 
 
-def get_and_store_latest_report(bucket, login, password, vendorid, dry_run=False, verbose=False):
-    # Fetch the latest download report and upload it to S3
-    with TemporaryDirectory() as dir:
-        pwd = os.path.dirname(__file__)
+ENGINES = ('python', 'numpy')
+
+
+def get_engine(name):
+    """Return the aggregate_report and rollup_reports functions of an engine."""
+    if name == 'python':
+        return aggregate_report, rollup_reports
+    elif name == 'numpy':
+        import columnar
+        return columnar.aggregate_report, columnar.rollup_reports
+    raise Exception('Unknown engine: {}'.format(name))
+
+
+def generate_reports(f, granularities=('daily', 'weekly')):
+    """
+    Generates summaries of the sales data at several granularities.
+
+    Reads the sales data in `f` once and returns a dict mapping each
+    granularity to its report.
+    """
+    f.seek(0)
+    return rollup_reports(aggregate_report(f), granularities)
 
-        if verbose:
-            print('Copying the ingestor class...')
-        command = "cp {pwd}/Autoingestion.class {dir}/Autoingestion.class".format(
-            dir=dir, pwd=pwd)
-        r = envoy.run(command)
-        if r.status_code != 0:
-            raise Exception('There was an error running: {}'.format(command))
 
-        # Setup the CWD
-        oldcwd = os.getcwd()
-        os.chdir(dir)
+def generate_daily_report(f, upgrades=False):
+    """
+    Generates a summary of the sales data by day.
+
+    Groups the sales data by date and number of downloads on that day.
+    """
+    return generate_reports(f, ('daily', ))['daily']
+
+
+def generate_weekly_report(f, upgrades=False):
+    """
+    Generates a summary of the sales data by week.
 
+    Groups the sales data by date and number of downloads in that week.
+    """
+    return generate_reports(f, ('weekly', ))['weekly']
+
+
+def _run_autoingestion(dir, login, password, vendorid, date=None, verbose=False):
+    """
+    Download a Daily Summary report into `dir` with Autoingestion.
+
+    Downloads the report for `date` ('%Y%m%d'), or the latest report if no
+    date is given. The JVM runs with `dir` as its working directory, so
+    several downloads can run side by side.
+
+    Returns the path of the downloaded report, or None if there was none.
+    """
+    command = [
+        'java', '-cp', AUTOINGESTION_CLASSPATH, 'Autoingestion',
+        login, password, vendorid, 'Sales', 'Daily', 'Summary',
+    ]
+    if date is not None:
+        command.append(date)
+
+    process = subprocess.Popen(
+        command, cwd=dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        raise Exception('There was an error running Autoingestion for {}: {}'.format(
+            date or 'the latest report', output))
+    if verbose and output.strip():
+        print(output.strip())
+
+    # Get the name of the file that was downloaded
+    files = glob.glob('{}/S_D_{}_*.txt.gz'.format(dir, vendorid))
+    if not files:
+        return None
+    return files[0]
+
+
+def get_and_store_latest_report(bucket, login, password, vendorid, dry_run=False, verbose=False,
+                                downloader='java'):
+    # Fetch the latest download report and upload it to S3
+    with TemporaryDirectory() as dir:
         if verbose:
             print('Retreiving the latest daily report...')
-        command = "java Autoingestion {login} {password} {vendorid} Sales Daily Summary".format(
-            login=login,
-            password=password,
-            vendorid=vendorid,
-        )
-        r = envoy.run(command)
-        if r.status_code != 0:
-            raise Exception('There was an error running: {}'.format(command))
-
-        # Get the name of the file that was downloaded
-        files = glob.glob('{}/S_D_{}_*.txt.gz'.format(dir, vendorid))
-        if not files:
+        with METRICS.timer('download', requests=1):
+            if downloader == 'python':
+                client = AutoingestionClient(login, password)
+                try:
+                    filepath = client.download(dir, vendorid)
+                finally:
+                    client.close()
+            else:
+                filepath = _run_autoingestion(dir, login, password, vendorid)
+        if filepath is None:
             raise Exception('Unable to find a downloaded data file!')
+        METRICS.add('download', objects=1, bytes=os.path.getsize(filepath))
 
-        filepath = files[0]
         filename = os.path.basename(filepath)
 
         if verbose:
             print('The latest report is {}. Saving to S3...'.format(filename))
 
         # Upload the report to S3
-        key = Key(bucket)
-        key.key = '{}/{}'.format(S3_PREFIX, filename)
+        key = bucket.new_key('{}/{}'.format(S3_PREFIX, filename))
         if not dry_run:
-            key.set_contents_from_filename(filepath, replace=True)
+            with METRICS.timer('upload', requests=1, objects=1, bytes=os.path.getsize(filepath)):
+                key.set_contents_from_filename(filepath, replace=True)
+            update_report_manifest(bucket, added=[key])
 
-        os.chdir(oldcwd)
 
+def parse_report_name(name):
+    """
+    Return the vendor ID and date string of a report key name.
+
+    The date string is '%Y%m%d' for daily reports and '%Y%m' for
+    consolidated monthly reports. Returns (None, None) for other names.
+    """
+    match = REPORT_NAME_RE.search(name)
+    if match is None:
+        return None, None
+    return match.group('vendorid'), match.group('date')
+
+
+def load_compaction_manifest(bucket):
+    """Load the manifest of consolidated monthly reports in `bucket`."""
+    key = bucket.get_key(COMPACTION_MANIFEST_KEY)
+    if key is None:
+        return {'consolidated': {}}
+    return json.loads(key.get_contents_as_string())
+
+
+def _compacted_sources(consolidated):
+    """Return the names of the daily reports merged into `consolidated`."""
+    return set(
+        source['name']
+        for entry in consolidated.itervalues()
+        for source in entry['sources']
+    )
+
+
+def _list_report_keys(bucket):
+    """
+    Iterate over the report keys stored in `bucket` by listing it.
+
+    Consolidated monthly reports come first, followed by the daily reports
+    that have not been consolidated yet. Only consolidated reports recorded
+    in the compaction manifest are read, and daily reports that were merged
+    into one of them are skipped, so an interrupted compaction never counts
+    a day twice. A skipped daily report that was downloaded again is picked
+    up by the next compaction.
+    """
+    consolidated = load_compaction_manifest(bucket)['consolidated']
+    METRICS.add('list', requests=1)
+    compacted = _compacted_sources(consolidated)
+
+    if consolidated:
+        for key in _list_keys(bucket, CONSOLIDATED_PREFIX + '/'):
+            if key.name in consolidated:
+                yield key
+
+    for key in _list_keys(bucket, S3_PREFIX):
+        if 'S_D_' not in key.name or key.name in compacted:
+            continue
+        yield key
+
+
+def _list_keys(bucket, prefix):
+    """List the keys under `prefix`, counting the requests in the metrics."""
+    keys = list(bucket.list(prefix=prefix))
+    # S3 lists up to 1000 keys per request
+    METRICS.add('list', requests=1 + len(keys) // 1000, objects=len(keys))
+    return keys
+
+
+def _timestamp_str(timestamp=None):
+    """
+    Format an S3 timestamp, or the current time, as ISO 8601.
+
+    Listings and HEAD requests format the time a key was last modified
+    differently, so the manifest stores them in one sortable format.
+    """
+    if timestamp is None:
+        dt = datetime.datetime.utcnow()
+    else:
+        dt = parse_ts(timestamp)
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _manifest_entry(key):
+    """Describe the report at `key` for the report manifest."""
+    return {
+        'date': parse_report_name(key.name)[1],
+        'size': key.size,
+        'etag': key.etag,
+        'uploaded': _timestamp_str(key.last_modified),
+    }
+
+
+def load_report_manifest(bucket):
+    """
+    Load the manifest of the reports stored in `bucket`.
+
+    The manifest maps the key name of every report that summaries read,
+    daily or consolidated, to its report date, size, ETag and upload time,
+    and records the name of the latest report, which is a consolidated one
+    when every daily report has been compacted. Returns None if the manifest
+    has not been built yet.
+    """
+    key = bucket.get_key(REPORT_MANIFEST_KEY)
+    if key is None:
+        return None
+    return json.loads(key.get_contents_as_string())
+
+
+def save_report_manifest(bucket, manifest):
+    """Store `manifest` in `bucket`, replacing the previous one in one PUT."""
+    manifest['latest'] = _latest_report_name(manifest['reports'])
+    manifest['updated'] = _timestamp_str()
+
+    key = bucket.new_key(REPORT_MANIFEST_KEY)
+    key.set_contents_from_string(
+        json.dumps(manifest, indent=2, sort_keys=True), replace=True)
+
+
+def rebuild_report_manifest(bucket, verbose=False):
+    """Build the report manifest from a full listing of `bucket`."""
+    manifest = {'reports': {}}
+    for key in _list_report_keys(bucket):
+        manifest['reports'][key.name] = _manifest_entry(key)
+
+    save_report_manifest(bucket, manifest)
 
-def _concatenate_reports_in_bucket(bucket, dest, verbose=False):
-    """Concatenate the report files in `bucket` into dest."""
+    if verbose:
+        print('Rebuilt the report manifest with {} reports.'.format(
+            len(manifest['reports'])))
+
+    return manifest
+
+
+def update_report_manifest(bucket, added=(), removed=()):
+    """
+    Record the reports at the `added` keys and forget the `removed` names.
+
+    The manifest is rebuilt from a listing if it does not exist yet. Each
+    update is written as a whole in a single PUT, so readers always see a
+    complete manifest, but it is not atomic: S3 cannot write an object only
+    if it is unchanged. The manifest's ETag is checked again just before
+    writing, and if another run wrote it in the meantime the update is
+    applied to that run's manifest instead. Runs writing at the same moment
+    can still drop each other's entries, which `rebuild_report_manifest`
+    restores.
+    """
+    entries = [(key.name, _manifest_entry(key)) for key in added]
+
+    for attempt in xrange(REPORT_MANIFEST_ATTEMPTS):
+        key = bucket.get_key(REPORT_MANIFEST_KEY)
+        if key is None:
+            return rebuild_report_manifest(bucket)
+        etag = key.etag
+        manifest = json.loads(key.get_contents_as_string())
+
+        for name in removed:
+            manifest['reports'].pop(name, None)
+        for name, entry in entries:
+            manifest['reports'][name] = entry
+
+        current = bucket.get_key(REPORT_MANIFEST_KEY)
+        if current is not None and current.etag == etag:
+            break
+
+    save_report_manifest(bucket, manifest)
+    return manifest
+
+
+def reports_changed_since(manifest, since):
+    """
+    Return the names of the reports in `manifest` uploaded after `since`.
+
+    `since` is a UTC time in the manifest's format, such as its 'updated'
+    time from an earlier run. Removed reports are not listed.
+    """
+    return sorted(
+        name for name, entry in manifest['reports'].iteritems()
+        if entry['uploaded'] > since
+    )
+
+
+def _manifest_key(bucket, name, entry):
+    key = bucket.new_key(name)
+    key.etag = entry['etag']
+    key.size = entry['size']
+    key.last_modified = entry['uploaded']
+    return key
+
+
+def _report_keys(bucket):
+    """
+    Return the report keys stored in `bucket`.
+
+    The keys come from the report manifest when there is one, so the bucket
+    is not listed. Consolidated monthly reports come first, followed by the
+    daily reports. The same reports are skipped as by `_list_report_keys`,
+    including daily reports downloaded again into a compacted month.
+    """
+    with METRICS.timer('list', requests=1):
+        manifest = load_report_manifest(bucket)
+        if manifest is None:
+            return list(_list_report_keys(bucket))
+
+        consolidated = load_compaction_manifest(bucket)['consolidated']
+        METRICS.add('list', requests=1)
+        compacted = _compacted_sources(consolidated)
+        prefix = CONSOLIDATED_PREFIX + '/'
+        reports = dict(
+            (name, entry) for name, entry in manifest['reports'].iteritems()
+            if name not in compacted
+            and (not name.startswith(prefix) or name in consolidated)
+        )
+        METRICS.add('list', objects=len(reports))
+        return [
+            _manifest_key(bucket, name, reports[name])
+            for name in sorted(reports, key=lambda n: (not n.startswith(prefix), n))
+        ]
+
+
+def _iter_key_chunks(key, chunk_size=FETCH_CHUNK_SIZE):
+    """Iterate over the compressed contents of `key` as it is downloaded."""
+    with METRICS.timer('fetch', requests=1, objects=1):
+        key.open('r')
+    try:
+        while True:
+            with METRICS.timer('fetch'):
+                chunk = key.read(chunk_size)
+            if not chunk:
+                break
+            METRICS.add('fetch', bytes=len(chunk))
+            yield chunk
+    finally:
+        key.close()
+
+
+def _iter_data_chunks(data, chunk_size=FETCH_CHUNK_SIZE):
+    """Iterate over an already downloaded report in chunks."""
+    for i in xrange(0, len(data), chunk_size):
+        yield data[i:i + chunk_size]
+
+
+def _download_report(key):
+    """Download the compressed report stored at `key`."""
+    return ''.join(_iter_key_chunks(key))
+
+
+def _iter_report_lines(chunks):
+    """
+    Decompress a gzipped report from an iterator of compressed chunks.
+
+    Yields the lines of the report as they are decompressed, so only a chunk
+    of the report is held in memory at a time.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    remainder = ''
+
+    for chunk in chunks:
+        while chunk:
+            with METRICS.timer('decompress', bytes=len(chunk)):
+                data = decompressor.decompress(chunk)
+
+            # Whatever follows the end of a gzip member is another member
+            chunk = decompressor.unused_data
+            if chunk:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+            if not data:
+                continue
+            lines = (remainder + data).split('\n')
+            remainder = lines.pop()
+            for line in lines:
+                yield line + '\n'
+
+    if remainder:
+        yield remainder
+
+
+def _fetch_reports(keys, concurrency=1, max_inflight_bytes=FETCH_MAX_INFLIGHT_BYTES):
+    """
+    Download the compressed reports at `keys`.
+
+    Yields (key, chunks) tuples in the same order as `keys`, where `chunks`
+    iterates over the compressed report. Each `chunks` must be consumed
+    before the next tuple is requested.
+
+    With a `concurrency` of one, the reports are streamed straight from S3.
+    Above that, the downloads run in a pool of threads which share the
+    bucket connection's pool of HTTP connections. At most
+    `max_inflight_bytes` of downloaded (or downloading) data is held before
+    it is consumed, although a single report larger than that is always let
+    through.
+    """
+    if concurrency <= 1:
+        for key in keys:
+            yield key, _iter_key_chunks(key)
+        return
+
+    pool = ThreadPool(concurrency)
+    try:
+        pending = collections.deque()
+        inflight = 0
+
+        for key in keys:
+            size = key.size or 0
+            while pending and (len(pending) >= concurrency * 2 or inflight + size > max_inflight_bytes):
+                done_key, result = pending.popleft()
+                yield done_key, _iter_data_chunks(result.get())
+                inflight -= done_key.size or 0
+
+            pending.append((key, pool.apply_async(_download_report, (key, ))))
+            inflight += size
+
+        while pending:
+            done_key, result = pending.popleft()
+            yield done_key, _iter_data_chunks(result.get())
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _iter_reports_in_bucket(bucket, verbose=False, concurrency=1):
+    """Iterate over the lines of every report file in `bucket`."""
     if verbose:
         print('Parsing download reports from the files in {}...'.format(
             bucket.name))
 
+    for key, chunks in _fetch_reports(_report_keys(bucket), concurrency=concurrency):
+        if verbose:
+            sys.stdout.write('.')
+            sys.stdout.flush()
+        for line in _iter_report_lines(chunks):
+            yield line
+
+    if verbose:
+        print(' done fetching download reports.')
+
+
+def _concatenate_reports_in_bucket(bucket, dest, verbose=False, concurrency=1):
+    """Concatenate the report files in `bucket` into dest."""
     dest.seek(0)
+    dest.writelines(_iter_reports_in_bucket(
+        bucket, verbose=verbose, concurrency=concurrency))
+
+
+def _merge_groups(results):
+    """Merge several `group_report` results into one."""
+    groups = collections.defaultdict(list)
+    for result in results:
+        for grouping, totals in result.iteritems():
+            groups[grouping].append(totals)
+    return dict(
+        (grouping, merge_aggregates(totals))
+        for grouping, totals in groups.iteritems()
+    )
 
-    for key in bucket.list(prefix=S3_PREFIX):
-        if 'S_D_' not in key.name:
-            continue
+
+def _parse_reports(keys, aggregate_lines, concurrency=1):
+    """Yield each of `keys` with the `aggregate_lines` result of its report."""
+    for key, chunks in _fetch_reports(keys, concurrency=concurrency):
+        with METRICS.timer('parse'):
+            yield key, aggregate_lines(_iter_report_lines(chunks))
+
+
+# The bucket and aggregation function of a parse worker process
+_parse_worker = {}
+
+
+def _init_parse_worker(source, engine, groupings):
+    _parse_worker['bucket'] = open_source(source)
+    if groupings is None:
+        _parse_worker['aggregate'] = get_engine(engine)[0]
+    else:
+        _parse_worker['aggregate'] = lambda lines: group_report(lines, groupings)
+
+
+def _parse_shard(shard):
+    """
+    Download, decompress and aggregate a shard of (name, etag, size) reports
+    in a worker.
+
+    Returns the (name, partial aggregate) of each report and the worker's
+    metrics for the shard.
+    """
+    METRICS.reset()
+    bucket = _parse_worker['bucket']
+    aggregate_lines = _parse_worker['aggregate']
+
+    partials = []
+    for name, etag, size in shard:
+        key = bucket.new_key(name)
+        key.etag, key.size = etag, size
+        with METRICS.timer('parse'):
+            lines = _iter_report_lines(_iter_key_chunks(key))
+            partials.append((name, aggregate_lines(lines)))
+
+    return partials, METRICS.record()
+
+
+def _parse_reports_in_processes(bucket, keys, processes, engine='python',
+                                groupings=None):
+    """
+    Yield each of `keys` with the aggregate of its report, parsed by a pool
+    of `processes` worker processes.
+
+    The keys are split into shards, and each worker downloads and aggregates
+    a shard of reports over its own connection to the storage. Only the partial
+    aggregates of each report come back to this process, never the rows.
+    """
+    if not keys:
+        return
+
+    keys_by_name = dict((key.name, key) for key in keys)
+    reports = [(key.name, key.etag, key.size) for key in keys]
+
+    # Several shards per process even out slow downloads
+    shard_size = -(-len(reports) // (processes * PARSE_SHARDS_PER_PROCESS))
+    shards = [reports[i:i + shard_size] for i in xrange(0, len(reports), shard_size)]
+
+    pool = Pool(
+        min(processes, len(shards)), _init_parse_worker,
+        (storage_source(bucket), engine, groupings))
+    try:
+        for partials, record in pool.imap_unordered(_parse_shard, shards):
+            METRICS.merge(record)
+            for name, totals in partials:
+                yield keys_by_name[name], totals
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _parse_keys(bucket, keys, aggregate_lines, concurrency=1, processes=1,
+                engine='python', groupings=None):
+    """
+    Yield each of `keys` with the `aggregate_lines` result of its report,
+    parsed in this process or by a pool of `processes` worker processes.
+    """
+    if processes > 1:
+        return _parse_reports_in_processes(
+            bucket, keys, processes, engine=engine, groupings=groupings)
+    return _parse_reports(keys, aggregate_lines, concurrency=concurrency)
+
+
+def _aggregate_reports_in_bucket(bucket, cache, verbose=False, concurrency=1,
+                                 engine='python', groupings=None, processes=1):
+    """
+    Aggregate the report files in `bucket`, reusing `cache` entries.
+
+    With `groupings`, returns the merged `group_report` results for those
+    groupings and the empty one instead of the `aggregate_report` totals.
+    With several `processes`, the reports are parsed by a pool of worker
+    processes, see `_parse_reports_in_processes`.
+    """
+    if groupings is None:
+        aggregate_lines, _ = get_engine(engine)
+        cache_get, cache_set, merge = cache.get, cache.set, merge_aggregates
+    else:
+        groupings = [()] + [tuple(g) for g in groupings if g]
+        aggregate_lines = lambda lines: group_report(lines, groupings)
+        cache_get = lambda name, etag: cache.get_groups(name, etag, groupings)
+        cache_set, merge = cache.set_groups, _merge_groups
+
+    if verbose:
+        print('Aggregating download reports from the files in {}...'.format(
+            bucket.name))
+
+    aggregates = []
+    names = set()
+    missing = []
+
+    for key in _report_keys(bucket):
+        names.add(key.name)
+
+        totals = cache_get(key.name, key.etag)
+        if totals is None:
+            missing.append(key)
+        else:
+            aggregates.append(totals)
+
+    parsed = _parse_keys(
+        bucket, missing, aggregate_lines, concurrency=concurrency,
+        processes=processes, engine=engine, groupings=groupings)
+    for key, totals in parsed:
         if verbose:
             sys.stdout.write('.')
             sys.stdout.flush()
-        key.open('r')
-        with contextlib.closing(StringIO.StringIO(key.read())) as s, gzip.GzipFile(fileobj=s) as gz:
-            dest.write(gz.read())
+        cache_set(key.name, key.etag, totals)
+        aggregates.append(totals)
+
+    cache.prune(names)
 
     if verbose:
-        print(' done fetching download reports.')
+        print(' done, fetched {} of {} download reports.'.format(
+            len(missing), len(names)))
+
+    with METRICS.timer('aggregate'):
+        return merge(aggregates)
+
+
+def _report_dates(name):
+    """
+    Return the first and last dates covered by the report named `name`, a
+    single day for daily reports or a month for consolidated ones.
+    """
+    datestr = parse_report_name(name)[1]
+    if datestr is None:
+        raise Exception('Unable to find the date of the report {}.'.format(name))
+
+    first = datetime.date(int(datestr[:4]), int(datestr[4:6]), int(datestr[6:8] or 1))
+    if len(datestr) == 8:
+        return first, first
+    next_month = (first + datetime.timedelta(days=31)).replace(day=1)
+    return first, next_month - datetime.timedelta(days=1)
 
 
-def _reports_from_source(source, daily=False, weekly=False, verbose=False):
-    """Generate daily and weekly reports from a source file."""
+def iter_daily_totals(bucket, verbose=False, cache=None, concurrency=1,
+                      engine='python', reorder_days=REPORT_REORDER_DAYS):
+    """
+    Stream the daily totals of the reports in `bucket` in date order.
+
+    The reports are read in the order of the dates in their names, and the
+    totals of a day are yielded as ('%Y/%m/%d', [installs, updates, edu])
+    once every report that could still hold that day has been read. Reports
+    can restate days up to `reorder_days` before their own date, which are
+    held back until then, so memory does not grow with the history and
+    nothing is sorted beyond that window. See `aggregate_reports_from_files`
+    for `cache`, `concurrency` and `engine`.
+    """
+    aggregate_lines, _ = get_engine(engine)
+    if verbose:
+        print('Streaming download reports from the files in {} in date order...'.format(
+            bucket.name))
+
+    keys = sorted(_report_keys(bucket), key=lambda k: (_report_dates(k.name), k.name))
+    cached = [cache.get(key.name, key.etag) if cache is not None else None for key in keys]
+    fetched = _fetch_reports(
+        [key for key, totals in zip(keys, cached) if totals is None],
+        concurrency=concurrency)
+
+    pending = {}
+    emitted = None
+
+    for key, totals in zip(keys, cached):
+        if totals is None:
+            fetched_key, chunks = next(fetched)
+            with METRICS.timer('parse'):
+                totals = aggregate_lines(_iter_report_lines(chunks))
+            if cache is not None:
+                cache.set(key.name, key.etag, totals)
+            if verbose:
+                sys.stdout.write('.')
+                sys.stdout.flush()
+
+        for date, (installs, updates, edu) in totals.iteritems():
+            if emitted is not None and date <= emitted:
+                raise Exception(
+                    '{} restates {}, more than {} days before its date. '
+                    'Read the reports with a larger reorder window.'.format(
+                        key.name, date, reorder_days))
+            counts = pending.get(date)
+            if counts is None:
+                pending[date] = [installs, updates, edu]
+            else:
+                counts[0] += installs
+                counts[1] += updates
+                counts[2] += edu
+
+        # Days before the window can no longer be restated by later reports
+        first = _report_dates(key.name)[0]
+        finished = datetime_to_str(first - datetime.timedelta(days=reorder_days))
+        for date in sorted(d for d in pending if d < finished):
+            emitted = date
+            yield date, pending.pop(date)
+
+    for date in sorted(pending):
+        yield date, pending.pop(date)
+
+    if cache is not None:
+        cache.prune(key.name for key in keys)
+
     if verbose:
-        print('Generating reports from source file...')
-    source.seek(0)
+        print(' done.')
+
+
+def aggregate_reports_from_files(
+        bucket, verbose=False, cache=None, concurrency=1, engine='python',
+        processes=1):
+    """Aggregate the report files in `bucket` by date.
+
+    If an `AggregateCache` is given, only reports that are new or changed
+    since it was saved are downloaded. Reports are downloaded by
+    `concurrency` threads and parsed by the named `engine`, or downloaded
+    and parsed by a pool of `processes` worker processes.
+
+    Returns the merged `aggregate_report` totals for every report.
+    """
 
-    daily_report = generate_daily_report(source) if daily else None
-    weekly_report = generate_weekly_report(source) if weekly else None
+    if processes > 1 and cache is None:
+        # Per report partial aggregates are merged the same way as the cache
+        cache = AggregateCache()
 
-    print(' done.')
+    if cache is not None:
+        return _aggregate_reports_in_bucket(
+            bucket=bucket, cache=cache, verbose=verbose,
+            concurrency=concurrency, engine=engine, processes=processes)
 
-    return daily_report, weekly_report
+    # Stream every file in the bucket directory straight into the aggregation
+    aggregate_lines, _ = get_engine(engine)
+    with METRICS.timer('parse'):
+        return aggregate_lines(_iter_reports_in_bucket(
+            bucket=bucket, verbose=verbose, concurrency=concurrency))
+
+
+def group_reports_from_files(
+        bucket, groupings, verbose=False, cache=None, concurrency=1,
+        processes=1):
+    """Aggregate the report files in `bucket` by date and `groupings`.
+
+    Computes the totals and every grouping in the same pass over the
+    reports, with `group_report`. See `aggregate_reports_from_files` for
+    `cache`, `concurrency` and `processes`.
+
+    Returns the `aggregate_report` totals and a dict mapping each grouping
+    to its merged `group_report` totals.
+    """
+    groupings = [tuple(g) for g in groupings if g]
+
+    if processes > 1 and cache is None:
+        cache = AggregateCache()
+
+    if cache is not None:
+        groups = _aggregate_reports_in_bucket(
+            bucket=bucket, cache=cache, verbose=verbose,
+            concurrency=concurrency, groupings=groupings, processes=processes)
+    else:
+        with METRICS.timer('parse'):
+            groups = group_report(_iter_reports_in_bucket(
+                bucket=bucket, verbose=verbose, concurrency=concurrency),
+                [()] + groupings)
+
+    return _ungroup_totals(groups.pop(())), groups
 
 
 def generate_reports_from_files(
-        bucket, verbose=False, daily=False, weekly=False):
+        bucket, verbose=False, daily=False, weekly=False, cache=None,
+        concurrency=1, engine='python'):
     """Generate a summary report from `bucket`.
 
-    Generate daily and / or weekly summary reports.
+    Generate daily and / or weekly summary reports. See
+    `aggregate_reports_from_files` for `cache`, `concurrency` and `engine`.
 
     Returns tuple of daily_report, weekly_report
     """
+    totals = aggregate_reports_from_files(
+        bucket=bucket, verbose=verbose, cache=cache, concurrency=concurrency,
+        engine=engine)
 
-    # For every file in the bucket directory, unzip it and add it to a
-    # temporary file
-    with tempfile.TemporaryFile() as summary:
-        _concatenate_reports_in_bucket(
-            bucket=bucket, dest=summary, verbose=verbose)
+    _, rollup = get_engine(engine)
+    granularities = [g for g, wanted in (('daily', daily), ('weekly', weekly)) if wanted]
+    reports = rollup(totals, granularities)
 
-        daily_report, weekly_report = _reports_from_source(
-            summary,
-            daily=daily,
-            weekly=weekly,
-            verbose=verbose,
-        )
+    return reports.get('daily'), reports.get('weekly')
 
-        return daily_report, weekly_report
+
+def _latest_report_name(names):
+    """
+    Return the name of the newest report among `names`, or None.
+
+    A consolidated monthly report is newer than the daily reports of its
+    month, which it holds.
+    """
+    dated = []
+    for name in names:
+        datestr = parse_report_name(name)[1]
+        if datestr is not None:
+            dated.append((datestr.ljust(8, '9'), name))
+    return max(dated)[1] if dated else None
 
 
 def link_for_latest_report(bucket, verbose=False):
-    keys = sorted(bucket.list(prefix=S3_PREFIX), key=lambda k: k.name)
+    """
+    Return a link to the latest report in `bucket`, or None if it has none.
 
-    key = keys[-1]
+    Once every daily report has been compacted, as on the first day of a
+    month, the latest report is the newest consolidated one.
+    """
+    manifest = load_report_manifest(bucket)
+    if manifest is not None and manifest.get('latest'):
+        name = manifest['latest']
+    else:
+        with METRICS.timer('list'):
+            names = [key.name for key in _list_keys(bucket, S3_PREFIX)]
+        names.extend(load_compaction_manifest(bucket)['consolidated'])
+        name = _latest_report_name(names)
+        if name is None:
+            return None
 
-    return key.generate_url(expires_in=60 * 60 * 24 * 365)
+    return bucket.new_key(name).generate_url(expires_in=60 * 60 * 24 * 365)
 
 
-def email_report(email, download_link, daily_report, weekly_report,
-                 host, port, login=None, password=None, dry_run=False,
-                 verbose=False):
-    daily = [v[0] for k, v in daily_report.items()] if daily_report else []
-    daily_updates = daily_report.items()[-1][1][1]
-    daily_edu = daily_report.items()[-1][1][2]
-    weekly = [v[0] for k, v in weekly_report.items()] if weekly_report else []
+# The most rows shown for each breakdown in the email
+BREAKDOWN_EMAIL_ROWS = 10
+
+# Dimensions that are left out of breakdown labels next to readable ones
+IDENTIFIER_DIMENSIONS = ('sku', 'apple_identifier')
+
+
+def _breakdown_label(grouping, values):
+    labels = [v for d, v in zip(grouping, values) if d not in IDENTIFIER_DIMENSIONS]
+    return ' '.join(labels or values) or '(none)'
+
+
+def _breakdown_html(name, grouping, rows):
+    """Render the rows of one breakdown as a table for the email."""
+    cells = ''.join("""
+                <tr>
+                    <td style="text-align: left; padding: 2px 10px;">{label}</td>
+                    <td style="padding: 2px 10px;">{installs:,}</td>
+                    <td style="padding: 2px 10px;">{updates:,}</td>
+                    <td style="padding: 2px 10px;">{edu:,}</td>
+                </tr>""".format(
+        label=cgi.escape(_breakdown_label(grouping, values)),
+        installs=installs,
+        updates=updates,
+        edu=edu,
+    ) for values, (installs, updates, edu) in rows)
+
+    return """
+    <tr>
+        <td style="padding: 5px;">
+            <table cellpadding="0" cellspacing="0" border="0" style="width: 100%; text-align: right; font-size: 12px;">
+                <tr style="font-size: 10px; color: #777">
+                    <td style="text-align: left; padding: 2px 10px;">By {name}</td>
+                    <td style="padding: 2px 10px;">Downloads</td>
+                    <td style="padding: 2px 10px;">Updates</td>
+                    <td style="padding: 2px 10px;">Educational</td>
+                </tr>{cells}
+            </table>
+        </td>
+    </tr>""".format(name=cgi.escape(name), cells=cells)
+
+
+def _format_average(average):
+    return '&ndash;' if average is None else '{:,.0f}'.format(average)
+
 
+def _format_change(change):
+    return '&ndash;' if change is None else '{:+.0%}'.format(change)
+
+
+def _anomaly_html(trends):
+    """Flag the latest downloads when they are far from the last weeks'."""
+    if not trends['anomaly']:
+        return ''
+    return """
+                        <div style="font-size: 9px; color: {color};">unusually {direction}</div>""".format(
+        color='#2a9d3a' if trends['z_score'] > 0 else '#d0342c',
+        direction='high' if trends['z_score'] > 0 else 'low',
+    )
+
+
+def report_chart_specs(daily_report, weekly_report, chart_points=CHART_MAX_POINTS):
+    """
+    Return the specs of the report charts: 'daily', 'weekly', 'cumulative'
+    and 'daily-recent', for the reports that are given.
+    """
     cumulative_data = daily_report if daily_report else weekly_report
     if cumulative_data is None:
         raise Exception("No data given to generate a cumulative report!")
-    cumulative = [v[3] for k, v in cumulative_data.items()]
-
-    width, height = 700, 300
 
-    # Create the charts
-    daily_chart = SimpleLineChart(width, height)
-    weekly_chart = SimpleLineChart(width, height)
-    cumulative_chart = SimpleLineChart(width, height)
-
-    # Titles
-    daily_chart.set_title('Daily Downloads')
-    weekly_chart.set_title('Weekly Downloads')
-    cumulative_chart.set_title('Cumulative Downloads')
-
-    # Add data
-    if daily:
-        daily_data = daily[-180:]
-        daily_chart.add_data(daily_data)
-        daily_chart.set_axis_range(Axis.LEFT, 0, max(daily_data))
-        daily_chart.set_axis_labels(Axis.RIGHT, [min(daily_data), max(daily_data)])
-
-    if weekly:
-        weekly_chart.add_data(weekly)
-        weekly_chart.set_axis_range(Axis.LEFT, 0, max(weekly))
-        weekly_chart.set_axis_labels(Axis.RIGHT, [min(weekly), max(weekly)])
-
-    cumulative_chart.add_data(cumulative)
-    cumulative_chart.set_axis_range(Axis.LEFT, 0, max(cumulative))
-    cumulative_chart.set_axis_labels(
-        Axis.RIGHT, [min(cumulative), max(cumulative)])
-
-    # Set the styling
-    marker = ('B', 'C5D4B5BB', '0', '0', '0')
-    colors = ['3D7930', 'FF9900']
-
-    daily_chart.markers.append(marker)
-    weekly_chart.markers.append(marker)
-    cumulative_chart.markers.append(marker)
-
-    daily_chart.set_colours(colors)
-    weekly_chart.set_colours(colors)
-    cumulative_chart.set_colours(colors)
-
-    grid_args = 0, 10
-    grid_kwargs = dict(line_segment=2, blank_segment=6)
-    daily_chart.set_grid(*grid_args, **grid_kwargs)
-    weekly_chart.set_grid(*grid_args, **grid_kwargs)
-    cumulative_chart.set_grid(*grid_args, **grid_kwargs)
-
-    #daily_chart.fill_linear_stripes(
-    #   Chart.CHART, 0, 'CCCCCC', 0.2, 'FFFFFF', 0.2)
-
-    daily_chart_url = daily_chart.get_url() if daily else None
-    weekly_chart_url = weekly_chart.get_url() if weekly else None
-    cumulative_chart_url = cumulative_chart.get_url()
-
-    # Create recent versions of the charts
-    if daily:
-        recent_daily = daily[-90:]
-
-        # Get last year's daily data. First, get the first date for the daily
-        # data.
-        start = daily_report.items()[-90][0]
-        dt = datetime.datetime.strptime(start, '%Y/%m/%d')
-        dt = dt - datetime.timedelta(weeks=52)
-        last_year_datestr = datetime_to_str(dt)
-
-        # Get the index in the data for the datestr
-        try:
-            i = daily_report.keys().index(last_year_datestr)
-            recent_daily_comparison = daily[i:i + 90]
-        except ValueError:
+    specs = []
+    if daily_report:
+        specs.append(chart_spec(
+            'daily', 'Daily Downloads', [daily_report[-180:].column('installs')],
+            max_points=chart_points))
+    if weekly_report:
+        specs.append(chart_spec(
+            'weekly', 'Weekly Downloads', [weekly_report.column('installs')],
+            max_points=chart_points))
+    specs.append(chart_spec(
+        'cumulative', 'Cumulative Downloads', [cumulative_data.column('cumulative')],
+        max_points=chart_points))
+
+    # Create a recent version of the daily chart
+    if daily_report:
+        recent = daily_report[-90:]
+        recent_daily = recent.column('installs')
+
+        # Compare with the same window 52 weeks earlier, if there is data for
+        # its first day
+        start = _datestr_to_date(recent.keys()[0]) - datetime.timedelta(weeks=52)
+        i = daily_report.position(datetime_to_str(start))
+        if i is not None:
+            recent_daily_comparison = daily_report[i:i + 90].column('installs')
+        else:
             recent_daily_comparison = []
 
+        series = [recent_daily]
         if recent_daily_comparison:
-            daily_chart.data = [recent_daily, recent_daily_comparison]
-        else:
-            daily_chart.data = [recent_daily]
-        # Reset the axes
-        daily_chart.axis = []
-        min_daily = min(recent_daily + recent_daily_comparison)
-        max_daily = max(recent_daily + recent_daily_comparison)
-        daily_chart.set_axis_range(Axis.LEFT, 0, max_daily)
-        daily_chart.set_axis_labels(Axis.RIGHT, [min_daily, max_daily])
-        daily_chart.set_title('Recent Daily Downloads (filled is now)')
-
-        daily_recent_chart_url = daily_chart.get_url()
-    else:
-        daily_recent_chart_url = None
+            series.append(recent_daily_comparison)
+        specs.append(chart_spec(
+            'daily-recent', 'Recent Daily Downloads (filled is now)', series,
+            max_points=chart_points))
 
-    if verbose:
-        print('Daily: ' + daily_chart_url) if daily_chart_url else None
-        print('Weekly: ' + weekly_chart_url) if weekly_chart_url else None
-        print('Cumulative: ' + cumulative_chart_url)
-        print('Daily Recent: ' + daily_recent_chart_url) if daily_recent_chart_url else None
+    return specs
+
+
+def build_report_message(email, download_link, daily_report, weekly_report,
+                         verbose=False, chart_backend='google',
+                         chart_cache=None, chart_points=CHART_MAX_POINTS,
+                         breakdowns=None, trends=None):
+    """
+    Render the charts and build the report email sent to `email`.
+
+    `breakdowns` is a list of (name, grouping, rollup) tuples, where each
+    rollup is the daily `rollup_groups` result of its grouping. Their rows
+    for the latest day are shown below the charts. `trends` are the
+    `RollingStats.stats` of the daily installs, when they were kept while
+    the reports were rolled up, or else they are read from `daily_report`.
+    """
+    latest_daily, daily_updates, daily_edu, _ = daily_report.last()
+    latest_weekly = weekly_report.last()[0] if weekly_report else 0
+
+    cumulative_data = daily_report if daily_report else weekly_report
+    if cumulative_data is None:
+        raise Exception("No data given to generate a cumulative report!")
+    cumulative = cumulative_data.last()[3]
+
+    if trends is None:
+        trends = daily_trends(daily_report) if daily_report else RollingStats().stats()
+
+    # Create the charts
+    images = render_charts(
+        report_chart_specs(daily_report, weekly_report, chart_points=chart_points),
+        backend=chart_backend, cache=chart_cache, verbose=verbose)
+
+    breakdown_html = ''
+    if breakdowns and daily_report:
+        latest = daily_report.keys()[-1]
+        breakdown_html = ''.join(
+            _breakdown_html(name, grouping, breakdown_rows(rollup, latest, BREAKDOWN_EMAIL_ROWS))
+            for name, grouping, rollup in breakdowns
+        )
+
+    download_html = ''
+    if download_link:
+        download_html = """
+    <tr>
+        <td><hr color="#cbcbcb"></td>
+    </tr>
+    <tr>
+        <td style="padding: 10px; text-align: center;">
+            <a style="color: #777" href="{}">Download today's report</a>
+        </td>
+    </tr>""".format(download_link)
 
     yesterday = datetime.date.today() - datetime.timedelta(days=1)
 
@@ -390,7 +1380,7 @@ def email_report(email, download_link, daily_report, weekly_report,
                 <tr>
                     <td style="margin-top: 5px;">
                         <span style="font-size: 10px; color: #777">Downloads:</span>
-                        <div style="font-size: 15px; margin-top: 3px; "><b>{latest_daily:,}</b></div>
+                        <div style="font-size: 15px; margin-top: 3px; "><b>{latest_daily:,}</b></div>{anomaly}
                     </td>
                     <td style="margin-top: 5px;">
                         <span style="font-size: 10px; color: #777">Updates:</span>
@@ -409,6 +1399,24 @@ def email_report(email, download_link, daily_report, weekly_report,
                         <div style="font-size: 15px; margin-top: 3px; "><b>{cumulative:,}</b></div>
                     </td>
                 </tr>
+                <tr>
+                    <td style="margin-top: 5px;">
+                        <span style="font-size: 10px; color: #777">7-Day Average:</span>
+                        <div style="font-size: 13px; margin-top: 3px; ">{short_average}</div>
+                    </td>
+                    <td style="margin-top: 5px;">
+                        <span style="font-size: 10px; color: #777">28-Day Average:</span>
+                        <div style="font-size: 13px; margin-top: 3px; ">{long_average}</div>
+                    </td>
+                    <td style="margin-top: 5px;">
+                        <span style="font-size: 10px; color: #777">Week over Week:</span>
+                        <div style="font-size: 13px; margin-top: 3px; ">{week_over_week}</div>
+                    </td>
+                    <td style="margin-top: 5px;" colspan="2">
+                        <span style="font-size: 10px; color: #777">Year over Year:</span>
+                        <div style="font-size: 13px; margin-top: 3px; ">{year_over_year}</div>
+                    </td>
+                </tr>
             </table>
         </td>
     </tr>
@@ -423,15 +1431,9 @@ def email_report(email, download_link, daily_report, weekly_report,
     <tr><td style="padding: 5px;"><img src="cid:weekly.png" width="{width}" height="{height}" alt="Weekly Downloads" /></td></tr>
     <tr><td style="padding: 5px;"><img src="cid:cumulative.png" width="{width}" height="{height}" alt="Cumulative Downloads" /></td></tr>
     <tr><td style="padding: 5px;"><img src="cid:daily-recent.png" width="{width}" height="{height}" alt="Recent Daily Downloads" /></td></tr>
+{breakdowns}
 
-    <tr>
-        <td><hr color="#cbcbcb"></td>
-    </tr>
-    <tr>
-        <td style="padding: 10px; text-align: center;">
-            <a style="color: #777" href="{download}">Download today's report</a>
-        </td>
-    </tr>
+{download}
 </table>
 
 
@@ -439,14 +1441,20 @@ def email_report(email, download_link, daily_report, weekly_report,
 
 </html>""".format(
         yesterday=yesterday,
-        latest_daily=daily[-1] if daily else 0,
-        latest_weekly=weekly[-1] if weekly else 0,
+        latest_daily=latest_daily,
+        latest_weekly=latest_weekly,
         latest_updates=daily_updates,
         latest_edu=daily_edu,
-        cumulative=cumulative[-1],
-        download=download_link,
-        width=width,
-        height=height,
+        cumulative=cumulative,
+        anomaly=_anomaly_html(trends),
+        short_average=_format_average(trends['short_average']),
+        long_average=_format_average(trends['long_average']),
+        week_over_week=_format_change(trends['week_over_week']),
+        year_over_year=_format_change(trends['year_over_year']),
+        download=download_html,
+        width=CHART_WIDTH,
+        height=CHART_HEIGHT,
+        breakdowns=breakdown_html,
     )
 
     # Create message container - the correct MIME type is multipart/alternative.
@@ -469,41 +1477,62 @@ def email_report(email, download_link, daily_report, weekly_report,
     alternative.attach(part1)
     alternative.attach(part2)
 
-    # Get the images
-    if daily_chart_url:
-        r = requests.get(daily_chart_url)
-        img = MIMEImage(r.content, _subtype='png')
-        img.add_header('Content-ID', '<daily.png>')
-        message_root.attach(img)
-
-    if weekly_chart_url:
-        r = requests.get(weekly_chart_url)
-        img = MIMEImage(r.content, _subtype='png')
-        img.add_header('Content-ID', '<weekly.png>')
-        message_root.attach(img)
-
-    r = requests.get(cumulative_chart_url)
-    img = MIMEImage(r.content, _subtype='png')
-    img.add_header('Content-ID', '<cumulative.png>')
-    message_root.attach(img)
-
-    if daily_recent_chart_url:
-        r = requests.get(daily_recent_chart_url)
-        img = MIMEImage(r.content, _subtype='png')
-        img.add_header('Content-ID', '<daily-recent.png>')
-        message_root.attach(img)
+    # Attach the images
+    for name in ('daily', 'weekly', 'cumulative', 'daily-recent'):
+        if name in images:
+            img = MIMEImage(images[name], _subtype='png')
+            img.add_header('Content-ID', '<{}.png>'.format(name))
+            message_root.attach(img)
+
+    return message_root
+
+
+def report_messages(message_root, recipients, sender=None):
+    """
+    Return the (from address, to addresses, message) of `message_root` for
+    each of `recipients`, sent from `sender` or the first recipient.
+
+    The message is built, and its charts encoded, once. Only its headers
+    change between the recipients.
+    """
+    sender = sender or recipients[0]
+    message_root.replace_header('From', sender)
+
+    messages = []
+    for recipient in recipients:
+        message_root.replace_header('To', recipient)
+        messages.append((sender, [recipient], message_root.as_string()))
+    return messages
+
 
+def email_report(email, download_link, daily_report, weekly_report,
+                 host, port, login=None, password=None, dry_run=False,
+                 verbose=False, chart_backend='google', chart_cache=None,
+                 chart_points=CHART_MAX_POINTS, smtp=None, breakdowns=None,
+                 sender=None, starttls=True, retries=SMTP_RETRIES,
+                 connections=1, trends=None):
+    """
+    Email the report to `email`, a comma separated list of addresses.
+
+    Every message is built before any is sent. They are sent over `smtp`, a
+    shared `SMTPPool`, or else over up to `connections` connections to
+    `host` that are closed afterwards.
+    """
+    recipients = parse_recipients(email)
+    message_root = build_report_message(
+        recipients[0], download_link, daily_report, weekly_report,
+        verbose=verbose, chart_backend=chart_backend, chart_cache=chart_cache,
+        chart_points=chart_points, breakdowns=breakdowns, trends=trends)
+    messages = report_messages(message_root, recipients, sender=sender)
+
+    if smtp is not None:
+        deliver(messages, smtp, verbose=verbose)
+        return
+
+    smtp = SMTPPool(
+        host, port, login=login, password=password, size=connections,
+        retries=retries, starttls=starttls)
     try:
-        # Send the message via local SMTP server.
-        s = smtplib.SMTP(host, port)
-        s.starttls()
-        s.login(login, password)
-
-        # sendmail function takes 3 arguments: sender's address,
-        # recipient's address and message to send - here it is sent as one
-        # string.
-        s.sendmail(email, [email], message_root.as_string())
-        s.quit()
-    except (ssl.SSLError, smtplib.SMTPServerDisconnected):
-        print('Error')
-        s.close()
+        deliver(messages, smtp, verbose=verbose)
+    finally:
+        smtp.close()
@@ -0,0 +1,281 @@
+import json
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+
+from cache import AggregateCache
+from delivery import SMTP_RETRIES, SMTPPool
+from exports import export_reports
+from metrics import METRICS
+from reports import (
+    aggregate_reports_from_files, email_report, get_and_store_latest_report,
+    get_engine, group_reports_from_files, link_for_latest_report, rollup_groups)
+
+
+# The settings every vendor needs, from its entry or the defaults
+VENDOR_SETTINGS = ('login', 'password', 'vendorid', 'key', 'secret', 'bucket')
+
+STAGES = ('download', 'summary', 'email')
+
+
+def load_vendor_config(path, defaults=None):
+    """
+    Load the vendors listed in the JSON config file at `path`.
+
+    The file holds a list of vendors, or an object with a 'vendors' list
+    and optional 'defaults'. Each vendor is an object with the same names as
+    the command line options ('login', 'password', 'vendorid', 'key',
+    'secret', 'bucket', 'email', 'email_from') and an optional 'name'. Missing settings
+    are taken from the file's 'defaults', then from `defaults`.
+    """
+    with open(path) as f:
+        config = json.load(f)
+    if isinstance(config, list):
+        config = {'vendors': config}
+
+    base = dict((k, v) for k, v in (defaults or {}).iteritems() if v)
+    base.update(config.get('defaults', {}))
+
+    vendors = []
+    buckets = {}
+    for entry in config['vendors']:
+        vendor = dict(base)
+        vendor.update(entry)
+
+        missing = [k for k in VENDOR_SETTINGS if not vendor.get(k)]
+        if missing:
+            raise Exception('Vendor {} is missing {} in {}.'.format(
+                entry.get('name') or entry.get('vendorid'), ', '.join(missing), path))
+        vendor.setdefault('name', vendor['vendorid'])
+
+        # Summaries cover every report in a bucket
+        other = buckets.setdefault(vendor['bucket'], vendor['name'])
+        if other != vendor['name']:
+            raise Exception('Vendors {} and {} share the bucket {}.'.format(
+                other, vendor['name'], vendor['bucket']))
+
+        vendors.append(vendor)
+
+    return vendors
+
+
+class S3Pool(object):
+    """One S3 connection per AWS account, shared by every vendor using it.
+
+    boto pools the HTTP connections of each S3 connection, so vendors in the
+    same account reuse them. Buckets are only looked up once.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.buckets = {}
+
+    def get_bucket(self, key, secret, name):
+        with self.lock:
+            bucket = self.buckets.get((key, name))
+            if bucket is None:
+                s3 = self.connections.get(key)
+                if s3 is None:
+                    s3 = self.connections[key] = S3Connection(
+                        key, secret, calling_format=OrdinaryCallingFormat())
+                bucket = self.buckets[(key, name)] = s3.get_bucket(name)
+            return bucket
+
+
+def _run_vendor(vendor, s3, smtp, limits, settings):
+    """
+    Run the stages for one vendor, returning its status.
+
+    Each stage waits for a slot in its `limits` semaphore. An error stops
+    this vendor's remaining stages, and is recorded in its status.
+    """
+    status = {'name': vendor['name'], 'stages': [], 'error': None}
+    verbose = settings['verbose']
+    dry_run = settings['dry_run']
+
+    def stage(name, func):
+        with limits[name]:
+            start = time.time()
+            result = func()
+            elapsed = time.time() - start
+        status['stages'].append((name, elapsed))
+        if verbose:
+            print('[{}] {} done in {:.1f}s.'.format(vendor['name'], name, elapsed))
+        return result
+
+    try:
+        bucket = s3.get_bucket(vendor['key'], vendor['secret'], vendor['bucket'])
+
+        if settings['download']:
+            stage('download', lambda: get_and_store_latest_report(
+                bucket=bucket,
+                login=vendor['login'],
+                password=vendor['password'],
+                vendorid=vendor['vendorid'],
+                dry_run=dry_run,
+                downloader=vendor.get('downloader', settings['downloader']),
+            ))
+
+        granularities = settings['granularities']
+        if not granularities:
+            return status
+
+        breakdowns = settings['breakdowns']
+
+        def summarize():
+            cache = AggregateCache.load_from_bucket(bucket) if settings['cache'] else None
+            groups = {}
+            if breakdowns:
+                totals, groups = group_reports_from_files(
+                    bucket=bucket,
+                    groupings=[grouping for name, grouping in breakdowns],
+                    cache=cache,
+                    concurrency=settings['fetch_concurrency'],
+                    processes=settings['parse_processes'],
+                )
+            else:
+                totals = aggregate_reports_from_files(
+                    bucket=bucket,
+                    cache=cache,
+                    concurrency=settings['fetch_concurrency'],
+                    engine=settings['engine'],
+                    processes=settings['parse_processes'],
+                )
+            if cache is not None and cache.dirty and not dry_run:
+                cache.save_to_bucket(bucket)
+            _, rollup_reports = get_engine(settings['engine'])
+            with METRICS.timer('aggregate'):
+                reports = rollup_reports(totals, granularities)
+            if settings['export_formats']:
+                export_reports(
+                    bucket, reports,
+                    breakdowns=[
+                        (name, grouping, groups[grouping])
+                        for name, grouping in breakdowns
+                    ],
+                    formats=settings['export_formats'],
+                    dry_run=dry_run,
+                )
+            return reports, groups
+
+        reports, groups = stage('summary', summarize)
+        daily_report, weekly_report = reports.get('daily'), reports.get('weekly')
+
+        email = vendor.get('email')
+        if email and smtp is not None and (daily_report is not None or weekly_report is not None):
+            stage('email', lambda: email_report(
+                email=email,
+                download_link=link_for_latest_report(bucket),
+                daily_report=daily_report,
+                weekly_report=weekly_report,
+                host=None,
+                port=None,
+                dry_run=dry_run,
+                chart_backend=settings['chart_backend'],
+                chart_cache=settings['chart_cache'],
+                chart_points=settings['chart_points'],
+                smtp=smtp,
+                sender=vendor.get('email_from', settings['email_from']),
+                breakdowns=[
+                    (name, grouping, rollup_groups(groups[grouping], 'daily'))
+                    for name, grouping in breakdowns
+                ],
+            ))
+    except Exception as e:
+        status['error'] = '{}: {}'.format(type(e).__name__, e)
+        if verbose:
+            sys.stderr.write('[{}] failed:\n{}'.format(
+                vendor['name'], traceback.format_exc()))
+
+    return status
+
+
+def run_vendors(vendors, smtp_host=None, smtp_port=25, smtp_login=None,
+                smtp_password=None, smtp_starttls=True, smtp_connections=1,
+                smtp_retries=SMTP_RETRIES, email_from=None, download=False, granularities=(),
+                cache=False, engine='python', fetch_concurrency=1,
+                parse_processes=1, export_formats=(), downloader='java', breakdowns=(), chart_backend='google',
+                chart_cache=None, chart_points=None, download_concurrency=2,
+                summary_concurrency=2, email_concurrency=1, dry_run=False,
+                verbose=False):
+    """
+    Download, summarize and email the reports of many vendors at once.
+
+    Every vendor runs concurrently, and each stage runs for at most its
+    `*_concurrency` vendors at a time. The vendors share S3 connections per
+    AWS account and a pool of `smtp_connections` SMTP connections, see
+    `delivery.SMTPPool`. A vendor that fails does not
+    stop the others. `breakdowns` is a list of (name, grouping) tuples the
+    emailed and exported summaries are broken down by. With
+    `export_formats`, each vendor's summaries are written back to its
+    bucket, see `exports.export_reports`.
+
+    Returns the status of every vendor, see `format_status`.
+    """
+    limits = {
+        'download': threading.BoundedSemaphore(download_concurrency),
+        'summary': threading.BoundedSemaphore(summary_concurrency),
+        'email': threading.BoundedSemaphore(email_concurrency),
+    }
+    settings = {
+        'download': download,
+        'granularities': list(granularities),
+        'cache': cache,
+        'engine': engine,
+        'fetch_concurrency': fetch_concurrency,
+        'parse_processes': parse_processes,
+        'export_formats': list(export_formats),
+        'downloader': downloader,
+        'breakdowns': list(breakdowns),
+        'chart_backend': chart_backend,
+        'chart_cache': chart_cache,
+        'chart_points': chart_points,
+        'email_from': email_from,
+        'dry_run': dry_run,
+        'verbose': verbose,
+    }
+
+    s3 = S3Pool()
+    smtp = None
+    if smtp_host:
+        smtp = SMTPPool(
+            smtp_host, smtp_port, login=smtp_login, password=smtp_password,
+            size=smtp_connections, retries=smtp_retries, starttls=smtp_starttls)
+
+    pool = ThreadPool(len(vendors) or 1)
+    try:
+        return pool.map(
+            lambda vendor: _run_vendor(vendor, s3, smtp, limits, settings),
+            vendors)
+    finally:
+        pool.terminate()
+        pool.join()
+        if smtp is not None:
+            smtp.close()
+
+
+def format_status(statuses):
+    """Summarize the outcome of `run_vendors` as a table."""
+    lines = ['Vendor\tStatus\t' + '\t'.join(STAGES)]
+    for status in statuses:
+        elapsed = dict(status['stages'])
+        lines.append('{}\t{}\t{}'.format(
+            status['name'],
+            'failed' if status['error'] else 'ok',
+            '\t'.join(
+                '{:.1f}s'.format(elapsed[s]) if s in elapsed else '-'
+                for s in STAGES),
+        ))
+
+    failed = [s for s in statuses if s['error']]
+    lines.append('{} of {} vendors succeeded.'.format(
+        len(statuses) - len(failed), len(statuses)))
+    for status in failed:
+        lines.append('{}: {}'.format(status['name'], status['error']))
+
+    return '\n'.join(lines)
@@ -0,0 +1,139 @@
+import array
+
+
+# The columns of a report, in the order of its rows
+COLUMNS = ('installs', 'updates', 'edu', 'cumulative')
+
+# The columns of a report's rows when they start with their period
+SERIES_COLUMNS = ('date',) + COLUMNS
+
+# Signed 64 bit integers on the platforms the reporter runs on
+TYPECODE = 'l'
+
+
+class Series(object):
+    """A report's (installs, updates, edu, cumulative) counts by period.
+
+    The counts are kept in one integer array per column instead of a tuple
+    per period, and the periods ('%Y/%m/%d' strings, in order) are indexed
+    so looking one up is O(1). A series reads like the OrderedDict reports
+    used to be: `keys`, `items`, `iteritems`, `series[period]`, `get`, `in`
+    and `len` all work.
+
+    Slicing a series (`series[-90:]`) returns a window that shares the
+    arrays and the index of the series it was taken from, so windows cost
+    the same however long the history is.
+    """
+
+    __slots__ = ('periods', 'columns', 'index', 'start', 'stop')
+
+    def __init__(self, periods=None, columns=None, index=None, start=0, stop=None):
+        self.periods = periods if periods is not None else []
+        self.columns = columns if columns is not None else tuple(
+            array.array(TYPECODE) for column in COLUMNS)
+        if index is None:
+            index = dict((period, i) for i, period in enumerate(self.periods))
+        self.index = index
+        self.start = start
+        self.stop = len(self.periods) if stop is None else stop
+
+    @classmethod
+    def from_items(cls, items):
+        """Build a series from (period, (installs, updates, edu, cumulative))
+        items in period order."""
+        series = cls()
+        for period, row in items:
+            series.append(period, row)
+        return series
+
+    def append(self, period, row):
+        """Add the `row` of counts of a period after the last one."""
+        if self.stop != len(self.periods):
+            raise Exception('Unable to append to a window of a series.')
+        if period in self.index:
+            raise Exception('The series already has {}.'.format(period))
+        self.index[period] = len(self.periods)
+        self.periods.append(period)
+        for column, count in zip(self.columns, row):
+            column.append(count)
+        self.stop += 1
+
+    def position(self, period):
+        """Return the position of `period` in this series, or None."""
+        i = self.index.get(period)
+        if i is None or not self.start <= i < self.stop:
+            return None
+        return i - self.start
+
+    def last(self):
+        """Return the counts of the last period."""
+        if not len(self):
+            raise KeyError('The series is empty.')
+        return self._row(self.stop - 1)
+
+    def column(self, name):
+        """Return the counts of the column `name` as a list."""
+        return self.columns[COLUMNS.index(name)][self.start:self.stop].tolist()
+
+    def _row(self, i):
+        return tuple(column[i] for column in self.columns)
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __contains__(self, period):
+        return self.position(period) is not None
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise Exception('Series windows cannot have a step.')
+            stop = max(start, stop)
+            return Series(
+                self.periods, self.columns, self.index,
+                self.start + start, self.start + stop)
+
+        i = self.position(key)
+        if i is None:
+            raise KeyError(key)
+        return self._row(self.start + i)
+
+    def get(self, period, default=None):
+        i = self.position(period)
+        return default if i is None else self._row(self.start + i)
+
+    def iterkeys(self):
+        return iter(self.periods[self.start:self.stop])
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        for i in xrange(self.start, self.stop):
+            yield self._row(i)
+
+    def iteritems(self):
+        for i in xrange(self.start, self.stop):
+            yield self.periods[i], self._row(i)
+
+    def keys(self):
+        return self.periods[self.start:self.stop]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __eq__(self, other):
+        if not hasattr(other, 'iteritems'):
+            return NotImplemented
+        return len(self) == len(other) and all(
+            a == b for a, b in zip(self.iteritems(), other.iteritems()))
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return 'Series({!r})'.format(self.items())
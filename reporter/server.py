@@ -0,0 +1,345 @@
+import BaseHTTPServer
+import SocketServer
+import collections
+import datetime
+import hashlib
+import json
+import sys
+import threading
+import time
+import traceback
+import urlparse
+
+from charts import CHART_MAX_POINTS, render_charts
+from metrics import METRICS
+from reports import (
+    GRANULARITIES, _parse_keys, _report_keys, email_report, get_engine,
+    link_for_latest_report, report_chart_specs)
+from series import SERIES_COLUMNS
+
+
+# Seconds between polls of the bucket for new reports
+POLL_INTERVAL = 300
+
+
+class ReportService(object):
+    """Report aggregates kept in memory and updated as reports arrive.
+
+    The reports are aggregated once when the service starts. After that,
+    each `refresh` reads the report manifest (or lists the bucket) and only
+    downloads the reports that were added or changed since the last one.
+    Their totals are folded into the daily totals in memory, and the totals
+    of reports that changed or were removed are taken back out. The
+    per-report totals are also stored in the `AggregateCache`, so a
+    restarted service with a saved cache downloads nothing it already
+    parsed.
+    """
+
+    def __init__(self, bucket, cache, engine='python', concurrency=1,
+                 processes=1, save_cache=None, chart_backend='google',
+                 chart_cache=None, chart_points=CHART_MAX_POINTS,
+                 email_options=None, verbose=False):
+        self.bucket = bucket
+        self.cache = cache
+        self.engine = engine
+        self.concurrency = concurrency
+        self.processes = processes
+        self.save_cache = save_cache
+        self.chart_backend = chart_backend
+        self.chart_cache = chart_cache
+        self.chart_points = chart_points
+        self.email_options = email_options
+        self.verbose = verbose
+
+        # Guards the state below
+        self.lock = threading.Lock()
+        # Only one refresh runs at a time
+        self.refresh_lock = threading.Lock()
+
+        # The ETag and totals of each report folded into the daily totals
+        self.partials = {}
+        self.totals = {}
+        self.contributors = collections.defaultdict(int)
+        self.reports = {}
+        self.version = self._version()
+        self.refreshed = None
+
+    def _version(self):
+        """Identify the loaded data by the ETags of its reports."""
+        digest = hashlib.md5()
+        for name, (etag, totals) in sorted(self.partials.iteritems()):
+            digest.update('{}\0{}\0'.format(name, etag))
+        return digest.hexdigest()[:16]
+
+    def _fold(self, partial, sign):
+        """Add a report's totals into the daily totals, or take them out."""
+        for date, counts in partial.iteritems():
+            totals = self.totals.get(date)
+            if totals is None:
+                totals = self.totals[date] = [0, 0, 0]
+            for i, count in enumerate(counts):
+                totals[i] += sign * count
+
+            # Days no report mentions any more are dropped
+            self.contributors[date] += sign
+            if not self.contributors[date]:
+                del self.contributors[date]
+                del self.totals[date]
+
+    def refresh(self):
+        """
+        Fold the reports added, changed or removed since the last refresh
+        into the totals.
+
+        Returns the numbers of added, changed, removed and downloaded
+        reports.
+        """
+        with self.refresh_lock:
+            keys = _report_keys(self.bucket)
+            current = dict((key.name, key) for key in keys)
+            removed = [name for name in self.partials if name not in current]
+            updated = [
+                key for key in keys
+                if self.partials.get(key.name, (None, None))[0] != key.etag
+            ]
+
+            aggregate_lines, _ = get_engine(self.engine)
+            partials = []
+            missing = []
+            for key in updated:
+                totals = self.cache.get(key.name, key.etag)
+                if totals is None:
+                    missing.append(key)
+                else:
+                    partials.append((key, totals))
+
+            parsed = _parse_keys(
+                self.bucket, missing, aggregate_lines,
+                concurrency=self.concurrency, processes=self.processes,
+                engine=self.engine)
+            for key, totals in parsed:
+                self.cache.set(key.name, key.etag, totals)
+                partials.append((key, totals))
+
+            changes = {
+                'added': len([k for k in updated if k.name not in self.partials]),
+                'changed': len([k for k in updated if k.name in self.partials]),
+                'removed': len(removed),
+                'downloaded': len(missing),
+            }
+
+            with self.lock:
+                for name in removed + [key.name for key, totals in partials]:
+                    if name in self.partials:
+                        self._fold(self.partials.pop(name)[1], -1)
+                for key, totals in partials:
+                    self._fold(totals, 1)
+                    self.partials[key.name] = (key.etag, totals)
+
+                if removed or partials:
+                    self.version = self._version()
+                    _, rollup = get_engine(self.engine)
+                    with METRICS.timer('aggregate'):
+                        self.reports = rollup(self.totals, GRANULARITIES.keys())
+                self.refreshed = datetime.datetime.utcnow()
+
+            self.cache.prune(current)
+            if self.save_cache is not None and self.cache.dirty:
+                self.save_cache(self.cache)
+
+        if self.verbose and (removed or partials):
+            print('Refreshed the reports: {added} added, {changed} changed, '
+                  '{removed} removed, {downloaded} downloaded.'.format(**changes))
+        return changes
+
+    def snapshot(self):
+        """Return the version of the data and its reports by granularity."""
+        with self.lock:
+            return self.version, self.reports
+
+    def status(self):
+        with self.lock:
+            return {
+                'version': self.version,
+                'reports': len(self.partials),
+                'days': len(self.totals),
+                'refreshed': self.refreshed.strftime('%Y-%m-%dT%H:%M:%SZ') if self.refreshed else None,
+            }
+
+    def chart(self, reports, name):
+        """Render the chart `name` of `reports`, or return None if there is
+        no such chart."""
+        specs = report_chart_specs(
+            reports.get('daily'), reports.get('weekly'),
+            chart_points=self.chart_points)
+        specs = [spec for spec in specs if spec['name'] == name]
+        if not specs:
+            return None
+        return render_charts(
+            specs, backend=self.chart_backend, cache=self.chart_cache)[name]
+
+    def send_email(self):
+        """Email the current daily and weekly reports."""
+        if not self.email_options:
+            raise Exception('No email to send the report to.')
+        version, reports = self.snapshot()
+        email_report(
+            download_link=link_for_latest_report(self.bucket),
+            daily_report=reports.get('daily'),
+            weekly_report=reports.get('weekly'),
+            chart_backend=self.chart_backend,
+            chart_cache=self.chart_cache,
+            chart_points=self.chart_points,
+            verbose=self.verbose,
+            **self.email_options)
+        return {'sent': self.email_options['email']}
+
+
+class ReportRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve the reports of the server's `ReportService`.
+
+        GET  /status                 the loaded reports and last refresh
+        GET  /reports/<period>.json  a daily, weekly, monthly or yearly
+                                     series, ?last=N for the latest periods
+        GET  /charts/<name>.png      the daily, weekly, cumulative or
+                                     daily-recent chart
+        POST /refresh                fold in new reports now, as a push hook
+        POST /email                  email the current report
+
+    Reports and charts have an ETag that changes with the loaded reports,
+    so polling with If-None-Match costs a 304 until new reports arrive.
+    """
+
+    server_version = 'iTunesReporter/1.0'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _send(self, status, body, content_type='application/json', etag=None):
+        self.send_response(status)
+        if etag is not None:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        if body is not None:
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body is not None:
+            self.wfile.write(body)
+
+    def _send_json(self, status, data, etag=None):
+        self._send(status, json.dumps(data, sort_keys=True), etag=etag)
+
+    def _not_modified(self, etag):
+        matches = [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]
+        return etag in matches or '*' in matches
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+
+        if url.path == '/status':
+            return self._send_json(200, self.server.service.status())
+
+        version, reports = self.server.service.snapshot()
+        etag = '"{}-{}"'.format(version, hashlib.md5(self.path).hexdigest()[:8])
+        if self._not_modified(etag):
+            return self._send(304, None, etag=etag)
+
+        parts = url.path.strip('/').split('/')
+        if len(parts) != 2:
+            return self._send_json(404, {'error': 'Not found.'})
+        kind, filename = parts
+
+        if kind == 'reports' and filename.endswith('.json'):
+            report = reports.get(filename[:-len('.json')])
+            if report is None:
+                return self._send_json(404, {'error': 'Unknown report period.'})
+            rows = [[date] + list(counts) for date, counts in report.iteritems()]
+            if 'last' in query:
+                last = query['last'][0]
+                if not last.isdigit():
+                    return self._send_json(400, {'error': 'last must be a number of periods.'})
+                rows = rows[len(rows) - min(int(last), len(rows)):]
+            return self._send_json(200, {'columns': SERIES_COLUMNS, 'rows': rows}, etag=etag)
+
+        if kind == 'charts' and filename.endswith('.png') and reports:
+            png = self.server.service.chart(reports, filename[:-len('.png')])
+            if png is not None:
+                return self._send(200, png, content_type='image/png', etag=etag)
+
+        return self._send_json(404, {'error': 'Not found.'})
+
+    def do_POST(self):
+        token = self.server.token
+        if token and self.headers.get('Authorization') != 'Bearer {}'.format(token):
+            return self._send_json(401, {'error': 'Unauthorized.'})
+
+        actions = {
+            '/refresh': self.server.service.refresh,
+            '/email': self.server.service.send_email,
+        }
+        action = actions.get(urlparse.urlparse(self.path).path)
+        if action is None:
+            return self._send_json(404, {'error': 'Not found.'})
+
+        try:
+            result = action()
+        except Exception as e:
+            traceback.print_exc()
+            return self._send_json(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+        self._send_json(200, result)
+
+
+class ReportServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """An HTTP server handling each request in its own thread."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, service, token=None, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ReportRequestHandler)
+        self.service = service
+        self.token = token
+        self.verbose = verbose
+
+
+def _poll(service, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            service.refresh()
+        except Exception:
+            # Keep serving the last reports, and try again next time
+            sys.stderr.write('Unable to refresh the reports:\n{}'.format(
+                traceback.format_exc()))
+
+
+def serve(service, address, poll_interval=POLL_INTERVAL, token=None,
+          verbose=False):
+    """
+    Load the reports and serve them at `address` ('host:port') until
+    interrupted, refreshing them every `poll_interval` seconds (never if 0).
+
+    With a `token`, POST requests need an 'Authorization: Bearer <token>'
+    header.
+    """
+    host, _, port = address.rpartition(':')
+    server = ReportServer((host, int(port)), service, token=token, verbose=verbose)
+
+    service.refresh()
+
+    if poll_interval:
+        poller = threading.Thread(target=_poll, args=(service, poll_interval))
+        poller.daemon = True
+        poller.start()
+
+    if verbose:
+        print('Serving the reports on http://{}:{}/'.format(*server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,452 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
+import urllib
+
+from boto.s3.connection import OrdinaryCallingFormat, S3Connection
+from boto.utils import compute_md5
+
+from metrics import METRICS
+
+
+# The disk space a mirror uses before evicting its least recently used files
+MIRROR_BUDGET_BYTES = 1024 * 1024 * 1024
+
+STORAGE_CHUNK_SIZE = 64 * 1024
+
+# The file next to each mirrored object recording its ETag and size
+MIRROR_META_SUFFIX = '.mirror.json'
+
+
+def _local_path(root, name):
+    return os.path.join(root, *name.split('/'))
+
+
+def _write_atomically(path, chunks):
+    """
+    Write `chunks` to `path` through a temporary file in the same directory.
+
+    Readers never see a partly written file. Returns the bytes written.
+    """
+    dir = os.path.dirname(path)
+    if not os.path.isdir(dir):
+        try:
+            os.makedirs(dir)
+        except OSError:
+            # Another thread or process created it first
+            if not os.path.isdir(dir):
+                raise
+
+    # Temporary files start with a dot, so listings skip them
+    fd, tmppath = tempfile.mkstemp(prefix='.{}.'.format(os.path.basename(path)), dir=dir)
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        os.rename(tmppath, path)
+    except:
+        os.remove(tmppath)
+        raise
+    return size
+
+
+def _iter_file_chunks(f, chunk_size=STORAGE_CHUNK_SIZE):
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+class LocalKey(object):
+    """A file in a `LocalBucket`, with the parts of the boto Key API that
+    the reporter uses."""
+
+    def __init__(self, bucket, name=None):
+        self.bucket = bucket
+        self.name = name
+        self.size = None
+        self.last_modified = None
+        self._etag = None
+        self._file = None
+        if name is not None and os.path.isfile(self.path):
+            self._stat()
+
+    @property
+    def key(self):
+        return self.name
+
+    @key.setter
+    def key(self, name):
+        self.name = name
+
+    @property
+    def path(self):
+        return _local_path(self.bucket.path, self.name)
+
+    @property
+    def etag(self):
+        # Like S3, the ETag of a file is the MD5 of its contents
+        if self._etag is None and os.path.isfile(self.path):
+            with open(self.path, 'rb') as f:
+                self._etag = '"{}"'.format(compute_md5(f)[0])
+        return self._etag
+
+    @etag.setter
+    def etag(self, etag):
+        self._etag = etag
+
+    def _stat(self):
+        stat = os.stat(self.path)
+        self.size = stat.st_size
+        self.last_modified = datetime.datetime.utcfromtimestamp(
+            stat.st_mtime).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        self._etag = None
+
+    def open(self, mode='r'):
+        if self._file is None:
+            self._file = open(self.path, 'rb')
+
+    def read(self, size=0):
+        self.open()
+        return self._file.read(size) if size else self._file.read()
+
+    def close(self, fast=False):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def get_contents_as_string(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def get_contents_to_filename(self, filename):
+        shutil.copyfile(self.path, filename)
+
+    def compute_md5(self, fp):
+        # Like boto's Key.compute_md5, without the size
+        return compute_md5(fp)[:2]
+
+    def _write(self, chunks):
+        _write_atomically(self.path, chunks)
+        self._stat()
+
+    def set_contents_from_string(self, data, replace=True, **kwargs):
+        self._write([data])
+
+    def set_contents_from_file(self, fp, replace=True, **kwargs):
+        self._write(_iter_file_chunks(fp))
+
+    def set_contents_from_filename(self, filename, replace=True, **kwargs):
+        with open(filename, 'rb') as f:
+            self._write(_iter_file_chunks(f))
+
+    def generate_url(self, expires_in=0, **kwargs):
+        return 'file:{}'.format(urllib.pathname2url(os.path.abspath(self.path)))
+
+    def delete(self):
+        return self.bucket.delete_key(self.name)
+
+
+class LocalBucket(object):
+    """A directory standing in for an S3 bucket.
+
+    Key names map to paths under the directory, so reports can be stored
+    and summarized without S3, for example when working offline.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(os.path.abspath(path))
+
+    def list(self, prefix=''):
+        names = []
+        for root, dirs, files in os.walk(self.path):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for filename in files:
+                if filename.startswith('.'):
+                    continue
+                name = os.path.relpath(os.path.join(root, filename), self.path)
+                name = name.replace(os.sep, '/')
+                if name.startswith(prefix):
+                    names.append(name)
+        return [LocalKey(self, key_name) for key_name in sorted(names)]
+
+    def get_key(self, name, validate=True):
+        if not os.path.isfile(_local_path(self.path, name)):
+            return None
+        return LocalKey(self, name)
+
+    def new_key(self, name=None):
+        return LocalKey(self, name)
+
+    def delete_key(self, name):
+        path = _local_path(self.path, name)
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def copy_key(self, new_name, src_bucket_name, src_key_name, **kwargs):
+        if src_bucket_name != self.name:
+            raise Exception('Unable to copy {} from the bucket {} into {}.'.format(
+                src_key_name, src_bucket_name, self.path))
+        key = self.new_key(new_name)
+        key.set_contents_from_filename(_local_path(self.path, src_key_name))
+        return key
+
+
+class MirroredKey(object):
+    """A key of a `MirroredBucket`.
+
+    Reads come from the mirror, and everything else goes to the key of the
+    remote bucket.
+    """
+
+    def __init__(self, bucket, remote):
+        object.__setattr__(self, '_bucket', bucket)
+        object.__setattr__(self, '_remote', remote)
+        object.__setattr__(self, '_file', None)
+
+    def __getattr__(self, name):
+        return getattr(self._remote, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._remote, name, value)
+
+    def open(self, mode='r'):
+        if self._file is None:
+            object.__setattr__(self, '_file', open(self._bucket.fetch(self), 'rb'))
+
+    def read(self, size=0):
+        self.open()
+        return self._file.read(size) if size else self._file.read()
+
+    def close(self, fast=False):
+        if self._file is not None:
+            self._file.close()
+            object.__setattr__(self, '_file', None)
+
+    def get_contents_as_string(self):
+        with open(self._bucket.fetch(self), 'rb') as f:
+            return f.read()
+
+    def get_contents_to_filename(self, filename):
+        shutil.copyfile(self._bucket.fetch(self), filename)
+
+    def set_contents_from_string(self, data, *args, **kwargs):
+        self._bucket.forget(self.name)
+        result = self._remote.set_contents_from_string(data, *args, **kwargs)
+        self._bucket.store(self, [data])
+        return result
+
+    def set_contents_from_filename(self, filename, *args, **kwargs):
+        self._bucket.forget(self.name)
+        result = self._remote.set_contents_from_filename(filename, *args, **kwargs)
+        with open(filename, 'rb') as f:
+            self._bucket.store(self, _iter_file_chunks(f))
+        return result
+
+    def set_contents_from_file(self, fp, *args, **kwargs):
+        self._bucket.forget(self.name)
+        return self._remote.set_contents_from_file(fp, *args, **kwargs)
+
+    def delete(self):
+        return self._bucket.delete_key(self.name)
+
+
+class MirroredBucket(object):
+    """A bucket read through a mirror of its objects on local disk.
+
+    Objects are downloaded into the mirror directory the first time they
+    are read. A mirrored copy is only used while its ETag and size match
+    the remote object's, so changed objects are downloaded again. The ETag
+    and size usually come from a listing or the report manifest. Keys
+    without them cost a HEAD request.
+
+    Once the mirror holds more than `budget` bytes, its least recently read
+    files are evicted. Writes go to the remote bucket, and uploads of
+    strings and files are mirrored as they are written. Several threads and
+    processes can share a mirror directory.
+    """
+
+    def __init__(self, remote, path, budget=MIRROR_BUDGET_BYTES):
+        self.remote = remote
+        self.path = path
+        self.budget = budget
+        self.name = remote.name
+        self.lock = threading.Lock()
+        self.used = None
+
+    def __getattr__(self, name):
+        return getattr(self.remote, name)
+
+    def _wrap(self, key):
+        return None if key is None else MirroredKey(self, key)
+
+    def list(self, prefix=''):
+        return [self._wrap(key) for key in self.remote.list(prefix=prefix)]
+
+    def get_key(self, name, validate=True):
+        return self._wrap(self.remote.get_key(name, validate=validate))
+
+    def new_key(self, name=None):
+        return self._wrap(self.remote.new_key(name))
+
+    def delete_key(self, name):
+        self.forget(name)
+        return self.remote.delete_key(name)
+
+    def copy_key(self, new_name, src_bucket_name, src_key_name, **kwargs):
+        self.forget(new_name)
+        return self._wrap(self.remote.copy_key(
+            new_name, src_bucket_name, src_key_name, **kwargs))
+
+    def _paths(self, name):
+        path = _local_path(self.path, name)
+        return path, path + MIRROR_META_SUFFIX
+
+    def _read_meta(self, name):
+        try:
+            with open(self._paths(name)[1]) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def fetch(self, key):
+        """Return the path of the mirrored copy of `key`, downloading it if
+        the mirror has no valid copy."""
+        if key.etag is None:
+            with METRICS.timer('mirror', requests=1):
+                head = self.remote.get_key(key.name)
+            if head is None:
+                raise Exception('Unable to find {} in {}.'.format(key.name, self.name))
+            key.etag, key.size = head.etag, head.size
+
+        path, meta_path = self._paths(key.name)
+        meta = self._read_meta(key.name)
+        if (meta is not None and meta['etag'] == key.etag and
+                (key.size is None or meta['size'] == key.size) and
+                os.path.isfile(path)):
+            # Mark the copy as recently read for eviction
+            os.utime(path, None)
+            METRICS.add('mirror', hits=1)
+            return path
+
+        METRICS.add('mirror', misses=1)
+        remote = key._remote
+        remote.open('r')
+        try:
+            size = self._store(key.name, key.etag, _iter_file_chunks(remote))
+        finally:
+            remote.close()
+
+        if key.size is not None and size != key.size:
+            self.forget(key.name)
+            raise Exception('Downloaded {} bytes of {}, expected {}.'.format(
+                size, key.name, key.size))
+        return path
+
+    def store(self, key, chunks):
+        """Mirror the contents of `key` that were just uploaded."""
+        if key.etag is not None:
+            self._store(key.name, key.etag, chunks)
+
+    def _store(self, name, etag, chunks):
+        path, meta_path = self._paths(name)
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        size = _write_atomically(path, chunks)
+        _write_atomically(meta_path, [json.dumps({'etag': etag, 'size': size})])
+        METRICS.add('mirror', objects=1, bytes=size)
+
+        with self.lock:
+            if self.used is not None:
+                self.used += size
+        self.evict(keep=path)
+        return size
+
+    def forget(self, name):
+        """Drop the mirrored copy of `name`, if any."""
+        for path in reversed(self._paths(name)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _mirrored_files(self):
+        """Return (last read, size, path) for every mirrored object."""
+        files = []
+        for root, dirs, filenames in os.walk(self.path):
+            for filename in filenames:
+                if filename.startswith('.') or filename.endswith(MIRROR_META_SUFFIX):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def evict(self, keep=None):
+        """Delete the least recently read copies until the mirror fits its
+        budget, never deleting the copy at `keep`."""
+        with self.lock:
+            # The mirror is only scanned when it may be over budget
+            if self.used is not None and self.used <= self.budget:
+                return
+
+            files = self._mirrored_files()
+            self.used = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if self.used <= self.budget:
+                    break
+                if path == keep:
+                    continue
+                for p in (path + MIRROR_META_SUFFIX, path):
+                    if os.path.exists(p):
+                        os.remove(p)
+                self.used -= size
+                METRICS.add('mirror', evicted=1)
+
+
+def open_storage(key=None, secret=None, bucket=None, directory=None,
+                 mirror=None, mirror_budget=MIRROR_BUDGET_BYTES):
+    """
+    Open where the reports are stored.
+
+    That is the local `directory` if given, or else the S3 `bucket`. With a
+    `mirror` directory, reads go through a `MirroredBucket`.
+    """
+    if directory:
+        storage = LocalBucket(directory)
+    else:
+        s3 = S3Connection(key, secret, calling_format=OrdinaryCallingFormat())
+        storage = s3.get_bucket(bucket)
+
+    if mirror:
+        storage = MirroredBucket(storage, mirror, budget=mirror_budget)
+    return storage
+
+
+def storage_source(bucket):
+    """Describe `bucket` so another process can open it with `open_source`."""
+    if isinstance(bucket, MirroredBucket):
+        return ('mirror', storage_source(bucket.remote), bucket.path, bucket.budget)
+    if isinstance(bucket, LocalBucket):
+        return ('local', bucket.path)
+    connection = bucket.connection
+    return ('s3', connection.aws_access_key_id, connection.aws_secret_access_key, bucket.name)
+
+
+def open_source(source):
+    """Open a bucket described by `storage_source`."""
+    kind = source[0]
+    if kind == 'mirror':
+        return MirroredBucket(open_source(source[1]), source[2], budget=source[3])
+    if kind == 'local':
+        return LocalBucket(source[1])
+    s3 = S3Connection(source[1], source[2], calling_format=OrdinaryCallingFormat())
+    return s3.get_bucket(source[3], validate=False)
@@ -0,0 +1,131 @@
+import collections
+import datetime
+import math
+
+
+# The days of the moving averages
+SHORT_AVERAGE_DAYS = 7
+LONG_AVERAGE_DAYS = 28
+
+# The days before the latest day its z-score is measured against
+BASELINE_DAYS = 28
+
+# How many standard deviations from the baseline make a day unusual
+ANOMALY_Z = 3.0
+
+# A year earlier on the same weekday
+YEAR_DAYS = 364
+
+# The (lag, length) of the windows kept, each summing `length` days up to
+# `lag` days before the latest day
+WINDOWS = {
+    'short': (0, SHORT_AVERAGE_DAYS),
+    'long': (0, LONG_AVERAGE_DAYS),
+    'previous_week': (7, 7),
+    'previous_year': (YEAR_DAYS, 7),
+    'baseline': (1, BASELINE_DAYS),
+}
+
+# The days of history the windows need, plus the day leaving them
+HISTORY_DAYS = max(lag + length for lag, length in WINDOWS.itervalues()) + 1
+
+
+class RollingStats(object):
+    """Moving averages, deltas and a z-score of a daily count.
+
+    Days are added in date order, and missing days count as zero. Each
+    window keeps a running sum and sum of squares, updated with the day
+    entering it and the day leaving it, so adding a day costs the same
+    however long the history is, and only the last HISTORY_DAYS are kept.
+    """
+
+    def __init__(self):
+        self.date = None
+        self.days = 0
+        self.history = collections.deque(maxlen=HISTORY_DAYS)
+        self.sums = dict((name, [0, 0]) for name in WINDOWS)
+
+    def add(self, date, count):
+        """Add the `count` of `date`, a datetime.date after the last one."""
+        if self.date is not None:
+            gap = (date - self.date).days
+            if gap < 1:
+                raise Exception('{} does not follow {}.'.format(date, self.date))
+            # After HISTORY_DAYS zeros every window is zero anyway
+            for _ in xrange(min(gap - 1, HISTORY_DAYS)):
+                self._push(0)
+            self.days += max(gap - 1 - HISTORY_DAYS, 0)
+        self._push(count)
+        self.date = date
+
+    def _push(self, count):
+        history = self.history
+        history.append(count)
+        size = len(history)
+        for name, (lag, length) in WINDOWS.iteritems():
+            sums = self.sums[name]
+            if size > lag:
+                entering = history[-1 - lag]
+                sums[0] += entering
+                sums[1] += entering * entering
+            if size > lag + length:
+                leaving = history[-1 - lag - length]
+                sums[0] -= leaving
+                sums[1] -= leaving * leaving
+        self.days += 1
+
+    def _total(self, name):
+        """The sum of a window, or None before it is full."""
+        lag, length = WINDOWS[name]
+        return self.sums[name][0] if self.days >= lag + length else None
+
+    def average(self, name):
+        total = self._total(name)
+        return None if total is None else float(total) / WINDOWS[name][1]
+
+    def change(self, name, base):
+        """The relative change of the window `name` from the window `base`."""
+        total, base_total = self._total(name), self._total(base)
+        if total is None or not base_total:
+            return None
+        return float(total) / base_total - 1
+
+    def z_score(self):
+        """How many standard deviations the latest day is from the baseline."""
+        total = self._total('baseline')
+        if total is None:
+            return None
+        mean = float(total) / BASELINE_DAYS
+        variance = float(self.sums['baseline'][1]) / BASELINE_DAYS - mean * mean
+        if variance <= 0:
+            return None
+        return (self.history[-1] - mean) / math.sqrt(variance)
+
+    def stats(self):
+        """Return the statistics of the latest day as a dict."""
+        z = self.z_score()
+        return {
+            'date': self.date,
+            'short_average': self.average('short'),
+            'long_average': self.average('long'),
+            'week_over_week': self.change('short', 'previous_week'),
+            'year_over_year': self.change('short', 'previous_year'),
+            'z_score': z,
+            'anomaly': z is not None and abs(z) >= ANOMALY_Z,
+        }
+
+
+def daily_trends(daily_report, column=0):
+    """
+    Return the `RollingStats.stats` of the latest day of a daily report.
+
+    Only the last HISTORY_DAYS periods of the report are read, so the cost
+    does not grow with the history. `column` is the position of the count
+    in each row, installs by default. Reports rolled up from a stream of
+    daily totals can instead feed a `RollingStats` as each day goes by, see
+    `rollup_ordered_totals`.
+    """
+    stats = RollingStats()
+    for period, counts in daily_report[-HISTORY_DAYS:].iteritems():
+        stats.add(datetime.datetime.strptime(period, '%Y/%m/%d').date(), counts[column])
+    return stats.stats()
@@ -0,0 +1,199 @@
+import csv
+import os
+import sqlite3
+import sys
+
+from metrics import METRICS
+from reports import (
+    COLUMN_APPLE_IDENTIFIER, COLUMN_COUNTRY, COLUMN_DATE, COLUMN_DOWNLOAD_TYPE,
+    COLUMN_DOWNLOADS, COLUMN_PROMO, COLUMN_SKU, COLUMN_TITLE, COLUMN_VERSION,
+    DIMENSIONS, DOWNLOAD_TYPE_INSTALL, DOWNLOAD_TYPE_UPGRADE, PROMO_TYPE_EDU,
+    _fetch_reports, _iter_report_lines, _report_keys, datestr_to_datetime,
+    datetime_to_str, exclude_headers)
+
+
+WAREHOUSE_KEY = 'warehouse/reports.sqlite3'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ingested_keys (
+    name TEXT PRIMARY KEY,
+    etag TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS report_rows (
+    source TEXT NOT NULL,
+    date TEXT NOT NULL,
+    sku TEXT,
+    title TEXT,
+    version TEXT,
+    download_type TEXT,
+    units INTEGER NOT NULL,
+    country TEXT,
+    apple_identifier TEXT,
+    promo_code TEXT
+);
+
+CREATE INDEX IF NOT EXISTS report_rows_source ON report_rows (source);
+CREATE INDEX IF NOT EXISTS report_rows_date ON report_rows (date);
+CREATE INDEX IF NOT EXISTS report_rows_download_type ON report_rows (download_type, date);
+CREATE INDEX IF NOT EXISTS report_rows_promo_code ON report_rows (promo_code);
+CREATE INDEX IF NOT EXISTS report_rows_version ON report_rows (version);
+CREATE INDEX IF NOT EXISTS report_rows_sku ON report_rows (sku);
+"""
+
+DAILY_TOTALS_QUERY = """
+SELECT date,
+    SUM(CASE WHEN download_type = :install THEN units ELSE 0 END),
+    SUM(CASE WHEN download_type = :upgrade THEN units ELSE 0 END),
+    SUM(CASE WHEN download_type = :install AND promo_code = :edu THEN units ELSE 0 END)
+FROM report_rows
+WHERE download_type IN (:install, :upgrade)
+GROUP BY date
+"""
+
+GROUPED_TOTALS_QUERY = """
+SELECT date{columns},
+    SUM(CASE WHEN download_type = :install THEN units ELSE 0 END),
+    SUM(CASE WHEN download_type = :upgrade THEN units ELSE 0 END),
+    SUM(CASE WHEN download_type = :install AND promo_code = :edu THEN units ELSE 0 END)
+FROM report_rows
+WHERE download_type IN (:install, :upgrade)
+GROUP BY date{columns}
+"""
+
+
+def _iter_warehouse_rows(name, lines):
+    dates = {}
+    for row in csv.reader(exclude_headers(lines), delimiter='\t'):
+        datestr = row[COLUMN_DATE]
+        date = dates.get(datestr)
+        if date is None:
+            date = dates[datestr] = datetime_to_str(datestr_to_datetime(datestr))
+
+        yield (
+            name,
+            date,
+            row[COLUMN_SKU],
+            row[COLUMN_TITLE],
+            row[COLUMN_VERSION],
+            row[COLUMN_DOWNLOAD_TYPE],
+            int(row[COLUMN_DOWNLOADS]),
+            row[COLUMN_COUNTRY],
+            row[COLUMN_APPLE_IDENTIFIER],
+            row[COLUMN_PROMO],
+        )
+
+
+class Warehouse(object):
+    """A SQLite database holding every row of the report files.
+
+    The database records the name and ETag of every ingested S3 key, so
+    ingestion only loads the reports that are new or have changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        # Report files are UTF-8, keep their fields as byte strings
+        self.db.text_factory = str
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def ingest(self, bucket, verbose=False, concurrency=1):
+        """Load the new and changed report files in `bucket`."""
+        if verbose:
+            print('Ingesting download reports from the files in {}...'.format(
+                bucket.name))
+
+        ingested = dict(self.db.execute('SELECT name, etag FROM ingested_keys'))
+
+        keys = list(_report_keys(bucket))
+        names = set(key.name for key in keys)
+        missing = [key for key in keys if ingested.get(key.name) != key.etag]
+
+        with self.db:
+            # Reports that are gone were compacted or removed
+            for name in set(ingested) - names:
+                self.db.execute('DELETE FROM report_rows WHERE source = ?', (name, ))
+                self.db.execute('DELETE FROM ingested_keys WHERE name = ?', (name, ))
+
+        for key, chunks in _fetch_reports(missing, concurrency=concurrency):
+            if verbose:
+                sys.stdout.write('.')
+                sys.stdout.flush()
+
+            # Each report is replaced in a single transaction
+            with self.db, METRICS.timer('parse'):
+                self.db.execute('DELETE FROM report_rows WHERE source = ?', (key.name, ))
+                self.db.executemany(
+                    'INSERT INTO report_rows VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    _iter_warehouse_rows(key.name, _iter_report_lines(chunks)))
+                self.db.execute(
+                    'INSERT OR REPLACE INTO ingested_keys VALUES (?, ?)',
+                    (key.name, key.etag))
+
+        if verbose:
+            print(' done, ingested {} of {} download reports.'.format(
+                len(missing), len(names)))
+
+    def aggregate(self):
+        """
+        Sums the installs, updates and educational installs by date.
+
+        Returns the same totals as `reports.aggregate_report` over every
+        ingested report.
+        """
+        cursor = self.db.execute(DAILY_TOTALS_QUERY, self._query_params())
+        return dict(
+            (date, [installs, updates, edu])
+            for date, installs, updates, edu in cursor
+        )
+
+    def group(self, groupings):
+        """
+        Sums the installs, updates and educational installs by date and by
+        each grouping of dimensions.
+
+        Returns the same totals as `reports.group_report` over every
+        ingested report.
+        """
+        groups = {}
+        for grouping in groupings:
+            grouping = tuple(grouping)
+            for dimension in grouping:
+                if dimension not in DIMENSIONS:
+                    raise Exception('Unknown report dimension: {}'.format(dimension))
+
+            query = GROUPED_TOTALS_QUERY.format(
+                columns=''.join(', {}'.format(d) for d in grouping))
+            groups[grouping] = dict(
+                (tuple(row[:-3]), list(row[-3:]))
+                for row in self.db.execute(query, self._query_params())
+            )
+        return groups
+
+    def _query_params(self):
+        return {
+            'install': DOWNLOAD_TYPE_INSTALL,
+            'upgrade': DOWNLOAD_TYPE_UPGRADE,
+            'edu': PROMO_TYPE_EDU,
+        }
+
+
+def download_warehouse(bucket, path, name=WAREHOUSE_KEY):
+    """Replace the database at `path` with the copy in `bucket`, if any."""
+    key = bucket.get_key(name)
+    if key is None:
+        return False
+    tmppath = '{}.tmp'.format(path)
+    key.get_contents_to_filename(tmppath)
+    os.rename(tmppath, path)
+    return True
+
+
+def upload_warehouse(bucket, path, name=WAREHOUSE_KEY):
+    """Store the database at `path` in `bucket`."""
+    key = bucket.new_key(name)
+    key.set_contents_from_filename(path, replace=True)
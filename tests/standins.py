@@ -0,0 +1,177 @@
+import BaseHTTPServer
+import asyncore
+import datetime
+import gzip
+import os
+import shutil
+import smtpd
+import SocketServer
+import StringIO
+import tempfile
+import threading
+import urlparse
+
+from reports import S3_PREFIX
+from storage import LocalBucket
+from synthetic import generate_reports
+
+
+def gzipped(text):
+    s = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=s, mode='wb', mtime=0) as gz:
+        gz.write(text)
+    return s.getvalue()
+
+
+class SyntheticReports(object):
+    """Synthetic reports in a local directory bucket, for a TestCase.
+
+    `setUp` writes `years` of reports ending on `end` under `reports_dir`,
+    and `bucket` is the bucket `open_bucket` returns for them.
+    """
+
+    years = 0.1
+    skus = 2
+    countries = 3
+    rows = 20
+    end = datetime.date(2015, 3, 10)
+
+    def setUp(self):
+        super(SyntheticReports, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.reports_dir = os.path.join(self.dir, S3_PREFIX)
+        generate_reports(
+            self.reports_dir, years=self.years, skus=self.skus,
+            countries=self.countries, rows=self.rows, end=self.end)
+        self.bucket = self.open_bucket()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        super(SyntheticReports, self).tearDown()
+
+    def open_bucket(self):
+        return LocalBucket(self.dir)
+
+
+class AutoingestionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep connections open, like the real service
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, headers, body=''):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = dict(
+            (name, values[0])
+            for name, values in urlparse.parse_qs(self.rfile.read(length)).iteritems())
+        server = self.server
+        with server.lock:
+            server.requests.append((self.client_address, form))
+            failing = server.failures > 0
+            server.failures -= 1
+
+        date = form.get('REPORTDATE', '20150101')
+        if failing:
+            return self._send(503, [])
+        if date in server.missing:
+            return self._send(200, [(
+                'ERRORMSG', 'There are no reports available to download for the selected period.')])
+        if date in server.errors:
+            return self._send(200, [('ERRORMSG', server.errors[date])])
+
+        name = 'S_D_{}_{}.txt.gz'.format(form['VNDNUMBER'], date)
+        self._send(200, [
+            ('filename', name),
+            ('Content-Type', 'application/a-gzip'),
+            # Sent like this by the service, but the report stays gzipped
+            ('Content-Encoding', 'gzip'),
+        ], server.reports.get(date, gzipped('report for {}\n'.format(date))))
+
+
+class AutoingestionStandIn(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A local Autoingestion service answering on a free port.
+
+    Reports the dates in `missing` as unavailable, answers the dates in
+    `errors` with their error message, and fails the next `failures`
+    requests with a 503. Every request is recorded in `requests`. Each
+    connection is served on its own thread, so clients can keep several
+    open at once.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), AutoingestionHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.reports = {}
+        self.missing = set()
+        self.errors = {}
+        self.failures = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/autoingestion.tft'.format(self.server_address[1])
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.serve_forever, args=(0.05, ))
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class SMTPStandIn(smtpd.SMTPServer):
+    """A local SMTP server keeping the messages it receives.
+
+    Refuses the messages to the addresses in `refused`, and counts the
+    connections it accepts in `connections`.
+    """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.messages = []
+        self.refused = set()
+        self.connections = 0
+        self.running = False
+
+    @property
+    def port(self):
+        return self.socket.getsockname()[1]
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if self.refused.intersection(rcpttos):
+            return '550 Refused'
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def _loop(self):
+        while self.running:
+            asyncore.loop(timeout=0.05, count=1)
+
+    def __enter__(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.running = False
+        self.thread.join()
+        asyncore.close_all()
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import requests
+
+from autoingestion import AutoingestionClient
+from tests.standins import AutoingestionStandIn, gzipped
+
+
+class AutoingestionClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.server = AutoingestionStandIn().__enter__()
+        self.client = AutoingestionClient(
+            'login', 'secret', url=self.server.url, retries=2, retry_backoff=0)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.__exit__()
+        shutil.rmtree(self.dir)
+
+    def test_download_keeps_the_report_gzipped(self):
+        self.server.reports['20150105'] = gzipped('a\tb\n')
+        path = self.client.download(self.dir, '8000', date='20150105')
+
+        self.assertEqual(path, os.path.join(self.dir, 'S_D_8000_20150105.txt.gz'))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), gzipped('a\tb\n'))
+        form = self.server.requests[0][1]
+        self.assertEqual(form['USERNAME'], 'login')
+        self.assertEqual(form['PASSWORD'], 'secret')
+        self.assertEqual(form['VNDNUMBER'], '8000')
+        self.assertEqual(form['REPORTDATE'], '20150105')
+        self.assertEqual(
+            (form['TYPEOFREPORT'], form['DATETYPE'], form['REPORTTYPE']),
+            ('Sales', 'Daily', 'Summary'))
+
+    def test_latest_report_has_no_date(self):
+        self.client.download(self.dir, '8000')
+        self.assertNotIn('REPORTDATE', self.server.requests[0][1])
+
+    def test_no_report_available(self):
+        self.server.missing.add('20150105')
+        self.assertIsNone(self.client.download(self.dir, '8000', date='20150105'))
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_error_message_raises(self):
+        self.server.errors['20150105'] = 'Please enter a valid vendor number.'
+        with self.assertRaisesRegexp(Exception, 'valid vendor number'):
+            self.client.download(self.dir, '8000', date='20150105')
+        # Errors reported by the service are not retried
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_server_errors_are_retried(self):
+        self.server.failures = 2
+        path = self.client.download(self.dir, '8000', date='20150105')
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_gives_up_after_the_retries(self):
+        self.server.failures = 10
+        with self.assertRaises(requests.HTTPError):
+            self.client.download(self.dir, '8000', date='20150105')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_download_many_reuses_one_connection(self):
+        self.server.missing.add('20150102')
+        results = self.client.download_many(
+            self.dir, [('8000', '20150101'), ('8000', '20150102'), ('9000', '20150101')])
+
+        self.assertEqual([(v, d, p and os.path.basename(p)) for v, d, p in results], [
+            ('8000', '20150101', 'S_D_8000_20150101.txt.gz'),
+            ('8000', '20150102', None),
+            ('9000', '20150101', 'S_D_9000_20150101.txt.gz'),
+        ])
+        self.assertEqual(len(set(address for address, form in self.server.requests)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
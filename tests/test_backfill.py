@@ -0,0 +1,72 @@
+import datetime
+import functools
+import shutil
+import tempfile
+import unittest
+
+import autoingestion
+import backfill
+from reports import load_report_manifest
+from storage import LocalBucket
+from tests.standins import AutoingestionStandIn, gzipped
+
+
+class BackfillTest(unittest.TestCase):
+    """Backfills with the python downloader against a local stand-in."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.bucket = LocalBucket(self.dir)
+        self.server = AutoingestionStandIn().__enter__()
+        self.client_class = backfill.AutoingestionClient
+        backfill.AutoingestionClient = functools.partial(
+            autoingestion.AutoingestionClient, url=self.server.url, retry_backoff=0)
+
+    def tearDown(self):
+        backfill.AutoingestionClient = self.client_class
+        self.server.__exit__()
+        shutil.rmtree(self.dir)
+
+    def backfill(self, **kwargs):
+        return backfill.backfill_reports(
+            self.bucket, 'login', 'secret', '8000',
+            datetime.date(2015, 1, 1), datetime.date(2015, 1, 5),
+            processes=2, downloader='python', **kwargs)
+
+    def requested_dates(self):
+        return sorted(form['REPORTDATE'] for address, form in self.server.requests)
+
+    def test_downloads_only_missing_dates(self):
+        key = self.bucket.new_key('itunes/S_D_8000_20150102.txt.gz')
+        key.set_contents_from_string(gzipped('stored\n'))
+        self.server.missing.add('20150104')
+
+        uploaded = self.backfill()
+
+        self.assertEqual(self.requested_dates(), ['20150101', '20150103', '20150104', '20150105'])
+        self.assertEqual(uploaded, [
+            'itunes/S_D_8000_20150101.txt.gz',
+            'itunes/S_D_8000_20150103.txt.gz',
+            'itunes/S_D_8000_20150105.txt.gz',
+        ])
+        self.assertEqual(
+            self.bucket.get_key('itunes/S_D_8000_20150103.txt.gz').get_contents_as_string(),
+            gzipped('report for 20150103\n'))
+        self.assertEqual(
+            sorted(load_report_manifest(self.bucket)['reports']),
+            uploaded[:1] + ['itunes/S_D_8000_20150102.txt.gz'] + uploaded[1:])
+
+    def test_refetch_uploads_only_changed_reports(self):
+        self.backfill()
+        self.server.reports['20150103'] = gzipped('restated\n')
+
+        self.assertEqual(self.backfill(refetch=True), ['itunes/S_D_8000_20150103.txt.gz'])
+        self.assertEqual(len(self.server.requests), 10)
+
+    def test_dry_run_uploads_nothing(self):
+        self.assertEqual(len(self.backfill(dry_run=True)), 5)
+        self.assertEqual(self.bucket.list(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import datetime
+import shutil
+import tempfile
+import unittest
+
+from compaction import compact_reports, uncompact_reports
+from reports import (
+    aggregate_reports_from_files, link_for_latest_report, load_report_manifest,
+    rebuild_report_manifest, update_report_manifest)
+from storage import LocalBucket
+from tests.standins import SyntheticReports
+
+
+class CompactionTest(SyntheticReports, unittest.TestCase):
+    """Compacts January to March 2015 on the first of April."""
+
+    years = 0.25
+    end = datetime.date(2015, 3, 31)
+
+    def compact(self):
+        compact_reports(self.bucket, today=datetime.date(2015, 4, 1))
+
+    def test_totals_are_unchanged(self):
+        totals = aggregate_reports_from_files(self.bucket)
+        self.compact()
+        self.assertEqual(aggregate_reports_from_files(self.bucket), totals)
+        uncompact_reports(self.bucket, '201503')
+        self.assertEqual(aggregate_reports_from_files(self.bucket), totals)
+
+    def test_latest_link_without_a_manifest(self):
+        self.compact()
+        self.assertTrue(link_for_latest_report(self.bucket).endswith(
+            'consolidated/S_D_80000000_201503.txt.gz'))
+
+    def test_latest_link_with_a_manifest(self):
+        rebuild_report_manifest(self.bucket)
+        self.compact()
+        self.assertEqual(
+            load_report_manifest(self.bucket)['latest'],
+            'consolidated/S_D_80000000_201503.txt.gz')
+        self.assertTrue(link_for_latest_report(self.bucket).endswith(
+            'consolidated/S_D_80000000_201503.txt.gz'))
+
+    def test_latest_link_prefers_a_newer_daily_report(self):
+        self.compact()
+        key = self.bucket.new_key('itunes/S_D_80000000_20150401.txt.gz')
+        key.set_contents_from_string('')
+        update_report_manifest(self.bucket, added=[key])
+        self.assertTrue(link_for_latest_report(self.bucket).endswith(
+            'itunes/S_D_80000000_20150401.txt.gz'))
+
+
+class EmptyBucketTest(unittest.TestCase):
+
+    def test_no_latest_link(self):
+        dir = tempfile.mkdtemp()
+        try:
+            self.assertIsNone(link_for_latest_report(LocalBucket(dir)))
+        finally:
+            shutil.rmtree(dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+
+from delivery import SMTPPool, deliver, parse_recipients
+from metrics import METRICS
+from tests.standins import SMTPStandIn
+
+
+class DeliveryTest(unittest.TestCase):
+    """Delivers messages to a local SMTP server."""
+
+    def setUp(self):
+        METRICS.reset()
+        self.server = SMTPStandIn().__enter__()
+
+    def tearDown(self):
+        self.server.__exit__()
+
+    def pool(self, size=1):
+        return SMTPPool(
+            '127.0.0.1', self.server.port, size=size, retry_delay=0, starttls=False)
+
+    def messages(self, *recipients):
+        return [
+            ('report@example.com', [to], 'Subject: Report\\n\\nFor {}\\n'.format(to))
+            for to in recipients
+        ]
+
+    def test_parse_recipients(self):
+        self.assertEqual(
+            parse_recipients(' a@example.com, ,b@example.com '),
+            ['a@example.com', 'b@example.com'])
+
+    def test_messages_share_one_connection(self):
+        smtp = self.pool()
+        try:
+            deliver(self.messages('a@example.com', 'b@example.com', 'c@example.com'), smtp)
+        finally:
+            smtp.close()
+
+        self.assertEqual(
+            sorted(rcpttos for mailfrom, rcpttos, data in self.server.messages),
+            [['a@example.com'], ['b@example.com'], ['c@example.com']])
+        self.assertEqual(self.server.connections, 1)
+
+    def test_pool_opens_at_most_its_size(self):
+        smtp = self.pool(size=2)
+        try:
+            deliver(self.messages(*['{}@example.com'.format(i) for i in range(8)]), smtp)
+        finally:
+            smtp.close()
+
+        self.assertEqual(len(self.server.messages), 8)
+        self.assertLessEqual(self.server.connections, 2)
+
+    def test_dropped_connection_is_retried(self):
+        smtp = self.pool()
+        try:
+            smtp.sendmail(*self.messages('a@example.com')[0])
+            # The server dropped the idle connection
+            smtp.idle[0].sock.close()
+            smtp.sendmail(*self.messages('b@example.com')[0])
+        finally:
+            smtp.close()
+
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(METRICS.record()['phases']['smtp']['retries'], 1)
+
+    def test_refused_message_does_not_stop_the_others(self):
+        self.server.refused.add('b@example.com')
+        smtp = self.pool()
+        try:
+            with self.assertRaisesRegexp(Exception, 'Unable to send 1 of 3 emails'):
+                deliver(self.messages('a@example.com', 'b@example.com', 'c@example.com'), smtp)
+        finally:
+            smtp.close()
+
+        self.assertEqual(
+            sorted(rcpttos for mailfrom, rcpttos, data in self.server.messages),
+            [['a@example.com'], ['c@example.com']])
+        # Refused messages are not sent again
+        self.assertNotIn('retries', METRICS.record()['phases']['smtp'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import unittest
+
+import columnar
+from columnar import numpy
+from reports import (
+    GRANULARITIES, aggregate_report, aggregate_reports_from_files, get_engine)
+from tests.standins import SyntheticReports
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class EngineTest(SyntheticReports, unittest.TestCase):
+    """The numpy engine gives the same reports as the python engine."""
+
+    years = 1.2
+    skus = 3
+    countries = 6
+    rows = 60
+
+    def summarize(self, engine):
+        totals = aggregate_reports_from_files(self.bucket, engine=engine)
+        _, rollup_reports = get_engine(engine)
+        return totals, rollup_reports(totals, GRANULARITIES.keys())
+
+    def test_engines_match(self):
+        python_totals, python_reports = self.summarize('python')
+        numpy_totals, numpy_reports = self.summarize('numpy')
+
+        self.assertEqual(
+            dict((date, list(counts)) for date, counts in python_totals.iteritems()),
+            dict((date, list(counts)) for date, counts in numpy_totals.iteritems()))
+        self.assertEqual(len(python_reports['daily']), 438)
+        for granularity in GRANULARITIES:
+            self.assertEqual(
+                python_reports[granularity].items(), numpy_reports[granularity].items(),
+                granularity)
+
+    def test_engines_match_on_one_report(self):
+        # A single report, so every date group has one day
+        for name in os.listdir(self.reports_dir)[1:]:
+            os.remove(os.path.join(self.reports_dir, name))
+        self.assertEqual(
+            self.summarize('python')[1]['weekly'].items(),
+            self.summarize('numpy')[1]['weekly'].items())
+
+
+HEADER = (
+    'Provider\tProvider Country\tSKU\tDeveloper\tTitle\tVersion\t'
+    'Product Type Identifier\tUnits\tDeveloper Proceeds\tBegin Date\tEnd Date\t'
+    'Customer Currency\tCountry Code\tCurrency of Proceeds\tApple Identifier\t'
+    'Customer Price\tPromo Code\tParent Identifier\tSubscription\tPeriod\n'
+)
+
+
+def row(date, download_type, units, promo='', title='App'):
+    return '\t'.join([
+        'APPLE', 'US', 'SKU1', 'Developer', title, '1.0', download_type, units,
+        '0', date, date, 'USD', 'US', 'USD', '400000001', '0', promo, '', '', '',
+    ]) + '\n'
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class ParseTest(unittest.TestCase):
+    """The numpy engine parses unusual reports like the python engine."""
+
+    rows = [
+        row('01/02/2015', '1T', '3'),
+        row('1/2/2015', '1T', '2', promo='EDU'),
+        row('01/03/2015', '7T', '12'),
+        row('01/03/2015', '1T', '-1'),
+        row('01/03/2015', 'IA1', '5'),
+        row('01/03/2015', '1T', '4', promo='EDUX'),
+    ]
+
+    def assertSameTotals(self, lines):
+        self.assertEqual(
+            columnar.aggregate_report(iter(lines)), aggregate_report(iter(lines)))
+
+    def test_report(self):
+        self.assertSameTotals([HEADER] + self.rows)
+
+    def test_merged_reports(self):
+        # Consolidated reports repeat the header of every daily report
+        self.assertSameTotals([HEADER] + self.rows[:3] + [HEADER] + self.rows[3:])
+
+    def test_rejected_lines(self):
+        self.assertSameTotals([HEADER, 'Total\t3\n', '\n'] + self.rows)
+
+    def test_no_trailing_newline(self):
+        self.assertSameTotals([HEADER] + self.rows + [row('01/04/2015', '1T', '1').rstrip('\n')])
+
+    def test_quoted_title(self):
+        lines = [HEADER, row('01/02/2015', '1T', '3', title='"App\tHD"')]
+        self.assertSameTotals(lines)
+        self.assertEqual(columnar.aggregate_report(iter(lines)), {'2015/01/02': [3, 0, 0]})
+
+    def test_windows_line_endings(self):
+        self.assertSameTotals([line.replace('\n', '\r\n') for line in [HEADER] + self.rows])
+
+    def test_extra_field(self):
+        self.assertSameTotals([HEADER] + self.rows + [row('01/04/2015', '1T', '1')[:-1] + '\tx\n'])
+
+    def test_empty(self):
+        self.assertSameTotals([])
+        self.assertSameTotals([HEADER])
+
+    def test_invalid_units(self):
+        for units in ('x', '-', '', '1-2'):
+            with self.assertRaises(ValueError):
+                columnar.aggregate_report(iter([
+                    HEADER, row('01/02/2015', '1T', '2'), row('01/02/2015', '1T', units)]))
+
+
+if __name__ == '__main__':
+    unittest.main()
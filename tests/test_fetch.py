@@ -0,0 +1,64 @@
+import cStringIO
+import os
+import unittest
+
+try:
+    import boto
+    import moto
+except ImportError:
+    moto = None
+
+from reports import S3_PREFIX, _concatenate_reports_in_bucket, _fetch_reports, _report_keys
+from tests.standins import SyntheticReports
+
+
+class FetchTest(SyntheticReports, unittest.TestCase):
+    """Concurrent fetches give the same reports, in the same order, as
+    fetching one report at a time."""
+
+    def concatenate(self, concurrency):
+        dest = cStringIO.StringIO()
+        _concatenate_reports_in_bucket(self.bucket, dest, concurrency=concurrency)
+        return dest.getvalue()
+
+    def test_concurrent_fetch_matches(self):
+        expected = self.concatenate(1)
+        self.assertTrue(expected)
+        self.assertEqual(self.concatenate(4), expected)
+
+    def test_keys_stay_in_order(self):
+        keys = _report_keys(self.bucket)
+        self.assertGreater(len(keys), 1)
+        fetched = [
+            (key.name, ''.join(chunks))
+            for key, chunks in _fetch_reports(keys, concurrency=4, max_inflight_bytes=1)
+        ]
+        self.assertEqual([name for name, data in fetched], [key.name for key in keys])
+        self.assertEqual(
+            [data for name, data in fetched],
+            [''.join(chunks) for key, chunks in _fetch_reports(keys)])
+
+
+@unittest.skipIf(moto is None, 'moto is not installed')
+class MotoFetchTest(FetchTest):
+    """The same fetches from a moto S3 bucket."""
+
+    def setUp(self):
+        self.mock = moto.mock_s3()
+        self.mock.start()
+        super(MotoFetchTest, self).setUp()
+
+    def tearDown(self):
+        super(MotoFetchTest, self).tearDown()
+        self.mock.stop()
+
+    def open_bucket(self):
+        bucket = boto.connect_s3().create_bucket('reports')
+        for name in os.listdir(self.reports_dir):
+            key = bucket.new_key('{}/{}'.format(S3_PREFIX, name))
+            key.set_contents_from_filename(os.path.join(self.reports_dir, name))
+        return bucket
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+
+from reports import (
+    REPORT_MANIFEST_KEY, load_report_manifest, rebuild_report_manifest,
+    reports_changed_since, update_report_manifest)
+from tests.standins import SyntheticReports
+
+
+class StaleKey(object):
+    """A key as it was read, before another run rewrote it."""
+
+    def __init__(self, key):
+        self.etag = key.etag
+        self.contents = key.get_contents_as_string()
+
+    def get_contents_as_string(self):
+        return self.contents
+
+
+class ManifestTest(SyntheticReports, unittest.TestCase):
+
+    def new_report(self, date):
+        key = self.bucket.new_key('itunes/S_D_80000000_{}.txt.gz'.format(date))
+        key.set_contents_from_string('')
+        return key
+
+    def test_update(self):
+        rebuild_report_manifest(self.bucket)
+        names = sorted(load_report_manifest(self.bucket)['reports'])
+        key = self.new_report('20150311')
+        update_report_manifest(self.bucket, added=[key], removed=names[:1])
+
+        manifest = load_report_manifest(self.bucket)
+        self.assertEqual(sorted(manifest['reports']), names[1:] + [key.name])
+        self.assertEqual(manifest['latest'], key.name)
+
+    def test_reports_changed_since(self):
+        manifest = rebuild_report_manifest(self.bucket)
+        since = max(entry['uploaded'] for entry in manifest['reports'].itervalues())
+        self.assertEqual(reports_changed_since(manifest, since), [])
+
+        manifest['reports']['itunes/S_D_80000000_20150310.txt.gz']['uploaded'] = (
+            '9999-01-01T00:00:00Z')
+        self.assertEqual(
+            reports_changed_since(manifest, since),
+            ['itunes/S_D_80000000_20150310.txt.gz'])
+
+    def test_concurrent_update_is_kept(self):
+        rebuild_report_manifest(self.bucket)
+        first, second = self.new_report('20150311'), self.new_report('20150312')
+
+        # Another run records `second` right after this one read the manifest
+        get_key = self.bucket.get_key
+
+        def get_key_racing(name, *args, **kwargs):
+            key = get_key(name, *args, **kwargs)
+            if name == REPORT_MANIFEST_KEY:
+                self.bucket.get_key = get_key
+                key = StaleKey(key)
+                update_report_manifest(self.bucket, added=[second])
+            return key
+
+        self.bucket.get_key = get_key_racing
+        update_report_manifest(self.bucket, added=[first])
+
+        reports = load_report_manifest(self.bucket)['reports']
+        self.assertIn(first.name, reports)
+        self.assertIn(second.name, reports)
+
+if __name__ == '__main__':
+    unittest.main()
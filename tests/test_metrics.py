@@ -0,0 +1,85 @@
+import socket
+import unittest
+
+from metrics import STATSD_MAX_DATAGRAM, Metrics, send_statsd, statsd_lines
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_nested_timers_split_their_time(self):
+        metrics = Metrics()
+        with metrics.timer('fetch', bytes=10):
+            with metrics.timer('parse', rows=2):
+                pass
+            with metrics.timer('parse', rows=3):
+                pass
+
+        phases = metrics.record()['phases']
+        self.assertEqual(phases['fetch']['bytes'], 10)
+        self.assertEqual(phases['fetch']['calls'], 1)
+        self.assertEqual(phases['parse']['rows'], 5)
+        self.assertEqual(phases['parse']['calls'], 2)
+
+    def test_merge(self):
+        metrics = Metrics()
+        metrics.add('parse', rows=1)
+        other = Metrics()
+        other.add('parse', rows=2)
+        other.sample('unrecognized', 'line')
+        metrics.merge(other.record())
+
+        record = metrics.record()
+        self.assertEqual(record['phases']['parse']['rows'], 3)
+        self.assertEqual(record['samples'], {'unrecognized': ['line']})
+
+
+class StatsdTest(unittest.TestCase):
+    """Sends records to a local UDP socket standing in for StatsD."""
+
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+
+    def tearDown(self):
+        self.sock.close()
+
+    def receive(self, record):
+        send_statsd(record, '127.0.0.1', self.sock.getsockname()[1], prefix='test')
+        datagrams = []
+        self.sock.settimeout(0.5)
+        try:
+            while True:
+                datagrams.append(self.sock.recv(65535))
+        except socket.timeout:
+            pass
+        return datagrams
+
+    def test_send(self):
+        metrics = Metrics()
+        metrics.add('parse', seconds=1.5, rows=10)
+        record = metrics.record()
+
+        datagrams = self.receive(record)
+        self.assertEqual(len(datagrams), 1)
+        lines = datagrams[0].split('\n')
+        self.assertEqual(lines, statsd_lines(record, prefix='test'))
+        self.assertIn('test.parse.seconds:1500|ms', lines)
+        self.assertIn('test.parse.rows:10|c', lines)
+        self.assertIn('test.run.failed:0|g', lines)
+
+    def test_datagrams_fit_the_mtu(self):
+        metrics = Metrics()
+        for i in xrange(200):
+            metrics.add('phase{}'.format(i), requests=i)
+        record = metrics.record()
+
+        datagrams = self.receive(record)
+        self.assertGreater(len(datagrams), 1)
+        self.assertTrue(all(len(datagram) <= STATSD_MAX_DATAGRAM for datagram in datagrams))
+        self.assertEqual(
+            [line for datagram in datagrams for line in datagram.split('\n')],
+            statsd_lines(record, prefix='test'))
+
+
+if __name__ == '__main__':
+    unittest.main()
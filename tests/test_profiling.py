@@ -0,0 +1,66 @@
+import threading
+import time
+import unittest
+
+import profiling
+from profiling import MB, Profiler, parse_memory_budgets
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.poll_interval = profiling.MEMORY_POLL_INTERVAL
+        profiling.MEMORY_POLL_INTERVAL = 0.01
+
+    def tearDown(self):
+        profiling.MEMORY_POLL_INTERVAL = self.poll_interval
+
+    def test_parse_memory_budgets(self):
+        self.assertEqual(
+            parse_memory_budgets(['summary=400,100', 'email=0.5']),
+            {'summary': 400 * MB, None: 100 * MB, 'email': MB / 2})
+        with self.assertRaises(Exception):
+            parse_memory_budgets(['summary=lots'])
+
+    def test_profile(self):
+        profiler = Profiler(profile=True)
+        with profiler.phase('summary'):
+            sum(xrange(1000))
+        entry, = profiler.report()['phases']
+        self.assertEqual(entry['phase'], 'summary')
+        self.assertTrue(entry['hotspots'])
+        self.assertGreater(entry['peak_rss'], 0)
+
+    def test_budget_interrupts_the_phase(self):
+        profiler = Profiler(budgets={'summary': 1})
+        with self.assertRaisesRegexp(Exception, 'The summary phase used'):
+            with profiler.phase('summary'):
+                time.sleep(5)
+                self.fail('The phase was not interrupted.')
+        self.assertEqual(profiler.exceeded, 'summary')
+
+    def test_budget_exceeded_as_the_phase_ends(self):
+        # The watcher finds the phase over its budget only after the block
+        # is done, so it must not interrupt the main thread any more
+        current_rss = profiling.current_rss
+
+        def late_rss():
+            if isinstance(threading.current_thread(), threading._MainThread):
+                return current_rss()
+            time.sleep(0.1)
+            return 1024 * MB
+
+        profiling.current_rss = late_rss
+        try:
+            profiler = Profiler(budgets={'summary': 512 * MB})
+            with self.assertRaisesRegexp(Exception, 'The summary phase used'):
+                with profiler.phase('summary'):
+                    time.sleep(0.05)
+            # Nothing reaches the main thread after the phase
+            time.sleep(0.1)
+        finally:
+            profiling.current_rss = current_rss
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import threading
+import unittest
+
+import requests
+
+from cache import AggregateCache
+from server import ReportServer, ReportService
+from tests.standins import SyntheticReports
+
+
+class ServerTest(SyntheticReports, unittest.TestCase):
+    """Serves synthetic reports from a local directory."""
+
+    def setUp(self):
+        super(ServerTest, self).setUp()
+        service = ReportService(self.bucket, AggregateCache())
+        service.refresh()
+        self.server = ReportServer(('127.0.0.1', 0), service)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super(ServerTest, self).tearDown()
+
+    def get(self, path, **kwargs):
+        return requests.get(self.url + path, **kwargs)
+
+    def test_report(self):
+        response = self.get('/reports/daily.json')
+        self.assertEqual(response.status_code, 200)
+        rows = response.json()['rows']
+        self.assertEqual(rows[-1][0], '2015/03/10')
+
+        etag = response.headers['ETag']
+        self.assertEqual(
+            self.get('/reports/daily.json', headers={'If-None-Match': etag}).status_code,
+            304)
+
+    def test_last(self):
+        rows = self.get('/reports/daily.json').json()['rows']
+        self.assertEqual(self.get('/reports/daily.json?last=3').json()['rows'], rows[-3:])
+        self.assertEqual(self.get('/reports/daily.json?last=0').json()['rows'], [])
+        self.assertEqual(
+            self.get('/reports/daily.json?last={}'.format(len(rows) + 10)).json()['rows'],
+            rows)
+
+    def test_invalid_last(self):
+        for last in ('abc', '-3', '1.5'):
+            response = self.get('/reports/daily.json', params={'last': last})
+            self.assertEqual(response.status_code, 400, last)
+            self.assertIn('error', response.json())
+
+    def test_unknown_report(self):
+        self.assertEqual(self.get('/reports/hourly.json').status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
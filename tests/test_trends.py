@@ -0,0 +1,57 @@
+import datetime
+import unittest
+
+from reports import iter_daily_totals, rollup_ordered_totals
+from tests.standins import SyntheticReports
+from trends import RollingStats, daily_trends
+
+
+class RollingStatsTest(unittest.TestCase):
+
+    def add_days(self, stats, counts, start=datetime.date(2015, 1, 1)):
+        for i, count in enumerate(counts):
+            stats.add(start + datetime.timedelta(days=i), count)
+
+    def test_averages_and_changes(self):
+        stats = RollingStats()
+        self.add_days(stats, [10] * 7 + [20] * 21)
+        self.assertEqual(stats.average('short'), 20)
+        self.assertEqual(stats.average('long'), 17.5)
+        self.assertEqual(stats.change('short', 'previous_week'), 0)
+        self.assertIsNone(stats.change('short', 'previous_year'))
+
+    def test_missing_days_count_as_zero(self):
+        stats = RollingStats()
+        stats.add(datetime.date(2015, 1, 1), 7)
+        stats.add(datetime.date(2015, 1, 7), 7)
+        self.assertEqual(stats.average('short'), 2)
+
+    def test_anomaly(self):
+        stats = RollingStats()
+        self.add_days(stats, [10, 12] * 14 + [100])
+        self.assertTrue(stats.stats()['anomaly'])
+        self.assertGreater(stats.z_score(), 3)
+
+    def test_days_must_follow(self):
+        stats = RollingStats()
+        stats.add(datetime.date(2015, 1, 2), 1)
+        with self.assertRaises(Exception):
+            stats.add(datetime.date(2015, 1, 2), 1)
+
+
+class StreamedTrendsTest(SyntheticReports, unittest.TestCase):
+    """Trends kept while rolling up a stream match those of the report."""
+
+    years = 1.1
+
+    def test_streamed_trends_match(self):
+        trends = RollingStats()
+        reports = rollup_ordered_totals(
+            iter_daily_totals(self.bucket), ['daily'], trends=trends)
+        self.assertEqual(trends.date, datetime.date(2015, 3, 10))
+        self.assertIsNotNone(trends.stats()['year_over_year'])
+        self.assertEqual(trends.stats(), daily_trends(reports['daily']))
+
+
+if __name__ == '__main__':
+    unittest.main()